@@ -1,4 +1,4 @@
-__all__ = ['complex_handler', 'handlers', 'simple_handler', 'util']
+__all__ = ['cache', 'complex_handler', 'export', 'generation', 'handlers', 'limiter', 'metrics', 'query_parser', 'serialize', 'simple_handler', 'solr_client', 'taxonomy', 'util']
 __version__ = '0.7.11'
 __cantus_version__ = '0.3.0'
 
@@ -32,6 +32,8 @@ CANTUS_REQUEST_HEADERS = (
     'X-Cantus-Include-Resources',
     'X-Cantus-Sort',
     'X-Cantus-Fields',
+    'X-Cantus-Cursor',
+    'X-Cantus-Deadline',
     # these are for Safari
     'Origin',
     'X-Requested-With',
@@ -44,7 +46,8 @@ other headers as applicable---this list determines the value of the
 
 CANTUS_RESPONSE_HEADERS = ('X-Cantus-Per-Page', 'X-Cantus-Page', 'X-Cantus-Include-Resources',
                            'X-Cantus-Sort', 'X-Cantus-Fields', 'Server', 'X-Cantus-Extra-Fields',
-                           'X-Cantus-Version', 'X-Cantus-Total-Results')
+                           'X-Cantus-Version', 'X-Cantus-Total-Results', 'X-Cantus-Cursor',
+                           'X-Cantus-Partial')
 '''
 Iterable of the headers that Cantus clients are interested in reading. Needless to say, Cantus
 clients may be interested in other headers---this list determines the value of the
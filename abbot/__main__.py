@@ -27,17 +27,25 @@ Main file for the Abbot server reference implementation of the Cantus API.
 '''
 
 import logging
+import os
+import socket
 import ssl
 
-from tornado import log, ioloop, web
+from tornado import log, ioloop, netutil, process, web
 from tornado.options import define, options
 from tornado.options import Error as OptionsError
 
 from systemdream.journal import handler as journalctl
-from tornado_systemd import SystemdHTTPServer
+from tornado_systemd import SystemdHTTPServer, SYSTEMD_SOCKET_FD
 
 import abbot
-from abbot.handlers import CanonicalHandler, RootHandler, EverythingElseHandler
+from abbot import generation
+from abbot import metrics
+from abbot import serialize
+from abbot import simple_handler
+from abbot import taxonomy
+from abbot import util
+from abbot.handlers import CanonicalHandler, RootHandler, EverythingElseHandler, make_root_document
 from abbot.simple_handler import SimpleHandler
 from abbot.complex_handler import ComplexHandler
 
@@ -49,6 +57,10 @@ define('server_name', default='', type=str, help='set with hostname and port; no
 define('certfile', default='', type=str, help='TLS certificate file')
 define('keyfile', default='', type=str, help='TLS private key file')
 define('ciphers', default='', type=str, help='TLS cipherlist in OpenSSL format')
+define('workers', default=1, type=int,
+       help='number of worker processes to start (0 for one per CPU core)')
+define('max_worker_restarts', default=100, type=int,
+       help='how many times to restart a worker process that dies before Abbot quits')
 
 
 # NOTE: these URLs require a terminating /
@@ -115,6 +127,53 @@ HANDLERS = [
     ]
 
 
+_ID_MARKER = 'abbotresourceid'
+# stands in for the resource ID when compile_routes() makes the URL_TEMPLATES
+
+
+def compile_routes(specs):
+    '''
+    Work out, once, the metadata that every request to a URL would otherwise work out again, so
+    that every request handler shares them. Call this after the "server_name" option is set.
+
+    - Every URL for a :class:`SimpleHandler` gets a :class:`~abbot.simple_handler.Route`, with the
+      fields to return and the headers for OPTIONS requests.
+    - :const:`abbot.simple_handler.URL_TEMPLATES` gets the path of every "view" URL, so resource
+      URLs are made without :meth:`~tornado.web.RequestHandler.reverse_url`.
+    - The :class:`RootHandler` gets its serialized response body.
+
+    :param specs: The URLs, like :const:`HANDLERS`. They are not modified.
+    :type specs: list of :class:`tornado.web.URLSpec`
+    :returns: New URLs to give to the :class:`~tornado.web.Application`, with the metadata in
+        the arguments for the handlers' ``initialize()`` method.
+    :rtype: list of :class:`tornado.web.URLSpec`
+    '''
+    named = {spec.name: spec for spec in specs if spec.name}
+    post = []
+
+    for spec in specs:
+        kwargs = dict(spec.kwargs or {})
+
+        if issubclass(spec.handler_class, SimpleHandler):
+            route = simple_handler.compile_route(kwargs['type_name'], kwargs.get('additional_fields'))
+            kwargs['route'] = route
+
+            if spec.name and spec.name.startswith('view_'):
+                # reverse() gives a path like "/chants/ID/?" but resource URLs are like "chants/ID/"
+                template = spec.reverse(_ID_MARKER)[1:-1].replace(_ID_MARKER, '{}')
+                simple_handler.URL_TEMPLATES[spec.name[len('view_'):]] = template
+                simple_handler.URL_TEMPLATES[route.type_name] = template
+
+        elif issubclass(spec.handler_class, RootHandler):
+            document = make_root_document(lambda name, *args: named[name].reverse(*args))
+            kwargs['document'] = serialize.Raw(serialize.encode(document))
+
+        post.append(web.URLSpec(spec.regex.pattern, spec.handler_class, kwargs=kwargs or None,
+                                name=spec.name))
+
+    return post
+
+
 def _load_options():
     '''
     Load options from the command line and from any configuration file.
@@ -236,6 +295,93 @@ def _set_addresses():
     log.app_log.debug('Listening on {}'.format(options.server_name))
 
 
+def _num_workers():
+    '''
+    Determine how many worker processes to start.
+
+    :returns: The number of worker processes, or ``0`` for one per CPU core.
+    :rtype: int
+    '''
+    if not isinstance(options.workers, int) or options.workers < 0:
+        log.app_log.warn('Invalid number of workers ({}); starting one.'.format(options.workers))
+        return 1
+    else:
+        return options.workers
+
+
+def _socket_activated():
+    '''
+    Determine whether systemd started Abbot with socket activation, as
+    :attr:`SystemdHTTPServer.systemd` does. Call this before starting any worker processes, since
+    only the process systemd started is named in "LISTEN_PID."
+
+    :returns: Whether the listening socket is inherited from systemd.
+    :rtype: bool
+    '''
+    return os.environ.get('LISTEN_PID', None) == str(os.getpid())
+
+
+# socket.SO_DOMAIN is new in Python 3.6, but systemd only runs on Linux, where it is 39
+_SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39)
+
+
+def _bind_sockets(systemd):
+    '''
+    Get the listening sockets, before any worker processes are started, so they are shared by all
+    the workers.
+
+    :param bool systemd: Whether to use the socket from systemd socket activation (the return
+        value of :func:`_socket_activated`). Otherwise Abbot binds to the "port" option.
+    :returns: The listening sockets.
+    :rtype: list of :class:`socket.socket`
+
+    The address family and type of the socket from systemd (IPv4, IPv6, or a Unix socket) are read
+    from the socket itself with ``getsockopt()``, rather than assumed. (Only Python 3.7 and later
+    do this when given just a file descriptor.)
+    '''
+    if systemd:
+        with socket.fromfd(SYSTEMD_SOCKET_FD, socket.AF_INET, socket.SOCK_STREAM) as probe:
+            family = probe.getsockopt(socket.SOL_SOCKET, _SO_DOMAIN)
+            sock_type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        sck = socket.socket(family, sock_type, fileno=SYSTEMD_SOCKET_FD)
+        sck.setblocking(0)
+        sck.listen(128)
+        return [sck]
+    else:  # pragma: no cover
+        return netutil.bind_sockets(options.port)
+
+
+def _set_log_identifier(task_id):  # pragma: no cover
+    '''
+    Replace the systemd-journal log handler with one that identifies a worker process, like
+    "abbot-3" for the worker with ``task_id`` 3.
+
+    :param int task_id: The worker's task ID, from :func:`tornado.process.fork_processes`.
+    '''
+    for handler in logging.root.handlers[:]:
+        if isinstance(handler, journalctl.JournalHandler):
+            logging.root.removeHandler(handler)
+    identifier = 'abbot-{}'.format(task_id)
+    logging.root.addHandler(journalctl.JournalHandler(SYSLOG_IDENTIFIER=identifier))
+
+
+def make_app(routes):
+    '''
+    Make the :class:`~tornado.web.Application` that answers Cantus API requests.
+
+    :param routes: The URLs and their handlers, as returned by :func:`compile_routes`.
+    :type routes: list of tuple
+    :returns: The application, with the "debug" and "compress_response" settings from the "debug"
+        option, and :func:`abbot.metrics.log_request` as its "log_function."
+    :rtype: :class:`tornado.web.Application`
+    '''
+    settings = {'debug': options.debug,
+                'compress_response': not options.debug,
+                'log_function': metrics.log_request,
+               }
+    return web.Application(routes, **settings)
+
+
 def main():  # pragma: no cover
     '''
     This function creates a Tornado Web Application listening on the specified port, then starts
@@ -257,10 +403,21 @@ def main():  # pragma: no cover
     _set_log_level()
     _set_addresses()
 
-    # prepare settings for the HTTPServer
-    settings = {'debug': options.debug,
-                'compress_response': not options.debug,
-               }
+    # bind the sockets, then start the worker processes
+    systemd = _socket_activated()
+    sockets = _bind_sockets(systemd)
+    num_workers = _num_workers()
+    task_id = None
+    if num_workers != 1:
+        # the parent process stays here, restarting workers that die; only workers return
+        task_id = process.fork_processes(num_workers, max_restarts=options.max_worker_restarts)
+        _set_log_identifier(task_id)
+
+    # everything that uses the IOLoop must be made after forking
+    util.connect_solr()
+
+    # prepare the metadata shared by every request to each URL, and the Application using it
+    app = make_app(compile_routes(HANDLERS))
 
     # prepare cryptography settings for the HTTPServer
     if options.certfile and options.keyfile and options.ciphers:
@@ -270,15 +427,18 @@ def main():  # pragma: no cover
         crypto.options = crypto.options | ssl.OP_NO_SSLv2
         crypto.options = crypto.options | ssl.OP_NO_SSLv3
 
-        server = SystemdHTTPServer(
-            web.Application(handlers=HANDLERS, settings=settings),
-            ssl_options=crypto)
+        server = SystemdHTTPServer(app, ssl_options=crypto)
     else:
         print('HEY! You are not using HTTPS!')
         log.app_log.warn('HEY! You are not using HTTPS!')
-        server = SystemdHTTPServer(web.Application(handlers=HANDLERS, settings=settings))
+        server = SystemdHTTPServer(app)
+
+    server.request_callback.systemd = systemd  # as SystemdHTTPServer.listen() would set it
+    server.add_sockets(sockets)
+    metrics.listen(task_id)
 
-    server.listen(options.port)
+    generation.start_refreshing()
+    taxonomy.start_refreshing()
 
     try:
         ioloop.IOLoop.current().start()
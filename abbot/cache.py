@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/cache.py
+# Purpose:                In-memory caches for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+In-memory caches for the Abbot server.
+'''
+
+from collections import OrderedDict
+import time
+
+
+def _now_wrapper():
+    '''
+    A wrapper function for time.monotonic() that can be mocked for automated tests.
+    '''
+    return time.monotonic()
+
+
+class LRUCache(object):
+    '''
+    A dictionary-like cache with a maximum size and an optional time-to-live.
+
+    When the cache is full, adding a new entry evicts the least-recently-used entry. When an entry
+    is older than ``ttl`` seconds it is treated as missing, and removed the next time it is
+    requested.
+
+    By default every entry has a size of ``1``, so ``maxsize`` is the maximum number of entries. If
+    you provide a ``getsizeof`` function, it is called with each value to find that entry's size,
+    so ``maxsize`` may be (for example) a number of bytes. A value larger than ``maxsize`` is never
+    stored.
+
+    A :class:`LRUCache` with a ``maxsize`` of ``0`` is disabled: :meth:`get` always misses and
+    :meth:`put` does nothing. This lets callers use the cache unconditionally.
+
+    The ``hits`` and ``misses`` attributes count the calls to :meth:`get` that did and did not find
+    a value.
+
+    **Example**
+
+    >>> cache = LRUCache(2)
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.put('c', 3)  # evicts "b", since "a" was used more recently
+    >>> cache.get('b') is None
+    True
+    '''
+
+    def __init__(self, maxsize, ttl=None, getsizeof=None):
+        '''
+        :param int maxsize: The maximum total size of the entries to hold.
+        :param ttl: The number of seconds an entry stays valid, or ``None`` for no expiry.
+        :type ttl: int or float or NoneType
+        :param getsizeof: A function that returns the size of a value. The default gives every
+            value a size of ``1``.
+        :type getsizeof: function
+        '''
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self._getsizeof = getsizeof
+        self._data = OrderedDict()  # key -> (expiry time, size, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def get(self, key, default=None):
+        '''
+        Get a value from the cache, marking it as recently used.
+
+        :param key: The key to find.
+        :param default: The value to return when ``key`` is missing or expired.
+        :returns: The cached value, or ``default``.
+        '''
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        else:
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        '''
+        Add a value to the cache, evicting the least-recently-used entries as required.
+
+        :param key: The key under which to store ``value``.
+        :param value: The value to store.
+        '''
+        if self.maxsize <= 0:
+            return
+
+        size = self._getsizeof(value) if self._getsizeof else 1
+        if size > self.maxsize:
+            return
+
+        if self.ttl:
+            expiry = _now_wrapper() + self.ttl
+        else:
+            expiry = None
+
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = (expiry, size, value)
+        self.currsize += size
+
+        self._evict()
+
+    def resize(self, maxsize=None, ttl=None):
+        '''
+        Change the size limit or time-to-live of the cache, evicting entries if required.
+
+        :param int maxsize: The new maximum size, or ``None`` to keep the current one.
+        :param ttl: The new time-to-live in seconds, or ``None`` to keep the current one.
+        '''
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+
+        self._evict()
+
+    def clear(self):
+        '''
+        Remove every entry from the cache.
+        '''
+        self._data.clear()
+        self.currsize = 0
+
+    def _lookup(self, key):
+        "Find the value for ``key``, marking it as recently used, or return ``_MISSING``."
+        try:
+            expiry, _, value = self._data[key]
+        except KeyError:
+            return _MISSING
+
+        if expiry is not None and expiry <= _now_wrapper():
+            self._remove(key)
+            return _MISSING
+
+        self._data.move_to_end(key)
+        return value
+
+    def _remove(self, key):
+        "Remove the entry for ``key``, which must exist."
+        self.currsize -= self._data.pop(key)[1]
+
+    def _evict(self):
+        "Remove least-recently-used entries until the cache is within its size limit."
+        while self._data and self.currsize > max(self.maxsize, 0):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self.currsize -= size
+
+
+_MISSING = object()
+# sentinel for LRUCache._lookup(), since None may be a cached value
@@ -30,13 +30,36 @@ from collections import namedtuple
 
 from tornado.log import app_log as log
 from tornado import gen
+from tornado.options import options
 
 import pysolrtornado
 
+from abbot import cache
+from abbot import generation
+from abbot import metrics
+from abbot import serialize
 from abbot import util
 from abbot import simple_handler
 
 
+options.define('xref_cache_size', type=int, default=4096,
+               help='maximum number of cross-referenced resources to cache (0 to disable)',
+               callback=lambda size: XREF_CACHE.resize(maxsize=size))
+options.define('xref_cache_ttl', type=int, default=3600,
+               help='number of seconds a cached cross-referenced resource stays valid',
+               callback=lambda ttl: XREF_CACHE.resize(ttl=ttl))
+
+
+XREF_CACHE = cache.LRUCache(options.xref_cache_size, options.xref_cache_ttl)
+'''
+Process-wide cache of the resources fetched by :meth:`Xref.lookup`, keyed on resource ID. These are
+mostly taxonomy resources (feasts, genres, and so on) that change only when HolyOrders runs, so they
+are kept for ``xref_cache_ttl`` seconds, or until the data generation changes.
+'''
+generation.CURRENT.add_listener(XREF_CACHE.clear)
+metrics.watch_cache('xref', XREF_CACHE)
+
+
 XrefLookup = namedtuple('XrefLookup', ['type', 'replace_with', 'replace_to'])
 '''
 Provide instructions for processing fields that are obtained with by cross-reference to another
@@ -89,9 +112,31 @@ class Xref(object):
 
         return post, set(xref_query)
 
+    @staticmethod
+    def from_cache(xref_query):
+        '''
+        Take the cross-reference resources that are already in :const:`XREF_CACHE`.
+
+        :param xref_query: As described in :meth:`lookup`.
+        :returns: The cached resources, keyed on resource ID, and the members of ``xref_query``
+            that are not cached.
+        :rtype: 2-tuple of dict and list of str
+        '''
+        post = {}
+        missing = []
+
+        for each_xref in xref_query:
+            cached = XREF_CACHE.get(each_xref[3:])  # remove the "id:" prefix
+            if cached is None:
+                missing.append(each_xref)
+            else:
+                post[cached['id']] = cached
+
+        return post, missing
+
     @staticmethod
     @gen.coroutine
-    def lookup(xref_query):
+    def lookup(xref_query, deadline=None):
         '''
         Step 2: look up all the cross-reference resources at once.
 
@@ -100,27 +145,29 @@ class Xref(object):
         :param xref_query: The second element in the 2-tuple returned by :meth:`collect`. This is an
             iterable of strings that contain the resource IDs to retrieve from Solr. Each resource
             ID should be prefaced with ``'id:'``, like ``'id:123'``.
+        :param float deadline: As described in :func:`abbot.util.search_solr`.
         :returns: The cross-reference resources from Solr. In the dictionary, resource IDs are keys,
             and the resources themselves are values.
         :rtype: dict
+        :raises: :exc:`pysolrtornado.SolrError` when the Solr request fails, including
+            :exc:`abbot.util.DeadlineExceeded` and :exc:`abbot.util.Overloaded`.
 
         If ``xref_query`` is an empty list, this method returns an empty dictionary.
 
-        This method also returns an empty dictionary (and emits a log message) if the Solr request
-        fails. While this will return incomplete data to the user agent (because the cross-referenced
-        fields will be missing) it will be better than returning no data.
+        Resources are first taken from :const:`XREF_CACHE` with :meth:`from_cache`. Solr is only
+        asked for the resources that are not already cached, and if every resource is cached then
+        Solr is not asked at all.
         '''
-        post = {}
+        post, missing = Xref.from_cache(xref_query)
 
-        if len(xref_query):
-            try:
-                xreffed = yield util.search_solr(' OR '.join(xref_query), rows=len(xref_query))
-            except pysolrtornado.SolrError as err:
-                log.warn('Solr problem: {0}'.format(err.args[0]))
-                xreffed = []
+        if len(missing):
+            xreffed = yield util.search_solr(' OR '.join(missing), rows=len(missing),
+                                             fields=_XREF_FIELDS, caller='Xref.lookup',
+                                             deadline=deadline)
 
             for result in xreffed:
                 post[result['id']] = result
+                XREF_CACHE.put(result['id'], result)
 
         return post
 
@@ -245,7 +292,19 @@ class ComplexHandler(simple_handler.SimpleHandler):
         substitutions indicated by :const:`ComplexHandler.LOOKUP`.
 
         The return value is the response body---in other words, the "results" argument with cross-
-        referenced fields substituted and appropriate "resources" information added.
+        referenced fields substituted and appropriate "resources" information added. The extra
+        fields from :meth:`make_extra_fields` are filled in from the same cross-references, so the
+        whole response needs only one cross-reference query, however many records it holds.
+
+        Records that came from the :const:`~abbot.simple_handler.FRAGMENT_CACHE` already have their
+        cross-references, so they are copied as they are. When ``self.use_fragments`` is ``True``, a
+        record with a cross-reference that was not found is added to ``self.partial_records``, so it
+        is not cached.
+
+        If Solr fails to look up the cross-references (including when ``self.deadline`` passes or
+        too many queries are waiting for Solr), the records are returned with only the cached
+        cross-references, and ``self.partial_response`` is set to ``True`` so the incomplete
+        response is neither cached nor given validators.
 
         :param dict record: A resource that may have some keys matching a key in
             :const:`ComplexHandler.LOOKUP`.
@@ -260,36 +319,52 @@ class ComplexHandler(simple_handler.SimpleHandler):
 
         # 1: collect all the resource IDs we need to look up
         xref_query = set()
+        record_xrefs = {}
         for each_id, each_result in results.items():
             if each_id in ('sort_order', 'resources'):
                 continue
+            elif isinstance(each_result, serialize.Raw):
+                post[each_id] = each_result
+                continue
             collected = Xref.collect(each_result)
             post[each_id] = collected[0]
+            record_xrefs[each_id] = collected[1]
             xref_query = xref_query.union(collected[1])
 
         # 2: look up all the cross-reference resources at once
-        xrefs = yield Xref.lookup(xref_query)
+        with self.timing('xrefs'):
+            try:
+                xrefs = yield Xref.lookup(xref_query, deadline=self.deadline)
+            except pysolrtornado.SolrError as err:
+                log.warn('Solr problem: {0}'.format(err.args[0]))
+                xrefs = Xref.from_cache(xref_query)[0]
+                self.partial_response = True
 
         for each_id, each_result in results.items():
-            if each_id in ('sort_order', 'resources'):
+            if each_id not in record_xrefs:
                 continue
+            if self.use_fragments and any(each_xref[3:] not in xrefs for each_xref in record_xrefs[each_id]):
+                self.partial_records.add(each_id)
+
             # 3: fill in the cross-referenced fields
             filled = Xref.fill(each_result, post[each_id], xrefs)
-            post[each_id] = filled
 
-            # 4: fill in the cross-references resources links
+            # 4: fill in extra fields, like descriptions, when relevant
+            with self.timing('extra_fields'):
+                post[each_id] = self.make_extra_fields(filled, each_result, xrefs)
+
+            # 5: fill in the cross-references resources links
             if include_resources:
                 resources[each_id].update(Xref.resources(each_result, filled, xrefs, self.make_resource_url))
 
-        # 5: copy over last-minute things
+        # 6: copy over last-minute things
         post['sort_order'] = results['sort_order']
         if include_resources:
             post['resources'] = resources
 
         return post
 
-    @gen.coroutine
-    def make_extra_fields(self, record, orig_record):
+    def make_extra_fields(self, record, orig_record, xrefs):
         '''
         For cross-reference records that require more than one field from the cross-referenced
         record, use this method!
@@ -297,32 +372,41 @@ class ComplexHandler(simple_handler.SimpleHandler):
         :param dict record: The record as being prepared for output.
         :param dict orig_record: The record as returned directly from the database (i.e., before
             processing any cross-references).
+        :param dict xrefs: The return value of :meth:`Xref.lookup`, containing the cross-reference
+            resources from Solr. Resource IDs are keys, and the resources themselves are values.
         :returns: The ``record`` argument with additional fields as possible.
         :rtype: dict
         '''
 
         # (for Chant) fill in fest_desc if we have a feast_id
-        if 'feast_id' in self.returned_fields and 'feast_id' in orig_record:
-            try:
-                resp = yield util.ask_solr_by_id('feast', orig_record['feast_id'])
-            except pysolrtornado.SolrError as err:
-                log.warn('Solr problem: {0}'.format(err.args[0]))
-                resp = []
-            if len(resp) > 0 and 'description' in resp[0]:
-                record['feast_desc'] = resp[0]['description']
+        if 'feast_id' in self.returned_field_set and 'feast_id' in orig_record:
+            xref = xrefs.get(orig_record['feast_id'], {})
+            if 'description' in xref:
+                record['feast_desc'] = xref['description']
 
         # (for Source) fill in source_status_desc if we have a source_status_id (probably never used)
-        if 'source_status_id' in self.returned_fields and 'source_status_id' in orig_record:
-            try:
-                resp = yield util.ask_solr_by_id('source_status', orig_record['source_status_id'])
-            except pysolrtornado.SolrError as err:
-                log.warn('Solr problem: {0}'.format(err.args[0]))
-                resp = []
-            if len(resp) > 0 and 'description' in resp[0]:
-                record['source_status_desc'] = resp[0]['description']
+        if 'source_status_id' in self.returned_field_set and 'source_status_id' in orig_record:
+            xref = xrefs.get(orig_record['source_status_id'], {})
+            if 'description' in xref:
+                record['source_status_desc'] = xref['description']
 
         return record
 
+    def export_columns(self):
+        '''
+        List the fields of an NDJSON or CSV export, as in :meth:`SimpleHandler.export_columns`, with
+        the extra fields from :meth:`make_extra_fields`.
+
+        :returns: The field names.
+        :rtype: list of str
+        '''
+        post = super(ComplexHandler, self).export_columns()
+        if 'feast_id' in self.returned_field_set:
+            post.append('feast_desc')
+        if 'source_status_id' in self.returned_field_set:
+            post.append('source_status_desc')
+        return post
+
     @gen.coroutine
     def get_handler(self, resource_id=None, query=None):  # pylint: disable=arguments-differ
         '''
@@ -342,16 +426,8 @@ class ComplexHandler(simple_handler.SimpleHandler):
         if results is None:
             return results, num_results
 
-        post = {'sort_order': results['sort_order']}
-        if self.hparams['include_resources']:
-            post['resources'] = results['resources']
-
         post = yield self.look_up_xrefs(results, self.hparams['include_resources'])
 
-        for record in results['sort_order']:
-            # fill in extra fields, like descriptions, when relevant
-            post[record] = yield self.make_extra_fields(post[record], results[record])
-
         return post, num_results
 
     def _lookup_name_for_response(self, name):
@@ -370,3 +446,11 @@ class ComplexHandler(simple_handler.SimpleHandler):
             return ComplexHandler.LOOKUP[name].replace_to
         else:
             return name
+
+
+_XREF_FIELDS = sorted({'id', 'type', 'description'}.union(
+    each.replace_with for each in ComplexHandler.LOOKUP.values()))
+'''
+The fields that :meth:`Xref.lookup` requests from Solr: those named by "replace_with" in
+:const:`ComplexHandler.LOOKUP`, plus "description" for :meth:`ComplexHandler.make_extra_fields`.
+'''
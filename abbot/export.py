@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/export.py
+# Purpose:                Streaming export of whole result sets for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Streaming export of whole result sets for the Abbot server.
+
+A GET request to a "browse" URL, or a SEARCH request, whose "Accept" header asks for NDJSON
+(``application/x-ndjson``) or CSV (``text/csv``) gets every matching resource rather than one page.
+The resources are fetched from Solr ``export_batch_size`` at a time with a cursor, cross-references
+are looked up once per batch, and each batch is sent to the client before the next is fetched, so
+the memory used does not depend on the size of the result set.
+
+The exported resources have the same fields as in a Cantus API response, but there is no
+"resources" member, and the X-Cantus-Page, X-Cantus-Per-Page, and X-Cantus-Cursor headers are
+ignored. Every response to these requests, export or not, has a ``Vary: Accept`` header.
+'''
+
+import csv
+import io
+
+from tornado import gen
+from tornado.options import options
+import pysolrtornado
+
+from abbot import serialize
+
+
+options.define('export_batch_size', type=int, default=500,
+               help='number of resources to fetch from Solr at a time for an NDJSON or CSV export')
+
+
+class NdjsonFormat(object):
+    '''
+    Newline-delimited JSON: every resource is a JSON object on its own line.
+    '''
+
+    content_type = 'application/x-ndjson; charset=UTF-8'
+
+    @staticmethod
+    def header(columns):  # pylint: disable=unused-argument
+        '''
+        :param columns: The field names to export.
+        :type columns: list of str
+        :returns: The text that starts an export; there is none for NDJSON.
+        :rtype: str
+        '''
+        return ''
+
+    @staticmethod
+    def rows(records, columns):  # pylint: disable=unused-argument
+        '''
+        :param records: The resources to export, as in a Cantus API response.
+        :type records: list of dict
+        :param columns: The field names to export. Every field of a resource is exported, so this
+            is ignored.
+        :type columns: list of str
+        :returns: One line for each record.
+        :rtype: bytes
+        '''
+        return b''.join(serialize.encode(record) + b'\n' for record in records)
+
+
+class CsvFormat(object):
+    '''
+    Comma-separated values, with a header row. Fields with several values (like "indexers") have
+    them separated by a "|" character.
+    '''
+
+    content_type = 'text/csv; charset=UTF-8'
+
+    @staticmethod
+    def _write(rows):
+        "Format ``rows`` (a list of lists) as CSV."
+        post = io.StringIO()
+        csv.writer(post).writerows(rows)
+        return post.getvalue()
+
+    @staticmethod
+    def header(columns):
+        '''
+        :param columns: The field names to export, in order.
+        :type columns: list of str
+        :returns: The header row.
+        :rtype: str
+        '''
+        return CsvFormat._write([columns])
+
+    @staticmethod
+    def rows(records, columns):
+        '''
+        :param records: The resources to export, as in a Cantus API response.
+        :type records: list of dict
+        :param columns: The field names to export, in order. Other fields are not exported.
+        :type columns: list of str
+        :returns: One row for each record.
+        :rtype: str
+        '''
+        rows = []
+        for record in records:
+            row = []
+            for column in columns:
+                value = record.get(column, '')
+                if isinstance(value, list):
+                    value = '|'.join(str(each) for each in value)
+                row.append(value)
+            rows.append(row)
+        return CsvFormat._write(rows)
+
+
+FORMATS = {'application/x-ndjson': NdjsonFormat,
+           'application/ndjson': NdjsonFormat,
+           'text/csv': CsvFormat,
+          }
+'''
+The export formats, keyed on the media type that asks for them in an "Accept" header.
+'''
+
+
+def choose_format(accept):
+    '''
+    Choose an export format from the value of an "Accept" request header.
+
+    :param str accept: The "Accept" header, or ``None`` if there was none.
+    :returns: The first export format in ``accept`` that isn't refused with ``q=0``, or ``None`` if
+        there is none, in which case the usual JSON response should be sent.
+    :rtype: :class:`NdjsonFormat` or :class:`CsvFormat` or ``None``
+    '''
+    if not accept:
+        return None
+
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        media_type = media_type.lower()
+        if media_type not in FORMATS:
+            continue
+
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0.0:
+            return FORMATS[media_type]
+
+    return None
+
+
+# error message for stream()
+_MISSING_XREFS = 'Solr did not answer the cross-reference lookup for an export batch'
+
+
+@gen.coroutine
+def stream(handler, export_format, resource_id=None, query=None):
+    '''
+    Send every resource that matches a request, in batches.
+
+    .. note:: This function is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+    :param handler: The request handler, after :meth:`~SimpleHandler.verify_request_headers`.
+    :type handler: :class:`~abbot.simple_handler.SimpleHandler`
+    :param export_format: The return value of :func:`choose_format`.
+    :param str resource_id: As for :meth:`SimpleHandler.get_handler`.
+    :param str query: As for :meth:`SimpleHandler.get_handler`.
+    :raises: :exc:`pysolrtornado.SolrError` when there's an error while connecting to Solr. If it
+        happens after the first batch, part of the response has already been sent.
+
+    If the first batch has no results, the handler sends an error response as usual.
+
+    The export is not bound by the request's deadline (the handler's ``deadline`` is cleared),
+    since it may take many batches. A batch whose cross-references could not be looked up is an
+    error, rather than rows with fields silently missing.
+    '''
+    handler.deadline = None
+    handler.hparams['include_resources'] = False
+    handler.hparams['page'] = None
+    handler.hparams['per_page'] = options.export_batch_size
+    handler.hparams['cursor'] = '*'
+    handler.use_fragments = False
+    columns = handler.export_columns()
+    num_written = 0
+
+    while True:
+        response, num_results = yield handler.get_handler(resource_id=resource_id, query=query)
+        if response is None:
+            return
+        if handler.partial_response:
+            raise pysolrtornado.SolrError(_MISSING_XREFS)
+
+        if num_written == 0:
+            handler.set_header('Content-Type', export_format.content_type)
+            handler.add_header('X-Cantus-Total-Results', handler.total_results)
+            handler.write(export_format.header(columns))
+
+        handler.write(export_format.rows([response[i] for i in response['sort_order']], columns))
+        num_written += num_results
+        yield handler.flush()
+
+        if handler.next_cursor is None or num_written >= handler.total_results:
+            return
+        handler.hparams['cursor'] = handler.next_cursor
+        handler.next_cursor = None
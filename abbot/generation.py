@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/generation.py
+# Purpose:                Track the "generation" of the data behind the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Track the "generation" of the data behind the Abbot server.
+
+A generation is a short string that changes whenever the data in Solr change. Abbot uses it to make
+"ETag" and "Last-Modified" response headers, and to know when its caches are out of date.
+
+If the ``updates_db`` option is set, the generation comes from the most recent "updated" time that
+Holy Orders recorded in its updates database. Otherwise the generation is Solr's index version. The
+:const:`CURRENT` generation is checked every ``generation_refresh`` seconds.
+'''
+
+import datetime
+import sqlite3
+
+from tornado import escape, gen, ioloop
+from tornado.log import app_log as log
+from tornado.options import options
+import iso8601
+import pysolrtornado
+
+from abbot import util
+
+
+options.define('updates_db', type=str, default='',
+               help='path to the Holy Orders updates database, used to know when data change')
+options.define('generation_refresh', type=int, default=30,
+               help='seconds between checks for changed data (0 to disable "ETag" headers)')
+
+
+_LUKE_PATH = 'admin/luke?numTerms=0&wt=json'
+# Solr's "Luke" request handler, which tells us about the index without listing any terms
+
+_CHECK_FAILED = 'Could not determine the data generation ({}).'
+
+
+class Generation(object):
+    '''
+    The generation of the data served by Abbot.
+
+    :ivar str tag: A string that changes whenever the data change, or ``None`` when unknown.
+    :ivar last_modified: When the data last changed, or ``None`` when unknown.
+    :vartype last_modified: :class:`datetime.datetime`
+    '''
+
+    def __init__(self):
+        "Initialize a :class:`Generation` that is not yet known."
+        self.tag = None
+        self.last_modified = None
+        self._listeners = []
+
+    def add_listener(self, listener):
+        '''
+        Add a function to call, with no arguments, whenever the generation changes.
+
+        :param listener: The function to call.
+        :type listener: callable
+        '''
+        self._listeners.append(listener)
+
+    def update(self, tag, last_modified):
+        '''
+        Set the generation. If ``tag`` differs from the current tag, every listener is called.
+
+        :param str tag: The new generation tag.
+        :param last_modified: When the data last changed.
+        :type last_modified: :class:`datetime.datetime`
+        '''
+        changed = tag != self.tag
+        self.tag = tag
+        self.last_modified = last_modified
+
+        if changed:
+            log.info('Data generation is now {}'.format(tag))
+            for listener in self._listeners:
+                listener()
+
+    @gen.coroutine
+    def refresh(self):
+        '''
+        Check for a new generation, from the updates database if ``updates_db`` is set or else from
+        Solr.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        If the generation cannot be determined, a message is logged and the previous generation is
+        kept.
+        '''
+        try:
+            if options.updates_db:
+                tag, last_modified = ask_updates_db(options.updates_db)
+            else:
+                tag, last_modified = yield ask_solr()
+        except (pysolrtornado.SolrError, sqlite3.Error, KeyError, TypeError, ValueError) as err:
+            log.warn(_CHECK_FAILED.format(err))
+            return
+
+        self.update(tag, last_modified)
+
+
+CURRENT = Generation()
+'''
+The process-wide :class:`Generation`.
+'''
+
+
+def ask_updates_db(db_path):
+    '''
+    Find the data generation in a Holy Orders updates database.
+
+    :param str db_path: The pathname of the updates database.
+    :returns: The generation tag and the most recent update time.
+    :rtype: 2-tuple of str and :class:`datetime.datetime`
+    :raises: :exc:`sqlite3.Error` when the database cannot be read.
+    :raises: :exc:`iso8601.ParseError` (a subclass of :exc:`ValueError`) when a time is invalid.
+    '''
+    conn = sqlite3.connect('file:{}?mode=ro'.format(db_path), uri=True)
+    try:
+        rows = conn.execute('SELECT updated FROM rtypes;').fetchall()
+    finally:
+        conn.close()
+
+    updates = [iso8601.parse_date(row[0]) for row in rows if row[0] != 'never']
+    if updates:
+        latest = max(updates)
+    else:
+        latest = datetime.datetime.fromtimestamp(0.0, datetime.timezone.utc)
+
+    return latest.isoformat(), latest
+
+
+@gen.coroutine
+def ask_solr():
+    '''
+    Find the data generation from Solr's index version.
+
+    .. note:: This function is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+    :returns: The generation tag and the time the index was last modified.
+    :rtype: 2-tuple of str and :class:`datetime.datetime`
+    :raises: :exc:`pysolrtornado.SolrError` when Solr cannot be reached.
+    :raises: :exc:`KeyError` or :exc:`ValueError` when Solr's response is not as expected.
+    '''
+    resp = yield util.SOLR._send_request('get', _LUKE_PATH)  # pylint: disable=protected-access
+    index = escape.json_decode(resp)['index']
+    return str(index['version']), iso8601.parse_date(index['lastModified'])
+
+
+def start_refreshing():  # pragma: no cover
+    '''
+    Find the :const:`CURRENT` generation as soon as the IOLoop starts, then check it again every
+    ``generation_refresh`` seconds. Nothing happens if ``generation_refresh`` is ``0``.
+
+    :returns: The :class:`PeriodicCallback` that checks the generation, or ``None``.
+    '''
+    if options.generation_refresh <= 0:
+        return None
+
+    ioloop.IOLoop.current().spawn_callback(CURRENT.refresh)
+    refresher = ioloop.PeriodicCallback(CURRENT.refresh, options.generation_refresh * 1000)
+    refresher.start()
+    return refresher
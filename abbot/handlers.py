@@ -27,6 +27,7 @@ Miscellaneous handlers for the Abbot server.
 '''
 
 from tornado import options, web
+from abbot import serialize
 from abbot.simple_handler import SimpleHandler
 
 
@@ -38,6 +39,15 @@ class RootHandler(web.RequestHandler):
     _ALLOWED_METHODS = 'GET, OPTIONS'
     # value of the "Allow" header in response to an OPTIONS request
 
+    def initialize(self, document=None):  # pylint: disable=arguments-differ
+        '''
+        :param document: The serialized response body for a GET request, made by
+            :func:`abbot.__main__.compile_routes` when Abbot starts. If it's omitted, the response
+            body is made by :meth:`prepare_get` for every request.
+        :type document: :class:`abbot.serialize.Raw`
+        '''
+        self.document = document
+
     def set_default_headers(self):
         '''
         Use :meth:`SimpleHandler.set_default_headers` to set the default headers.
@@ -54,33 +64,7 @@ class RootHandler(web.RequestHandler):
         '''
         Does the actual work for a GET request at '/'. It's a different method for easier testing.
         '''
-
-        # this ends with a / so we'll have to remove that
-        server_name = options.options.server_name[:-1]
-
-        all_plural_resources = [
-            'centuries',
-            'chants',
-            'feasts',
-            'genres',
-            'indexers',
-            'notations',
-            'offices',
-            'portfolia',
-            'provenances',
-            'sigla',
-            'segments',
-            'sources',
-            'source_statii'
-            ]
-        post = {'browse': {}, 'view': {}}
-        for resource_type in all_plural_resources:
-            this_url = '{name}{url}/'.format(name=server_name,
-                                            url=self.reverse_url('view_{}'.format(resource_type), 'id'))
-            post['view'][resource_type] = this_url
-            post['browse'][resource_type] = this_url[:-4]
-        post['browse']['all'] = '{name}{url}'.format(name=server_name, url=self.reverse_url('browse_all'))
-        return {'resources': post}
+        return make_root_document(self.reverse_url)
 
     def get(self):  # pylint: disable=arguments-differ
         '''
@@ -88,7 +72,11 @@ class RootHandler(web.RequestHandler):
         search and browse URLs.
         '''
         self.add_header('X-Cantus-Include-Resources', 'true')
-        self.write(self.prepare_get())
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if self.document is None:
+            self.write(serialize.encode(self.prepare_get()))
+        else:
+            self.write(self.document)
 
     def options(self):  # pylint: disable=arguments-differ
         '''
@@ -97,6 +85,46 @@ class RootHandler(web.RequestHandler):
         self.add_header('Allow', RootHandler._ALLOWED_METHODS)
 
 
+def make_root_document(reverse_url):
+    '''
+    Make the response body for a GET request to the root URL.
+
+    :param reverse_url: A function like :meth:`tornado.web.RequestHandler.reverse_url`, which takes
+        the name of a URL and its arguments, and returns its path.
+    :type reverse_url: function
+    :returns: The response body, with a "resources" member that has URLs to all the "browse" and
+        "view" URLs.
+    :rtype: dict
+    '''
+
+    # this ends with a / so we'll have to remove that
+    server_name = options.options.server_name[:-1]
+
+    all_plural_resources = [
+        'centuries',
+        'chants',
+        'feasts',
+        'genres',
+        'indexers',
+        'notations',
+        'offices',
+        'portfolia',
+        'provenances',
+        'sigla',
+        'segments',
+        'sources',
+        'source_statii'
+        ]
+    post = {'browse': {}, 'view': {}}
+    for resource_type in all_plural_resources:
+        this_url = '{name}{url}/'.format(name=server_name,
+                                        url=reverse_url('view_{}'.format(resource_type), 'id'))
+        post['view'][resource_type] = this_url
+        post['browse'][resource_type] = this_url[:-4]
+    post['browse']['all'] = '{name}{url}'.format(name=server_name, url=reverse_url('browse_all'))
+    return {'resources': post}
+
+
 class CanonicalHandler(web.RequestHandler):
     '''
     For requests that don't end with a slash, this handler sends a redirect response to the same
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/limiter.py
+# Purpose:                Adaptive limit on the number of concurrent Solr queries.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Adaptive limit on the number of concurrent Solr queries.
+
+When Solr slows down, sending it more queries at once only makes it slower. :class:`AdaptiveLimiter`
+watches how long Solr takes to answer, and changes the number of queries allowed in flight with
+"additive increase, multiplicative decrease" (AIMD), as TCP does for its congestion window:
+
+- when the recent latency is more than "tolerance" times the usual latency, a query shrinks the
+  limit by the "backoff" factor, at most once for all the queries that were started before the
+  last decrease;
+- otherwise, while at least half the limit is used, every query grows the limit by ``1 / limit``,
+  so the limit grows by about one for every full round of queries.
+
+Both latencies are kept separately for every kind of query (the "caller" label of
+:func:`abbot.util.search_solr`), since a full-text search is always much slower than a lookup by
+ID. The recent latency is a moving average over about ``1 / smoothing`` queries, so a healthy mix
+of fast and slow queries of one kind does not look like Solr slowing down. The usual latency is a
+much slower moving average, over about "window" queries, so it follows lasting changes in Solr.
+
+Queries beyond the limit wait in a queue. When the queue is full, :meth:`AdaptiveLimiter.acquire`
+raises :exc:`QueueFull` at once, so the request can be refused rather than pile onto Solr.
+'''
+
+import collections
+import time
+
+from tornado import concurrent, gen
+from tornado.options import options
+
+
+options.define('solr_adaptive_limit', type=bool, default=True,
+               help='whether to adapt the number of concurrent Solr queries to how quickly Solr '
+                    'answers, refusing requests when too many are waiting')
+options.define('solr_queue_size', type=int, default=100,
+               help='maximum number of Solr queries waiting for the adaptive limit, per worker '
+                    'process; requests beyond this are refused with 503')
+options.define('solr_latency_tolerance', type=float, default=2.0,
+               help='how many times slower than usual Solr may answer before the adaptive limit '
+                    'shrinks')
+
+
+# error message for QueueFull
+_QUEUE_FULL = 'There are already {} Solr queries waiting'
+
+
+class QueueFull(Exception):
+    '''
+    Raised by :meth:`AdaptiveLimiter.acquire` when the queue is full.
+    '''
+
+    pass
+
+
+class AdaptiveLimiter(object):
+    '''
+    Limit the number of concurrent Solr queries, adapting the limit to the latency of Solr.
+
+    **Example**
+
+    >>> @gen.coroutine
+    ... def query():
+    ...     yield limiter.acquire()
+    ...     started = time.monotonic()
+    ...     try:
+    ...         return (yield solr.search('*:*'))
+    ...     finally:
+    ...         limiter.release(started)
+    '''
+
+    def __init__(self, max_limit, min_limit=1, queue_size=100, tolerance=2.0, backoff=0.9,
+                 window=100, smoothing=0.05):
+        '''
+        :param int max_limit: The largest limit, which is also the first limit.
+        :param int min_limit: The smallest limit.
+        :param int queue_size: The maximum number of queries that wait for the limit.
+        :param float tolerance: How many times the usual latency the recent latency may be before
+            the limit shrinks.
+        :param float backoff: The factor by which the limit shrinks, between 0 and 1.
+        :param int window: About how many queries of one kind the usual latency averages.
+        :param float smoothing: The weight of every new query in the recent latency, between 0 and
+            1. Larger values react to Solr slowing down sooner, but also to a few slow queries.
+        '''
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(max_limit)
+        self.queue_size = queue_size
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.window = window
+        self.smoothing = smoothing
+
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters = collections.deque()
+        self._recent = {}  # for every kind of query, the recent latency
+        self._usual = {}  # for every kind of query, the usual latency
+        self._counts = {}  # for every kind of query, the number of queries in the averages
+        self._last_decrease = float('-inf')
+
+    @property
+    def queued(self):
+        "The number of queries waiting for the limit."
+        return len(self._waiters)
+
+    @gen.coroutine
+    def acquire(self, deadline=None):
+        '''
+        Wait until another query may start. You must call :meth:`release` once for every call that
+        does not raise.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        :param float deadline: The time, from :meth:`IOLoop.time`, after which to stop waiting.
+            The default, ``None``, waits as long as it takes.
+        :raises: :exc:`QueueFull` when the query would have to wait, but the queue is full.
+        :raises: :exc:`tornado.gen.TimeoutError` when the ``deadline`` passes first.
+        '''
+        if not self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return
+
+        if len(self._waiters) >= self.queue_size:
+            self.rejected += 1
+            raise QueueFull(_QUEUE_FULL.format(len(self._waiters)))
+
+        waiter = concurrent.Future()
+        self._waiters.append(waiter)
+        if deadline is None:
+            yield waiter
+            return
+
+        try:
+            yield gen.with_timeout(deadline, waiter)
+        except gen.TimeoutError:
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                # the waiter was given a place after the deadline passed, so pass it on
+                self.release()
+            raise
+
+    def release(self, started=None, failed=False, kind=None):
+        '''
+        Finish a query, letting the next waiting query start.
+
+        :param float started: The :func:`time.monotonic` time when the query was sent to Solr. If
+            this is ``None``, the query was not sent, and the limit does not change.
+        :param bool failed: Whether the query failed. A failed query counts in the recent latency,
+            so a slow failure may shrink the limit, but not in the usual latency.
+        :param kind: The kind of query, whose latencies are kept apart from other kinds.
+        '''
+        if started is not None:
+            self._adapt(started, time.monotonic() - started, failed, kind)
+        self.in_flight -= 1
+        self._wake()
+
+    def _adapt(self, started, latency, failed, kind):
+        "Change the limit for a query with this ``latency``, as described in the module docstring."
+        if kind not in self._usual:
+            if failed:
+                return
+            self._recent[kind] = self._usual[kind] = latency
+            self._counts[kind] = 1
+        else:
+            # until there are enough queries of this kind, both averages are the plain mean
+            count = self._counts[kind] = self._counts[kind] + 1
+            self._recent[kind] += (latency - self._recent[kind]) * max(self.smoothing, 1.0 / count)
+            if not failed:
+                self._usual[kind] += (latency - self._usual[kind]) / min(self.window, count)
+
+        if self._recent[kind] > self._usual[kind] * self.tolerance:
+            if started > self._last_decrease:
+                self.limit = max(float(self.min_limit), self.limit * self.backoff)
+                self._last_decrease = time.monotonic()
+        elif self.in_flight * 2 >= self.limit:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def _wake(self):
+        "Start as many waiting queries as the limit allows."
+        while self._waiters and self.in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def stats(self):
+        '''
+        Describe the limit and the queries using it.
+
+        :returns: A dictionary with these keys:
+
+            - "limit": the number of queries currently allowed in flight;
+            - "in_flight": the number of queries in flight;
+            - "queued": the number of queries waiting for the limit; and
+            - "rejected": the number of queries refused because the queue was full.
+        :rtype: dict
+        '''
+        return {'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'rejected': self.rejected,
+               }
+
+
+def from_options():
+    '''
+    Make an :class:`AdaptiveLimiter` with the "solr_*" options. The largest limit is the
+    "solr_max_clients" option, since more queries than that wait for a connection anyway.
+
+    :returns: The new limiter, or ``None`` if the "solr_adaptive_limit" option is ``False``.
+    :rtype: :class:`AdaptiveLimiter`
+    '''
+    if not options.solr_adaptive_limit:
+        return None
+    return AdaptiveLimiter(options.solr_max_clients,
+                           queue_size=options.solr_queue_size,
+                           tolerance=options.solr_latency_tolerance)
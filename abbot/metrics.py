@@ -0,0 +1,438 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/metrics.py
+# Purpose:                Prometheus-compatible metrics for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Prometheus-compatible metrics for the Abbot server.
+
+When the "metrics_port" option is set, every worker process serves its metrics at ``/metrics`` on a
+separate "admin" port, in the Prometheus text format, so they are not part of the public Cantus
+API. With several worker processes, the worker with task ID ``n`` uses ``metrics_port + n``.
+
+The metrics are:
+
+- ``abbot_http_requests_total`` and ``abbot_http_request_duration_seconds``, for every request,
+  by route, method, and (for the count) status code, recorded by :func:`log_request`;
+- ``abbot_http_requests_in_flight``, by route, for the requests to a
+  :class:`~abbot.simple_handler.SimpleHandler` that haven't finished;
+- ``abbot_stage_duration_seconds``, by the stages of
+  :meth:`~abbot.simple_handler.SimpleHandler.timing`, which are also in the "Server-Timing" header;
+- ``abbot_solr_request_duration_seconds`` and ``abbot_solr_errors_total``, by the function that
+  called :func:`abbot.util.search_solr`, and ``abbot_solr_shared_total`` for the calls that shared
+  a request already in flight instead of asking Solr again;
+- ``abbot_solr_in_flight``, ``abbot_solr_queued``, and ``abbot_solr_max_clients``, from
+  :meth:`abbot.solr_client.SolrClient.stats`;
+- ``abbot_solr_concurrency_limit``, ``abbot_solr_limit_queued``, and ``abbot_solr_rejected_total``,
+  from :meth:`abbot.limiter.AdaptiveLimiter.stats`; and
+- ``abbot_cache_hits_total``, ``abbot_cache_misses_total``, ``abbot_cache_hit_ratio``,
+  ``abbot_cache_entries``, and ``abbot_cache_size``, for every cache given to :func:`watch_cache`.
+
+The metric classes here are a small subset of the official "prometheus_client" library, which is
+not required.
+'''
+
+import math
+
+from tornado import web
+from tornado.log import access_log
+from tornado.options import options
+
+
+options.define('metrics_port', type=int, default=0,
+               help='port on which to serve Prometheus metrics at /metrics (0 to disable)')
+options.define('metrics_address', type=str, default='127.0.0.1',
+               help='address on which to serve Prometheus metrics')
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+'''
+The upper bounds, in seconds, of the :class:`Histogram` buckets. These are the defaults of the
+official Prometheus client libraries.
+'''
+
+_METRICS = []
+# every metric, in the order they were made, for render()
+
+_COLLECTORS = []
+# functions called by render() to update metrics kept elsewhere
+
+_CACHES = []
+# (name, LRUCache) for every cache given to watch_cache()
+
+
+def _format_value(value):
+    "Format a sample value as Prometheus expects."
+    if isinstance(value, int):
+        return str(value)
+    elif math.isnan(value):
+        return 'NaN'
+    elif math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    else:
+        return repr(float(value))
+
+
+def _format_labels(names, values):
+    "Format label names and values like ``{route=\"chants\",method=\"GET\"}``."
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter(object):
+    '''
+    A count that only goes up, like the number of requests, with one value for every combination
+    of label values.
+
+    **Example**
+
+    >>> requests = Counter('requests_total', 'Number of requests.', ('method',))
+    >>> requests.inc('GET')
+    >>> requests.get('GET')
+    1
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        '''
+        :param str name: The name of the metric.
+        :param str documentation: A description of the metric.
+        :param labelnames: The names of the labels, in the order their values are given.
+        :type labelnames: tuple of str
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _METRICS.append(self)
+
+    def inc(self, *labelvalues, amount=1):
+        '''
+        Add to the value for some label values.
+
+        :param labelvalues: The value of every label, in order.
+        :param amount: The amount to add.
+        :type amount: int or float
+        '''
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def set(self, value, *labelvalues):
+        '''
+        Replace the value for some label values. For a :class:`Counter`, this is only for counts
+        that are kept elsewhere, like :attr:`abbot.cache.LRUCache.hits`.
+
+        :param value: The new value.
+        :type value: int or float
+        :param labelvalues: The value of every label, in order.
+        '''
+        self._values[labelvalues] = value
+
+    def get(self, *labelvalues):
+        '''
+        :param labelvalues: The value of every label, in order.
+        :returns: The value for those label values, or ``0`` if there is none yet.
+        :rtype: int or float
+        '''
+        return self._values.get(labelvalues, 0)
+
+    def clear(self):
+        "Remove every value."
+        self._values.clear()
+
+    def samples(self):
+        '''
+        :returns: Every line of this metric in the Prometheus text format, without the comments.
+        :rtype: list of str
+        '''
+        return ['{}{} {}'.format(self.name, _format_labels(self.labelnames, labelvalues),
+                                 _format_value(value))
+                for labelvalues, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down, like the number of requests in flight.
+    '''
+
+    kind = 'gauge'
+
+    def dec(self, *labelvalues, amount=1):
+        '''
+        Subtract from the value for some label values.
+
+        :param labelvalues: The value of every label, in order.
+        :param amount: The amount to subtract.
+        :type amount: int or float
+        '''
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Counter):
+    '''
+    The distribution of a value, like the duration of requests, counted in buckets. Each bucket
+    counts the observations less than or equal to its upper bound, and there are also the number
+    and the sum of the observations.
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        '''
+        :param str name: As for :class:`Counter`.
+        :param str documentation: As for :class:`Counter`.
+        :param labelnames: As for :class:`Counter`.
+        :param buckets: The upper bound of every bucket, in increasing order. There is always a
+            final bucket for infinity.
+        :type buckets: tuple of float
+        '''
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def inc(self, *labelvalues, amount=1):
+        raise TypeError('use observe() for a Histogram')
+
+    def set(self, value, *labelvalues):
+        raise TypeError('use observe() for a Histogram')
+
+    def observe(self, value, *labelvalues):
+        '''
+        Count an observation.
+
+        :param value: The observed value.
+        :type value: int or float
+        :param labelvalues: The value of every label, in order.
+        '''
+        if labelvalues not in self._values:
+            # the count in every bucket, the sum, and the count
+            self._values[labelvalues] = [[0] * len(self.buckets), 0.0, 0]
+        counts = self._values[labelvalues]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[0][i] += 1
+                break
+        counts[1] += value
+        counts[2] += 1
+
+    def get(self, *labelvalues):
+        '''
+        :param labelvalues: The value of every label, in order.
+        :returns: The number of observations for those label values.
+        :rtype: int
+        '''
+        return self._values[labelvalues][2] if labelvalues in self._values else 0
+
+    def samples(self):
+        '''
+        :returns: As for :meth:`Counter.samples`.
+        :rtype: list of str
+        '''
+        post = []
+        bucket_labels = self.labelnames + ('le',)
+        for labelvalues, (bucket_counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(bucket_labels, labelvalues + (_format_value(bound),))
+                post.append('{}_bucket{} {}'.format(self.name, labels, cumulative))
+            labels = _format_labels(bucket_labels, labelvalues + ('+Inf',))
+            post.append('{}_bucket{} {}'.format(self.name, labels, count))
+            labels = _format_labels(self.labelnames, labelvalues)
+            post.append('{}_sum{} {}'.format(self.name, labels, _format_value(total)))
+            post.append('{}_count{} {}'.format(self.name, labels, count))
+        return post
+
+
+HTTP_REQUESTS = Counter('abbot_http_requests_total', 'Number of HTTP requests answered.',
+                        ('route', 'method', 'status'))
+HTTP_DURATION = Histogram('abbot_http_request_duration_seconds',
+                          'Time taken to answer HTTP requests.', ('route', 'method'))
+HTTP_IN_FLIGHT = Gauge('abbot_http_requests_in_flight',
+                       'Number of HTTP requests being answered.', ('route',))
+
+STAGE_DURATION = Histogram('abbot_stage_duration_seconds',
+                           'Time taken by each stage of answering a request.', ('stage',))
+
+SOLR_DURATION = Histogram('abbot_solr_request_duration_seconds',
+                          'Time taken by Solr to answer queries.', ('caller',))
+SOLR_ERRORS = Counter('abbot_solr_errors_total', 'Number of Solr queries that failed.', ('caller',))
+SOLR_SHARED = Counter('abbot_solr_shared_total',
+                      'Number of queries that shared an identical Solr query already in flight.',
+                      ('caller',))
+SOLR_IN_FLIGHT = Gauge('abbot_solr_in_flight',
+                       'Number of Solr requests started but not finished, including queued ones.')
+SOLR_QUEUED = Gauge('abbot_solr_queued', 'Number of Solr requests waiting for a connection.')
+SOLR_MAX_CLIENTS = Gauge('abbot_solr_max_clients',
+                         'Maximum number of simultaneous connections to Solr.')
+SOLR_LIMIT = Gauge('abbot_solr_concurrency_limit',
+                   'Number of Solr queries currently allowed in flight by the adaptive limit.')
+SOLR_LIMIT_QUEUED = Gauge('abbot_solr_limit_queued',
+                          'Number of Solr queries waiting for the adaptive limit.')
+SOLR_REJECTED = Counter('abbot_solr_rejected_total',
+                        'Number of Solr queries refused because too many were waiting.')
+
+CACHE_HITS = Counter('abbot_cache_hits_total', 'Number of cache lookups that found a value.',
+                     ('cache',))
+CACHE_MISSES = Counter('abbot_cache_misses_total', 'Number of cache lookups that found no value.',
+                       ('cache',))
+CACHE_HIT_RATIO = Gauge('abbot_cache_hit_ratio', 'Proportion of cache lookups that found a value.',
+                        ('cache',))
+CACHE_ENTRIES = Gauge('abbot_cache_entries', 'Number of entries in the cache.', ('cache',))
+CACHE_SIZE = Gauge('abbot_cache_size', 'Total size of the entries in the cache.', ('cache',))
+
+
+def add_collector(collector):
+    '''
+    Call a function every time the metrics are rendered, so it can update metrics that are kept
+    elsewhere (with :meth:`Counter.set`, for example).
+
+    :param collector: A function that takes no arguments.
+    :type collector: function
+    '''
+    _COLLECTORS.append(collector)
+
+
+def watch_cache(name, lru_cache):
+    '''
+    Report the hits, misses, and size of a cache.
+
+    :param str name: The value of the "cache" label.
+    :param lru_cache: The cache.
+    :type lru_cache: :class:`abbot.cache.LRUCache`
+    '''
+    _CACHES.append((name, lru_cache))
+
+
+def _collect_caches():
+    "Update the cache metrics from the caches given to :func:`watch_cache`."
+    for name, lru_cache in _CACHES:
+        lookups = lru_cache.hits + lru_cache.misses
+        CACHE_HITS.set(lru_cache.hits, name)
+        CACHE_MISSES.set(lru_cache.misses, name)
+        CACHE_HIT_RATIO.set(lru_cache.hits / lookups if lookups else float('nan'), name)
+        CACHE_ENTRIES.set(len(lru_cache), name)
+        CACHE_SIZE.set(lru_cache.currsize, name)
+
+
+add_collector(_collect_caches)
+
+
+def reset():
+    '''
+    Remove the values of every metric. The collectors and caches are still watched.
+    '''
+    for metric in _METRICS:
+        metric.clear()
+
+
+def render():
+    '''
+    Prepare every metric in the Prometheus text format.
+
+    :returns: The metrics.
+    :rtype: str
+    '''
+    for collector in _COLLECTORS:
+        collector()
+
+    post = []
+    for metric in _METRICS:
+        post.append('# HELP {} {}'.format(metric.name, metric.documentation))
+        post.append('# TYPE {} {}'.format(metric.name, metric.kind))
+        post.extend(metric.samples())
+    return '\n'.join(post) + '\n'
+
+
+def route_label(handler):
+    '''
+    Choose the "route" label for a request handler: the resource type for a
+    :class:`~abbot.simple_handler.SimpleHandler` (``'*'`` for the "browse" URL), otherwise the
+    name of the handler's class.
+
+    :param handler: The request handler.
+    :type handler: :class:`tornado.web.RequestHandler`
+    :returns: The label.
+    :rtype: str
+    '''
+    return getattr(handler, 'type_name', None) or type(handler).__name__
+
+
+def log_request(handler):
+    '''
+    Record the metrics of a finished request, then write the access log as Tornado does. This is
+    the "log_function" setting of the :class:`~tornado.web.Application`.
+
+    :param handler: The request handler that answered the request.
+    :type handler: :class:`tornado.web.RequestHandler`
+    '''
+    status = handler.get_status()
+    method = handler.request.method
+    request_time = handler.request.request_time()
+
+    route = route_label(handler)
+    HTTP_REQUESTS.inc(route, method, status)
+    HTTP_DURATION.observe(request_time, route, method)
+
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method('%d %s %.2fms', status, handler._request_summary(),  # pylint: disable=protected-access
+               1000.0 * request_time)
+
+
+class MetricsHandler(web.RequestHandler):
+    '''
+    Serve the metrics, on the admin port.
+    '''
+
+    def get(self):  # pylint: disable=arguments-differ
+        "Write the output of :func:`render`."
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(render())
+
+
+def listen(task_id=None):
+    '''
+    Serve the metrics on the admin port, if the "metrics_port" option is set. Call this in every
+    worker process, after forking.
+
+    :param int task_id: The worker's task ID, from :func:`tornado.process.fork_processes`, or
+        ``None`` if there is only one process.
+    :returns: The server, or ``None`` if "metrics_port" is ``0``.
+    :rtype: :class:`tornado.httpserver.HTTPServer`
+    '''
+    if options.metrics_port <= 0:
+        return None
+
+    port = options.metrics_port + (task_id or 0)
+    app = web.Application([(r'/metrics', MetricsHandler)], log_function=lambda handler: None)
+    return app.listen(port, address=options.metrics_address)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/query_parser.py
+# Purpose:                Parser for SEARCH queries.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Parser for SEARCH queries.
+
+This module accepts exactly the language of the grammar in :mod:`abbot.search_grammar`, but it is
+a hand-written recursive-descent parser that outputs the query components of
+:func:`abbot.util.parse_query` directly, without building a tree. It runs in time proportional to
+the length of the query, and it refuses queries longer than :const:`MAX_LENGTH` characters or with
+parentheses nested more than :const:`MAX_DEPTH` deep.
+
+Each parsing method corresponds to a rule in the grammar, and follows the same rules of "parsing
+expression grammars" that Parsimonious uses: alternatives are tried in order and the first match
+wins, and repetitions match as many times as possible without backtracking.
+'''
+
+import re
+
+
+MAX_LENGTH = 4096
+'''
+The longest query string that :func:`parse` accepts.
+'''
+
+MAX_DEPTH = 32
+'''
+The deepest nesting of parentheses that :func:`parse` accepts.
+'''
+
+_LETTERS = 'A-Za-z_.'
+_CHARACTERS = _LETTERS + '0-9áàäâéèëêíìïîóòöôúùüûÁÀÄÂÉÈËÊÍÌÏÎÓÒÖÔÚÙÜÛßÇç'
+# each of these matches zero or more of some characters
+_LETTERS_RUN = re.compile('[{}]*'.format(_LETTERS))
+_CHARACTERS_RUN = re.compile('[{}]*'.format(_CHARACTERS))
+_CHARACTERS_OR_SPACES_RUN = re.compile('[{} ]*'.format(_CHARACTERS))
+_SPACES_RUN = re.compile(' *')
+_QMARKS_RUN = re.compile(r'\?*')
+_BOOLEAN_SINGLETONS = ('!', '+', '-')
+_BOOLEAN_INFIXES = ('AND', 'OR', 'NOT', '&&', '||')
+
+_TOO_LONG = 'The query is longer than {} characters.'
+_TOO_DEEP = 'The query has parentheses nested more than {} deep.'
+_INVALID = 'The query is invalid at character {}.'
+
+
+def parse(query):
+    '''
+    Parse a SEARCH query string.
+
+    :param str query: The raw, user-submitted search query string.
+    :returns: The query components, as described in :func:`abbot.util.parse_query`.
+    :rtype: list of str and 2-tuple of str
+    :raises: :exc:`RuntimeError` when the query is invalid, too long, or too deeply nested.
+    '''
+    if len(query) > MAX_LENGTH:
+        raise RuntimeError(_TOO_LONG.format(MAX_LENGTH))
+
+    return _Parser(query).parse()
+
+
+class _Parser(object):
+    '''
+    Parse one query string. Every method takes a position in the string and returns either the
+    position after what it matched, or ``None`` if it did not match.
+    '''
+
+    def __init__(self, query):
+        self.query = query
+        self.length = len(query)
+        self.depth = 0
+
+    def parse(self):
+        "query = term_list"
+        post = []
+        end = self.term_list(0, post)
+        if end != self.length:
+            raise RuntimeError(_INVALID.format(end or 0))
+        return post
+
+    def run(self, pos, pattern):
+        "Match one of the compiled ``*_RUN`` patterns, which always matches."
+        return pattern.match(self.query, pos).end()
+
+    def wildcard(self, pos):
+        "wildcard = star / qmarks"
+        if self.query.startswith('*', pos):
+            return pos + 1
+        end = self.run(pos, _QMARKS_RUN)
+        return end if end > pos else None
+
+    def text(self, pos, characters):
+        '''
+        text = (characters? wildcard characters?) / characters
+
+        With ``_CHARACTERS_OR_SPACES_RUN`` as ``characters``, this is the part of "quoted_text"
+        between the quotes.
+        '''
+        chars_end = self.run(pos, characters)
+        wildcard_end = self.wildcard(chars_end)
+        if wildcard_end is not None:
+            return self.run(wildcard_end, characters)
+        elif chars_end > pos:
+            return chars_end
+        else:
+            return None
+
+    def quoted_text(self, pos):
+        "quoted_text = '\"' (text with spaces) '\"'"
+        if not self.query.startswith('"', pos):
+            return None
+        end = self.text(pos + 1, _CHARACTERS_OR_SPACES_RUN)
+        if end is None or not self.query.startswith('"', end):
+            return None
+        return end + 1
+
+    def boolean_infix(self, pos):
+        "boolean_infix = \"AND\" / \"OR\" / \"NOT\" / \"&&\" / \"||\""
+        for infix in _BOOLEAN_INFIXES:
+            if self.query.startswith(infix, pos):
+                return infix
+        return None
+
+    def field_value(self, pos):
+        '''
+        field_value = (!boolean_infix (quoted_text / text)) / grouped_term_list
+
+        :returns: The end position and, for a "grouped_term_list," the components inside the
+            parentheses (otherwise ``None``), or ``None`` if nothing matched.
+        '''
+        if self.boolean_infix(pos) is None:
+            end = self.quoted_text(pos)
+            if end is None:
+                end = self.text(pos, _CHARACTERS_RUN)
+            if end is not None:
+                return end, None
+
+        inner = []
+        end = self.grouped_term_list(pos, inner)
+        if end is not None:
+            return end, inner
+
+        return None
+
+    def grouped_term_list(self, pos, post):
+        "grouped_term_list = group_start term_list group_end"
+        if not self.query.startswith('(', pos):
+            return None
+
+        self.depth += 1
+        if self.depth > MAX_DEPTH:
+            raise RuntimeError(_TOO_DEEP.format(MAX_DEPTH))
+        end = self.term_list(pos + 1, post)
+        self.depth -= 1
+
+        if end is None or not self.query.startswith(')', end):
+            return None
+        return end + 1
+
+    def named_field(self, pos, post):
+        "named_field = field_name ':' field_value"
+        name_end = self.run(pos, _LETTERS_RUN)
+        if name_end == pos or not self.query.startswith(':', name_end):
+            return None
+
+        value = self.field_value(name_end + 1)
+        if value is None:
+            return None
+
+        end, inner = value
+        name = self.query[pos:name_end]
+        if inner is None:
+            post.append((name, self.query[name_end + 1:end]))
+        else:
+            post.append((name, ''))
+            post.append('(')
+            post.extend(inner)
+            post.append(')')
+        return end
+
+    def default_field(self, pos, post):
+        "default_field = field_value"
+        value = self.field_value(pos)
+        if value is None:
+            return None
+
+        end, inner = value
+        if inner is None:
+            post.append(('default', self.query[pos:end]))
+        else:
+            post.append('(')
+            post.extend(inner)
+            post.append(')')
+        return end
+
+    def term(self, pos, post):
+        '''
+        term = (boolean_singleton? (named_field / default_field)) / grouped_term_list
+
+        The second alternative never matches when the first does not, since a "default_field" may
+        be a "grouped_term_list," so it is not tried.
+        '''
+        before = len(post)
+
+        if pos < self.length and self.query[pos] in _BOOLEAN_SINGLETONS:
+            post.append(self.query[pos])
+            pos += 1
+
+        end = self.named_field(pos, post)
+        if end is None:
+            end = self.default_field(pos, post)
+        if end is None:
+            del post[before:]
+        return end
+
+    def term_list(self, pos, post):
+        "term_list = (space* term) ((space+ boolean_infix)* space+ term)*"
+        pos = self.term(self.run(pos, _SPACES_RUN), post)
+        if pos is None:
+            return None
+
+        while True:
+            before = len(post)
+            following = pos
+
+            # (space+ boolean_infix)*
+            while True:
+                spaces_end = self.run(following, _SPACES_RUN)
+                infix = self.boolean_infix(spaces_end) if spaces_end > following else None
+                if infix is None:
+                    break
+                post.append(infix)
+                following = spaces_end + len(infix)
+
+            # space+ term
+            spaces_end = self.run(following, _SPACES_RUN)
+            end = self.term(spaces_end, post) if spaces_end > following else None
+            if end is None:
+                del post[before:]
+                return pos
+
+            pos = end
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/serialize.py
+# Purpose:                JSON serialization of response bodies for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+JSON serialization of response bodies for the Abbot server.
+
+:func:`encode` uses the fastest JSON encoder that is installed: "orjson," then "python-rapidjson,"
+then the :mod:`json` module of the standard library, which is what Tornado uses. Neither of the
+first two is required. The encoders differ in whitespace and in whether non-ASCII characters are
+escaped, but every encoder produces the same value when the JSON is decoded. Like Tornado, every
+encoder escapes ``</`` as ``<\\/`` so a response body can be safely embedded in HTML.
+
+If an encoder cannot serialize a value (for example an integer too large for "orjson") the standard
+library encoder is used for that value instead.
+
+:func:`encode_async` may serialize large response bodies on a thread rather than on the event loop.
+
+Parts of a response that were already serialized, like the resources held in
+:const:`abbot.simple_handler.FRAGMENT_CACHE`, are given as :class:`Raw` values so they are copied
+into the response body rather than serialized again.
+'''
+
+from concurrent import futures
+import json
+
+from tornado import gen
+from tornado.log import app_log as log
+from tornado.options import options
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+
+_UNKNOWN_ENCODER = 'The "{}" JSON encoder is not available; using "{}".'
+
+
+class Raw(bytes):
+    '''
+    UTF-8 encoded JSON that was already serialized by :func:`encode`. When a dictionary given to
+    :func:`encode` has :class:`Raw` values, they are spliced into the output as they are.
+    '''
+
+
+def _encode_stdlib(obj):
+    "Serialize with the standard library, exactly as :func:`tornado.escape.json_encode` does."
+    return json.dumps(obj).replace('</', '<\\/').encode('utf-8')
+
+
+def _encode_orjson(obj):
+    "Serialize with orjson."
+    return orjson.dumps(obj).replace(b'</', b'<\\/')
+
+
+def _encode_rapidjson(obj):
+    "Serialize with python-rapidjson."
+    return rapidjson.dumps(obj, ensure_ascii=False).replace('</', '<\\/').encode('utf-8')
+
+
+ENCODERS = {'stdlib': _encode_stdlib}
+'''
+The available JSON encoders, keyed on their name. Every encoder takes a JSON-compatible object and
+returns the UTF-8 encoded JSON as :class:`bytes`.
+'''
+if rapidjson is not None:
+    ENCODERS['rapidjson'] = _encode_rapidjson
+if orjson is not None:
+    ENCODERS['orjson'] = _encode_orjson
+
+_PREFERENCE = ('orjson', 'rapidjson', 'stdlib')
+# order in which the encoders are chosen for "auto"
+
+NAME = None
+'''
+The name of the encoder used by :func:`encode`. Set it with :func:`use_encoder`.
+'''
+
+_encoder = None
+_executor = None
+
+
+def use_encoder(name):
+    '''
+    Choose the encoder used by :func:`encode`.
+
+    :param str name: One of the keys in :const:`ENCODERS`, or ``'auto'`` for the fastest one. If
+        the encoder is not installed, a warning is logged and the fastest one is used.
+    '''
+    global NAME, _encoder  # pylint: disable=global-statement
+
+    auto = next(each for each in _PREFERENCE if each in ENCODERS)
+    if name == 'auto':
+        name = auto
+    elif name not in ENCODERS:
+        log.warn(_UNKNOWN_ENCODER.format(name, auto))
+        name = auto
+
+    NAME = name
+    _encoder = ENCODERS[name]
+
+
+options.define('json_encoder', type=str, default='auto', callback=use_encoder,
+               help='JSON encoder for response bodies: "auto," "orjson," "rapidjson," or "stdlib"')
+options.define('json_executor_threshold', type=int, default=0,
+               help=('serialize response bodies with at least this many top-level members on a '
+                     'thread rather than the event loop (0 to disable)'))
+
+use_encoder(options.json_encoder)
+
+
+def encode(obj):
+    '''
+    Serialize an object as JSON.
+
+    :param obj: The object to serialize. It must be JSON-compatible.
+    :returns: The UTF-8 encoded JSON.
+    :rtype: bytes
+    :raises: :exc:`TypeError` when ``obj`` is not JSON-compatible.
+
+    If ``obj`` is a dictionary with :class:`Raw` values, the output is put together from those
+    values and the other members, which are serialized separately (so dictionary values holding
+    :class:`Raw` values are spliced too).
+    '''
+    if isinstance(obj, dict) and any(isinstance(value, Raw) for value in obj.values()):
+        return _splice(obj)
+
+    if _encoder is not _encode_stdlib:
+        try:
+            return _encoder(obj)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return _encode_stdlib(obj)
+
+
+def _splice(obj):
+    "Serialize a dictionary with :class:`Raw` values, for :func:`encode`."
+    members = []
+    for key, value in obj.items():
+        if not isinstance(value, Raw):
+            value = encode(value)
+        members.append(encode(key) + b':' + value)
+    return b'{' + b','.join(members) + b'}'
+
+
+@gen.coroutine
+def encode_async(obj):
+    '''
+    Serialize an object as JSON, on a thread if it has at least "json_executor_threshold" members.
+
+    .. note:: This function is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+    :param obj: The object to serialize. It must be JSON-compatible.
+    :returns: The UTF-8 encoded JSON.
+    :rtype: bytes
+    :raises: :exc:`TypeError` when ``obj`` is not JSON-compatible.
+
+    Since the encoders hold the GIL while they run, a thread does not make serialization faster.
+    It only lets the event loop answer other requests while a large body is serialized.
+    '''
+    global _executor  # pylint: disable=global-statement
+
+    threshold = options.json_executor_threshold
+    if threshold <= 0 or not hasattr(obj, '__len__') or len(obj) < threshold:
+        return encode(obj)
+
+    if _executor is None:
+        _executor = futures.ThreadPoolExecutor(max_workers=1)
+    return (yield _executor.submit(encode, obj))
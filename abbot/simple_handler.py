@@ -26,16 +26,29 @@
 SimpleHandler for the Abbot server.
 '''
 
-import copy
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from contextlib import contextmanager
+import datetime
+import email.utils
+import hashlib
+import itertools
+import math
+import re
+import time
 from urllib.parse import urljoin
 
 from tornado.log import app_log as log
-from tornado import escape, gen, web
+from tornado import escape, gen, ioloop, web
 from tornado.options import options
 import pysolrtornado
 
 import abbot
+from abbot import cache
+from abbot import export
+from abbot import generation
+from abbot import metrics
+from abbot import serialize
+from abbot import taxonomy
 from abbot import util
 
 
@@ -44,6 +57,136 @@ options.define('cors_allow_origin',
                help='String or list of strings, the permitted "Host" values for a CORS request.',
                type=str,
                default=None)
+options.define('response_cache_size', type=int, default=32 * 1024 * 1024,
+               help='maximum number of bytes of responses to cache (0 to disable)',
+               callback=lambda size: RESPONSE_CACHE.resize(maxsize=size))
+options.define('response_cache_ttl', type=int, default=300,
+               help='number of seconds a cached response stays valid',
+               callback=lambda ttl: RESPONSE_CACHE.resize(ttl=ttl))
+options.define('batch_view_limit', type=int, default=100,
+               help='maximum number of resource IDs in the "ids" member of a SEARCH request')
+options.define('fragment_cache_size', type=int, default=32 * 1024 * 1024,
+               help='maximum number of bytes of serialized resources to cache (0 to disable)',
+               callback=lambda size: FRAGMENT_CACHE.resize(maxsize=size))
+options.define('fragment_cache_ttl', type=int, default=3600,
+               help='number of seconds a cached serialized resource stays valid',
+               callback=lambda ttl: FRAGMENT_CACHE.resize(ttl=ttl))
+options.define('server_timing', type=bool, default=False,
+               help='whether to send a "Server-Timing" header with the time taken by each stage')
+options.define('request_deadline', type=float, default=0.0,
+               help='seconds a request may spend waiting for Solr, in total (0 for no limit)')
+options.define('solr_retry_after', type=int, default=1,
+               help='seconds in the "Retry-After" header of a 503 when Solr is overloaded')
+
+
+CachedResponse = namedtuple('CachedResponse', ['body', 'headers'])
+'''
+A response held in the :const:`RESPONSE_CACHE`. The "body" is the serialized response body and
+"headers" is a list of (name, value) 2-tuples with the Cantus response headers.
+'''
+
+
+def _sizeof_response(cached):
+    '''
+    The number of bytes (more or less) held by a :class:`CachedResponse`.
+    '''
+    return len(cached.body) + sum(len(name) + len(value) for name, value in cached.headers)
+
+
+RESPONSE_CACHE = cache.LRUCache(options.response_cache_size, options.response_cache_ttl,
+                                getsizeof=_sizeof_response)
+'''
+Process-wide cache of GET and SEARCH responses, keyed on the result of
+:meth:`SimpleHandler.make_cache_key`.
+'''
+generation.CURRENT.add_listener(RESPONSE_CACHE.clear)
+
+Fragment = namedtuple('Fragment', ['record', 'resources', 'fields'])
+'''
+A resource held in the :const:`FRAGMENT_CACHE`. The "record" is the serialized resource, as it
+appears in a response body, and "resources" is its serialized member of the "resources" block (or
+``None`` if the response had no "resources" block). Both are :class:`abbot.serialize.Raw`. The
+"fields" are the names of the fields that :meth:`SimpleHandler.format_record` counted for the
+X-Cantus-Fields and X-Cantus-Extra-Fields headers.
+'''
+
+
+def _sizeof_fragment(fragment):
+    '''
+    The number of bytes (more or less) held by a :class:`Fragment`.
+    '''
+    return len(fragment.record) + len(fragment.resources or b'')
+
+
+FRAGMENT_CACHE = cache.LRUCache(options.fragment_cache_size, options.fragment_cache_ttl,
+                                getsizeof=_sizeof_fragment)
+'''
+Process-wide cache of serialized resources, keyed on the result of
+:meth:`SimpleHandler.make_fragment_key`. When a resource is found here, :meth:`SimpleHandler.basic_get`
+uses it instead of formatting the resource from Solr, and :meth:`SimpleHandler.write_response`
+splices it into the response body instead of serializing it again.
+'''
+generation.CURRENT.add_listener(FRAGMENT_CACHE.clear)
+metrics.watch_cache('fragment', FRAGMENT_CACHE)
+generation.CURRENT.add_listener(util.SUBQUERY_CACHE.clear)  # util can't import "generation" itself
+
+Route = namedtuple('Route', ['type_name', 'type_name_plural', 'returned_fields',
+                             'returned_field_set', 'solr_fields', 'browse_options', 'view_options'])
+'''
+Metadata for one URL handled by a :class:`SimpleHandler`, made once by :func:`compile_route` and
+shared by every request to that URL. The "returned_fields" and "solr_fields" are tuples of field
+names, and "returned_field_set" is a frozenset of the "returned_fields". The "browse_options" and
+"view_options" are tuples of (name, value) 2-tuples with the headers of a response to an OPTIONS
+request on a "browse" or "view" URL.
+'''
+
+URL_TEMPLATES = {}
+'''
+Templates for the path of a resource's "view" URL, relative to the "server_name" option, keyed on
+both the singular and plural resource type (like ``'chants/{}'`` for ``'chant'`` and ``'chants'``).
+The resource ID and a terminating slash go in the ``{}``. These are set by
+:func:`abbot.__main__.compile_routes`; :meth:`SimpleHandler.make_resource_url` uses
+:meth:`~tornado.web.RequestHandler.reverse_url` for resource types that are missing.
+'''
+
+
+def compile_route(type_name, additional_fields=None):
+    '''
+    Make the :class:`Route` for a URL handled by a :class:`SimpleHandler`.
+
+    :param str type_name: As for :meth:`SimpleHandler.initialize`.
+    :param additional_fields: As for :meth:`SimpleHandler.initialize`.
+    :type additional_fields: list of str
+    :returns: The route's metadata.
+    :rtype: :class:`Route`
+    '''
+    returned_fields = list(SimpleHandler._DEFAULT_RETURNED_FIELDS)
+    if additional_fields:
+        returned_fields.extend(additional_fields)
+
+    solr_fields = []
+    for field in itertools.chain(returned_fields, ('id', 'type', 'drupal_path')):
+        if field not in solr_fields:
+            solr_fields.append(field)
+
+    browse_options = [('Allow', SimpleHandler._ALLOWED_BROWSE_METHODS)]
+    browse_options.extend((header, 'allow') for header in SimpleHandler._HEADERS_FOR_BROWSE)
+    view_options = [('Allow', SimpleHandler._ALLOWED_VIEW_METHODS)]
+    view_options.extend((header, 'allow') for header in SimpleHandler._HEADERS_FOR_VIEW)
+
+    return Route(type_name=type_name,
+                 type_name_plural=util.singular_resource_to_plural(type_name),
+                 returned_fields=tuple(returned_fields),
+                 returned_field_set=frozenset(returned_fields),
+                 solr_fields=tuple(solr_fields),
+                 browse_options=tuple(browse_options),
+                 view_options=tuple(view_options))
+
+
+_CACHED_RESPONSE_HEADERS = ('X-Cantus-Fields', 'X-Cantus-Extra-Fields', 'X-Cantus-Include-Resources',
+                            'X-Cantus-Total-Results', 'X-Cantus-Per-Page', 'X-Cantus-Page',
+                            'X-Cantus-Sort', 'X-Cantus-Cursor')
+# the headers set by make_response_headers(), which must be stored with a cached response
 
 
 # translatable strings
@@ -77,6 +220,12 @@ _INVALID_FIELDS = 'X-Cantus-Fields header has field name(s) invalid for this res
 _MISSING_SEARCH_BODY = 'Request body was malformed or missing'
 # when the Solr server has an error
 _SOLR_502_ERROR = 'Bad Gateway (Problem with Solr Server)'
+# when the request's deadline passes while waiting for Solr
+_DEADLINE_504_ERROR = 'Gateway Timeout (Solr did not answer before the deadline)'
+# when too many queries are already waiting for Solr
+_OVERLOADED_503_ERROR = 'Service Unavailable (too many requests are waiting for Solr)'
+# when the X-Cantus-Deadline value isn't a positive number of seconds
+_INVALID_DEADLINE = 'Invalid "X-Cantus-Deadline" header'
 # when there's a SEARCH request with a query that returns no results, and we've decided to give up
 _NO_SEARCH_RESULTS = 'SEARCH query returned no results'
 # when the search query itself is improperly formatted
@@ -89,6 +238,22 @@ _RESOURCE_MISSING_ID = 'Solr returned a resource without an "id" field.'
 _RESOURCE_MISSING_TYPE = 'Solr returned a resource without a "type" field.'
 # when the search query has a field that's not valid
 _INVALID_SEARCH_FIELD = 'Invalid search field: "{}"'
+# when the X-Cantus-Cursor header isn't a Solr cursor mark
+_INVALID_CURSOR = 'Invalid "X-Cantus-Cursor" header'
+# when there are both X-Cantus-Cursor and X-Cantus-Page headers
+_CURSOR_WITH_PAGE = '"X-Cantus-Cursor" cannot be used with "X-Cantus-Page"'
+# when the X-Cantus-Cursor header is after the last result
+_CURSOR_AT_END = '"X-Cantus-Cursor" is past the last result'
+
+# when the "ids" member of a SEARCH request isn't a list of IDs
+_INVALID_IDS = 'SEARCH "ids" must be a list of resource IDs'
+# when a SEARCH request has both "ids" and "query" members
+_QUERY_WITH_IDS = 'SEARCH request cannot have both "ids" and "query"'
+# when the "ids" member of a SEARCH request has too many IDs
+_TOO_MANY_IDS = 'SEARCH "ids" has too many resource IDs'
+
+_CURSOR_MARK = re.compile(r'\*|[A-Za-z0-9+/=]+')
+# what a valid X-Cantus-Cursor looks like: "*" to start, or a cursor mark returned by Solr
 
 
 class SimpleHandler(web.RequestHandler):
@@ -111,15 +276,14 @@ class SimpleHandler(web.RequestHandler):
     _ALLOWED_VIEW_METHODS = 'GET, HEAD, OPTIONS'
     # value of the "Allow" header in response to an OPTIONS request on a "view" URL
 
-    _DEFAULT_RETURNED_FIELDS = ['id', 'type', 'name', 'description']
-    # I realized there was no reason for the default list to be world-accessible, since it has to be
-    # deepcopied anyway, so we'll just do this!
+    _DEFAULT_RETURNED_FIELDS = ('id', 'type', 'name', 'description')
+    # the fields of every resource type; compile_route() adds the "additional_fields" of a URL
 
     _MAX_PER_PAGE = 100
     # the highest value allowed for X-Cantus-Per-Page; higher values will get a 507
 
     _HEADERS_FOR_BROWSE = ['X-Cantus-Include-Resources', 'X-Cantus-Fields', 'X-Cantus-Per-Page',
-                           'X-Cantus-Page', 'X-Cantus-Sort']
+                           'X-Cantus-Page', 'X-Cantus-Sort', 'X-Cantus-Cursor']
     # the Cantus extension headers that can sensibly be used with a "browse" URL
 
     _HEADERS_FOR_VIEW = ['X-Cantus-Include-Resources', 'X-Cantus-Fields']
@@ -139,12 +303,22 @@ class SimpleHandler(web.RequestHandler):
         self.type_name_plural = None  # set in initialize()
         self.head_request = False  # whether the method being processed is HEAD
         self.total_results = 0  # total number of records to be returned in the response
+        self.next_cursor = None  # X-Cantus-Cursor for the next page, set by basic_get()
+        self.use_fragments = True  # whether basic_get() may use the FRAGMENT_CACHE
+        self.record_fields = {}  # if use_fragments, the fields counted by format_record() for each resource
+        self.partial_records = set()  # IDs of resources that must not go in the FRAGMENT_CACHE
+        self.in_flight_route = None  # the "route" label counted in flight by prepare()
+        self.timings = OrderedDict()  # seconds taken by each stage of the request; see timing()
+        self.deadline = None  # IOLoop time by which Solr must answer; see set_deadline()
+        self.partial_response = False  # whether cross-references were left out after a Solr error
+        self.vary_accept = False  # whether the response format depends on "Accept"; see vary_on_accept()
 
         # This holds the names of the fields that are appropriate to return for a resource of this
-        # type. We start here with the standard field names, and initialize() will add more if
-        # required. We do a deep copy so that SimpleHandler._DEFAULT_RETURNED_FIELDS doesn't change
-        # through the running time of the program.
-        self.returned_fields = copy.deepcopy(SimpleHandler._DEFAULT_RETURNED_FIELDS)
+        # type. We start here with the standard field names, and initialize() replaces them with
+        # the fields of the route, which are shared by every request, so they must not be modified.
+        # Assign a new list to "self.returned_fields" instead.
+        self.route = None  # the Route for this URL, set in initialize()
+        self.returned_fields = SimpleHandler._DEFAULT_RETURNED_FIELDS
 
         # request headers/body params (these will hold the parsed and verified values)
         self.hparams = {  # "hparams" means "header parameters"
@@ -153,17 +327,25 @@ class SimpleHandler(web.RequestHandler):
             'include_resources': True,  # X-Cantus-Include-Resources
             'sort': None,               # X-Cantus-Sort
             'fields': None,             # X-Cantus-Fields
+            'cursor': None,             # X-Cantus-Cursor
+            'deadline': None,           # X-Cantus-Deadline
             'search_query': None,        # "query" parameter from SEARCH request body
+            'ids': None,                # "ids" parameter from SEARCH request body
             }
 
         super(SimpleHandler, self).__init__(*args, **kwargs)
 
-    def initialize(self, type_name, additional_fields=None):  # pylint: disable=arguments-differ
+    # pylint: disable=arguments-differ
+    def initialize(self, type_name, additional_fields=None, route=None):
         '''
         :param str type_name: The resource type handled by this instance of :class:`SimpleHandler`
             in singular form.
         :param additional_fields: Optional list of fields to append to ``self.returned_fields``.
         :type additional_fields: list of str
+        :param route: The metadata for this URL, made by :func:`abbot.__main__.compile_routes` when
+            Abbot starts. If it's omitted, the metadata are made from ``type_name`` and
+            ``additional_fields`` for this request.
+        :type route: :class:`Route`
 
         **Side Effect**
 
@@ -174,18 +356,22 @@ class SimpleHandler(web.RequestHandler):
         then you must stop processing, and in particular not call :meth:`write` or
         :meth:`send_error`, which will overwrite the existing error values set by this method.
         '''
-        self.type_name = type_name
-        self.type_name_plural = util.singular_resource_to_plural(type_name)
-
-        if additional_fields:
-            self.returned_fields.extend(additional_fields)
+        if route is None:
+            route = compile_route(type_name, additional_fields)
+        self.route = route
+        self.type_name = route.type_name
+        self.type_name_plural = route.type_name_plural
+        self._returned_fields = route.returned_fields
+        self._returned_field_set = route.returned_field_set
 
         # take settings from headers
         header_to_setting = (('X-Cantus-Per-Page', 'per_page'),
                              ('X-Cantus-Page', 'page'),
                              ('X-Cantus-Include-Resources', 'include_resources'),
                              ('X-Cantus-Sort', 'sort'),
-                             ('X-Cantus-Fields', 'fields')
+                             ('X-Cantus-Fields', 'fields'),
+                             ('X-Cantus-Cursor', 'cursor'),
+                             ('X-Cantus-Deadline', 'deadline'),
                             )
         self.hparams.update(util.do_dict_transfer(self.request.headers, header_to_setting))
 
@@ -205,10 +391,99 @@ class SimpleHandler(web.RequestHandler):
                                      ('page', 'page'),
                                      ('include_resources', 'include_resources'),
                                      ('sort', 'sort'),
-                                     ('fields', 'fields')
+                                     ('fields', 'fields'),
+                                     ('cursor', 'cursor'),
+                                     ('ids', 'ids')
                                     )
                 self.hparams.update(util.do_dict_transfer(body, member_to_setting))
 
+    @property
+    def returned_fields(self):
+        '''
+        The names of the fields to return, in order. Assigning a new sequence of field names also
+        updates :attr:`returned_field_set`.
+        '''
+        return self._returned_fields
+
+    @returned_fields.setter
+    def returned_fields(self, fields):
+        self._returned_fields = fields
+        self._returned_field_set = frozenset(fields)
+
+    @property
+    def returned_field_set(self):
+        '''
+        The names of the fields to return, as a frozenset for fast membership tests.
+        '''
+        return self._returned_field_set
+
+    def prepare(self):
+        '''
+        Count this request in the "abbot_http_requests_in_flight" metric until :meth:`on_finish`,
+        and start the "request_deadline" budget.
+        '''
+        self.in_flight_route = metrics.route_label(self)
+        metrics.HTTP_IN_FLIGHT.inc(self.in_flight_route)
+        if options.request_deadline > 0:
+            self.set_deadline(options.request_deadline)
+
+    def set_deadline(self, seconds):
+        '''
+        Set ``self.deadline`` to ``seconds`` after this request arrived, unless it is already sooner.
+
+        The deadline is given to every Solr query for this request, so the request waits no more
+        than ``seconds`` for Solr in total. When it passes, :meth:`get` and :meth:`search` return a
+        504 response, except during the cross-reference lookup; see
+        :meth:`~abbot.complex_handler.ComplexHandler.look_up_xrefs`.
+
+        :param float seconds: The budget for this request.
+        '''
+        deadline = ioloop.IOLoop.current().time() + seconds - self.request.request_time()
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+
+    def on_finish(self):
+        '''
+        Stop counting this request in the "abbot_http_requests_in_flight" metric, and add the
+        :attr:`timings` to the "abbot_stage_duration_seconds" metric.
+        '''
+        if self.in_flight_route is not None:
+            metrics.HTTP_IN_FLIGHT.dec(self.in_flight_route)
+            self.in_flight_route = None
+        for stage, seconds in self.timings.items():
+            metrics.STAGE_DURATION.observe(seconds, stage)
+
+    @contextmanager
+    def timing(self, stage):
+        '''
+        Add the time taken by the body of a ``with`` statement to :attr:`timings`. A stage that is
+        timed more than once (like "extra_fields," once for every resource) adds up.
+
+        :param str stage: The name of the stage: "parse," "subqueries," "solr," "xrefs,"
+            "extra_fields," or "encode."
+
+        **Example**
+
+        >>> with self.timing('solr'):
+        ...     resp = yield util.search_solr(query)
+        '''
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.monotonic() - started
+
+    def finish(self, chunk=None):
+        '''
+        Set the "Server-Timing" header from :attr:`timings`, if the "server_timing" option is set
+        and the headers were not already sent, then finish the response as usual.
+        '''
+        if options.server_timing and self.timings and not self._headers_written:
+            self.set_header('Server-Timing', ', '.join(
+                '{};dur={:.2f}'.format(stage, seconds * 1000.0)
+                for stage, seconds in self.timings.items()))
+        return super(SimpleHandler, self).finish(chunk)
+
     def set_default_headers(self):
         '''
         Set the default headers for all requests: Server, X-Cantus-Version.
@@ -313,9 +588,10 @@ class SimpleHandler(web.RequestHandler):
         post = {}
 
         drupal = options.drupal_url
+        returned_field_set = self._returned_field_set
 
         for key in iter(record):
-            if key in self.returned_fields:
+            if key in returned_field_set:
                 post[key] = record[key]
                 self.field_counts[key] += 1
             elif drupal and key == 'drupal_path':
@@ -323,6 +599,40 @@ class SimpleHandler(web.RequestHandler):
 
         return post
 
+    def solr_fields(self):
+        '''
+        List the fields to request from Solr: those in ``self.returned_fields``, plus the ones that
+        :meth:`basic_get` and :meth:`format_record` always need. Solr does not send the others.
+
+        :returns: The field names.
+        :rtype: list or tuple of str
+        '''
+        if self.route is not None and self._returned_fields is self.route.returned_fields:
+            return self.route.solr_fields
+
+        post = []
+        for field in itertools.chain(self.returned_fields, ('id', 'type', 'drupal_path')):
+            if field not in post:
+                post.append(field)
+        return post
+
+    def export_columns(self):
+        '''
+        List the fields of an NDJSON or CSV export, with the names they have in a response. For a
+        CSV export, these are the columns.
+
+        :returns: The field names.
+        :rtype: list of str
+        '''
+        post = []
+        for field in self.solr_fields():
+            if field == 'drupal_path' and not options.drupal_url:
+                continue
+            name = self._lookup_name_for_response(field)
+            if name not in post:
+                post.append(name)
+        return post
+
     def make_resource_url(self, resource_id, resource_type=None):
         '''
         Make a URL for the "resources" section of the response, with the indicated resource type
@@ -339,6 +649,12 @@ class SimpleHandler(web.RequestHandler):
         if resource_type is None:
             resource_type = self.type_name_plural
 
+        template = URL_TEMPLATES.get(resource_type)
+        if template is not None:
+            return '{server_name}{resource_path}'.format(
+                server_name=options.server_name,
+                resource_path=template.format(escape.url_escape(resource_id + '/', plus=False)))
+
         try:
             # hope it's a plural resource_type
             resource = 'view_{}'.format(resource_type)
@@ -395,29 +711,39 @@ class SimpleHandler(web.RequestHandler):
         elif resource_id.endswith('/') and len(resource_id) > 1:
             resource_id = resource_id[:-1]
 
-        # calculate the "start" argument for Solr
+        # calculate the "start" argument for Solr, or use the cursor instead
         start = None
-        if self.hparams['page']:
+        sort = self.hparams['sort']
+        cursor = self.hparams['cursor']
+        if cursor:
+            sort = util.make_cursor_sort(sort)
+        elif self.hparams['page']:
             start = (self.hparams['page'] - 1) * self.hparams['per_page']
 
         # run the query -----------------------------------
-        if query:
-            # SEARCH method
-            resp = yield util.search_solr(query, start=start, rows=self.hparams['per_page'],
-                                          sort=self.hparams['sort'])
-        else:
-            # "browse" and "view" URLs
-            try:
-                resp = yield util.ask_solr_by_id(self.type_name, resource_id, start=start,
-                                                 rows=self.hparams['per_page'], sort=self.hparams['sort'])
-            except ValueError:
-                # this means the Cantus ID was invalid
-                self.send_error(422, reason=_INVALID_ID)
-                return _NONE_ZERO
+        with self.timing('solr'):
+            if query:
+                # SEARCH method
+                resp = yield util.search_solr(query, start=start, rows=self.hparams['per_page'],
+                                              sort=sort, fields=self.solr_fields(), cursor=cursor,
+                                              caller='basic_get', deadline=self.deadline)
+            else:
+                # "browse" and "view" URLs
+                try:
+                    resp = yield taxonomy.ask_by_id(self.type_name, resource_id, start=start,
+                                                    rows=self.hparams['per_page'], sort=sort,
+                                                    fields=self.solr_fields(), cursor=cursor,
+                                                    caller='basic_get', deadline=self.deadline)
+                except ValueError:
+                    # this means the Cantus ID was invalid
+                    self.send_error(422, reason=_INVALID_ID)
+                    return _NONE_ZERO
 
         # format the query --------------------------------
         if resp.docs:
             post = {}
+            types = {}
+            fragments = {}
             for record in resp:
                 if 'id' not in record:
                     self.send_error(502, reason=_RESOURCE_MISSING_ID)
@@ -425,16 +751,41 @@ class SimpleHandler(web.RequestHandler):
                 elif 'type' not in record:
                     self.send_error(502, reason=_RESOURCE_MISSING_TYPE)
                     return _NONE_ZERO
-                else:
+
+                types[record['id']] = record['type']
+                fragment = None
+                if self.use_fragments:
+                    fragment = FRAGMENT_CACHE.get(self.make_fragment_key(record['id']))
+
+                if fragment is None:
                     post[record['id']] = self.format_record(record)
+                    if self.use_fragments:
+                        self.record_fields[record['id']] = [key for key in record if key in self._returned_field_set]
+                else:
+                    # cached resources are already formatted and serialized
+                    post[record['id']] = fragment.record
+                    fragments[record['id']] = fragment
+                    for field in fragment.fields:
+                        self.field_counts[field] += 1
 
             number_of_records = len(post)
-            post['sort_order'] = [record['id'] for record in resp]
+            if self.hparams['ids']:
+                # a batch view keeps the order of the requested IDs
+                post['sort_order'] = [each_id for each_id in self.hparams['ids'] if each_id in post]
+            else:
+                post['sort_order'] = [record['id'] for record in resp]
+
+            # a short page is the last one; otherwise Solr says whether there's more
+            if cursor and len(resp) == self.hparams['per_page'] and resp.nextCursorMark != cursor:
+                self.next_cursor = resp.nextCursorMark
         else:
             log.debug('SimpleHandler.basic_get() had no results; resource_id="{0}" and query="{1}"'.format(resource_id, query))
             if start and resp.hits <= start:
                 # if we have 0 results because of a weird "X-Cantus-Page" header, return a 409
                 self.send_error(409, reason=_TOO_LARGE_PAGE)
+            elif cursor and resp.hits:
+                # likewise if the previous page was the last one
+                self.send_error(409, reason=_CURSOR_AT_END)
             elif query:  # assume this is a SEARCH request
                 self.send_error(404, reason=_NO_SEARCH_RESULTS)
             else:
@@ -445,7 +796,12 @@ class SimpleHandler(web.RequestHandler):
         self.total_results = resp.hits
 
         if self.hparams['include_resources']:
-            post['resources'] = {i: {'self': self.make_resource_url(i, post[i]['type'])} for i in post['sort_order']}
+            post['resources'] = {}
+            for each_id in post['sort_order']:
+                if each_id in fragments:
+                    post['resources'][each_id] = fragments[each_id].resources
+                else:
+                    post['resources'][each_id] = {'self': self.make_resource_url(each_id, types[each_id])}
 
         return post, number_of_records
 
@@ -519,6 +875,18 @@ class SimpleHandler(web.RequestHandler):
             else:
                 self.hparams['per_page'] = 10
 
+            if self.hparams['cursor']:
+                # X-Cantus-Cursor
+                cursor = self.hparams['cursor']
+                if not isinstance(cursor, str) or not _CURSOR_MARK.fullmatch(cursor.strip()):
+                    error_messages.append(_INVALID_CURSOR)
+                    all_is_well = False
+                elif self.hparams['page']:
+                    error_messages.append(_CURSOR_WITH_PAGE)
+                    all_is_well = False
+                else:
+                    self.hparams['cursor'] = cursor.strip()
+
             if self.hparams['page']:
                 # X-Cantus-Page
                 try:
@@ -529,7 +897,7 @@ class SimpleHandler(web.RequestHandler):
                 if all_is_well and self.hparams['page'] < 1:
                     error_messages.append(_TOO_SMALL_PAGE)
                     all_is_well = False
-            else:
+            elif not self.hparams['cursor']:
                 self.hparams['page'] = 1
 
             if self.hparams['sort']:
@@ -548,11 +916,24 @@ class SimpleHandler(web.RequestHandler):
                     all_is_well = False
 
         else:
-            # This is a "view" request, so we should obliterate the sort/page/per_page settings,
-            # just in case they might otherwise cause problems for us.
+            # This is a "view" request, so we should obliterate the sort/page/per_page/cursor
+            # settings, just in case they might otherwise cause problems for us.
             self.hparams['page'] = None
             self.hparams['per_page'] = None
             self.hparams['sort'] = None
+            self.hparams['cursor'] = None
+
+        if self.hparams['deadline'] is not None:
+            # X-Cantus-Deadline may shorten the "request_deadline" but not lengthen it
+            try:
+                seconds = float(self.hparams['deadline'])
+            except ValueError:
+                seconds = 0.0
+            if seconds > 0.0 and math.isfinite(seconds):
+                self.set_deadline(seconds)
+            else:
+                error_messages.append(_INVALID_DEADLINE)
+                all_is_well = False
 
         if self.hparams['include_resources'] is not True:
             # This looks a little weird; True is the defalt value, and if it's been changed, then
@@ -575,6 +956,36 @@ class SimpleHandler(web.RequestHandler):
                 error_messages.append(_INVALID_FIELDS)
                 all_is_well = False
 
+        if self.hparams['ids'] is not None:
+            # "ids" in a SEARCH request body
+            ids = self.hparams['ids']
+            if not isinstance(ids, list) or not ids or not all(isinstance(x, str) for x in ids):
+                error_messages.append(_INVALID_IDS)
+                all_is_well = False
+            elif self.hparams['search_query'] is not None:
+                error_messages.append(_QUERY_WITH_IDS)
+                all_is_well = False
+            else:
+                ids = list(OrderedDict.fromkeys(each_id.strip() for each_id in ids))
+                if len(ids) > options.batch_view_limit:
+                    self.send_error(507, reason=_TOO_MANY_IDS)
+                    return False
+                try:
+                    for each_id in ids:
+                        if each_id == '*':
+                            raise ValueError(_INVALID_ID)
+                        util._verify_resource_id(each_id)  # pylint: disable=protected-access
+                except ValueError:
+                    self.send_error(422, reason=_INVALID_ID)
+                    return False
+
+                # every requested resource is on the first page, in the requested order
+                self.hparams['ids'] = ids
+                self.hparams['per_page'] = len(ids)
+                self.hparams['page'] = 1
+                self.hparams['sort'] = None
+                self.hparams['cursor'] = None
+
         if not all_is_well:
             if len(error_messages) == 1:
                 self.send_error(400, reason=error_messages[0])
@@ -642,8 +1053,11 @@ class SimpleHandler(web.RequestHandler):
             else:
                 self.add_header('X-Cantus-Per-Page', 10)
 
-            # figure out X-Cantus-Page
-            if self.hparams['page']:
+            # figure out X-Cantus-Page, or X-Cantus-Cursor when there's a next page
+            if self.hparams['cursor']:
+                if self.next_cursor:
+                    self.add_header('X-Cantus-Cursor', self.next_cursor)
+            elif self.hparams['page']:
                 self.add_header('X-Cantus-Page', self.hparams['page'])
             else:
                 self.add_header('X-Cantus-Page', 1)
@@ -652,6 +1066,203 @@ class SimpleHandler(web.RequestHandler):
             if self.hparams['sort']:
                 self.add_header('X-Cantus-Sort', util.postpare_formatted_sort(self.hparams['sort']))
 
+    def vary_on_accept(self):
+        '''
+        Say that the response depends on the "Accept" request header, which chooses between a JSON
+        response and an export (see :func:`abbot.export.choose_format`), so that a shared cache
+        does not serve one to a client that asked for the other. The ``Vary: Accept`` header is
+        kept by :meth:`send_error`.
+        '''
+        self.vary_accept = True
+        self.add_header('Vary', 'Accept')
+
+    def make_cache_key(self, resource_id):
+        '''
+        Make the key under which this request's response is held in the :const:`RESPONSE_CACHE`.
+
+        .. note:: You must call this method after :meth:`verify_request_headers`, so that the key
+            uses the normalized values of the request headers.
+
+        :param str resource_id: The "id" of the resource from the URL, or ``None`` for a "browse" URL.
+        :returns: A key that is equal for every request that has the same response.
+        :rtype: tuple
+
+        The key includes the current data generation, so a response built from older data is never
+        found under the key of a newer request.
+        '''
+        method = 'SEARCH' if self.request.method == 'SEARCH' else 'GET'  # HEAD is answered like GET
+        return (generation.CURRENT.tag,
+                method,
+                self.type_name,
+                resource_id,
+                self.hparams['per_page'],
+                self.hparams['page'],
+                self.hparams['cursor'],
+                self.hparams['sort'],
+                tuple(self.returned_fields),
+                self.hparams['include_resources'],
+                repr(self.hparams['search_query']),
+                tuple(self.hparams['ids'] or ()),
+               )
+
+    def set_validators(self, cache_key):
+        '''
+        Set the "ETag" and "Last-Modified" response headers from the current data generation.
+
+        The "ETag" is strong because every request with the same ``cache_key`` gets a byte-for-byte
+        identical response, and ``cache_key`` includes the data generation.
+
+        :param tuple cache_key: The return value of :meth:`make_cache_key`.
+        :returns: Whether the headers were set. They are not set if the generation is unknown.
+        :rtype: bool
+        '''
+        if generation.CURRENT.tag is None:
+            return False
+
+        digest = hashlib.sha1(repr(cache_key).encode('utf-8')).hexdigest()
+        self.set_header('ETag', '"{}"'.format(digest))
+        self.set_header('Last-Modified', generation.CURRENT.last_modified)
+        return True
+
+    def compute_etag(self):
+        '''
+        Let Tornado make an "ETag" from the response body, as it does for a response without one,
+        unless ``self.partial_response`` is ``True``. An incomplete response must have no
+        validators, or a client that stored it would be told it is current for the whole generation.
+
+        :returns: The "ETag," or ``None`` for no "ETag."
+        :rtype: str
+        '''
+        if self.partial_response:
+            return None
+        return super(SimpleHandler, self).compute_etag()
+
+    def is_not_modified(self):
+        '''
+        Determine whether a conditional request may be answered with "304 Not Modified," using the
+        response headers set by :meth:`set_validators`.
+
+        As required by RFC 7232, the "If-Modified-Since" request header is ignored when the request
+        has an "If-None-Match" header.
+
+        :returns: Whether the client's copy of the response is current.
+        :rtype: bool
+        '''
+        if 'If-None-Match' in self.request.headers:
+            return self.check_etag_header()
+
+        since = self.request.headers.get('If-Modified-Since')
+        if since:
+            since = email.utils.parsedate(since)
+            if since is not None:
+                since = datetime.datetime(*since[:6])
+                last_modified = generation.CURRENT.last_modified.astimezone(datetime.timezone.utc)
+                return last_modified.replace(tzinfo=None, microsecond=0) <= since
+
+        return False
+
+    def write_cached_response(self, cache_key):
+        '''
+        If the :const:`RESPONSE_CACHE` holds a response for ``cache_key``, set its headers and write
+        its body (unless ``self.head_request`` is ``True``).
+
+        :param tuple cache_key: The return value of :meth:`make_cache_key`.
+        :returns: Whether a cached response was found. If so, the request is finished.
+        :rtype: bool
+        '''
+        cached = RESPONSE_CACHE.get(cache_key)
+        if cached is None:
+            return False
+
+        for name, value in cached.headers:
+            self.add_header(name, value)
+        if not self.head_request:
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write(cached.body)
+
+        return True
+
+    def make_fragment_key(self, resource_id):
+        '''
+        Make the key for a resource in the :const:`FRAGMENT_CACHE`. A serialized resource depends
+        on the resource type of this handler, the returned fields, the "drupal_url" setting, and
+        whether there's a "resources" block, as well as the resource itself.
+
+        :param str resource_id: The "id" of the resource.
+        :returns: The cache key.
+        :rtype: tuple
+        '''
+        return (self.type_name,
+                resource_id,
+                self._returned_field_set,
+                options.drupal_url,
+                self.hparams['include_resources'])
+
+    def make_fragments(self, response):
+        '''
+        Serialize the resources in a response body that are not already serialized, and store them
+        in the :const:`FRAGMENT_CACHE`.
+
+        :param dict response: The response body. Every resource in it, and its member of the
+            "resources" block, is replaced with a :class:`abbot.serialize.Raw` value.
+
+        Resources whose "id" is in ``self.partial_records`` are serialized but not cached.
+        '''
+        resources = response.get('resources')
+        for each_id in response['sort_order']:
+            if isinstance(response[each_id], serialize.Raw):
+                continue
+
+            record = serialize.Raw(serialize.encode(response[each_id]))
+            response[each_id] = record
+            links = None
+            if resources is not None:
+                links = serialize.Raw(serialize.encode(resources[each_id]))
+                resources[each_id] = links
+
+            if each_id in self.record_fields and each_id not in self.partial_records:
+                FRAGMENT_CACHE.put(self.make_fragment_key(each_id),
+                                   Fragment(record, links, tuple(self.record_fields[each_id])))
+
+    @gen.coroutine
+    def write_response(self, response, cache_key):
+        '''
+        Serialize the response body, store it in the :const:`RESPONSE_CACHE` along with the headers
+        set by :meth:`make_response_headers`, then write it (unless ``self.head_request`` is ``True``).
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        :param dict response: The response body.
+        :param tuple cache_key: The return value of :meth:`make_cache_key`.
+
+        When the :const:`FRAGMENT_CACHE` is enabled, the resources are serialized one at a time with
+        :meth:`make_fragments`, on the event loop, and spliced into the response body.
+
+        When ``self.partial_response`` is ``True``, the response is not cached, here or by the
+        client, and it has an ``X-Cantus-Partial: xrefs`` header to say that the cross-references are
+        missing. The "ETag" and "Last-Modified" set by :meth:`set_validators` are removed (they
+        describe the complete response), and :meth:`compute_etag` does not replace them.
+        '''
+        with self.timing('encode'):
+            if FRAGMENT_CACHE.maxsize and isinstance(response, dict) and 'sort_order' in response:
+                self.make_fragments(response)
+            body = yield serialize.encode_async(response)
+
+        if self.partial_response:
+            self.clear_header('ETag')
+            self.clear_header('Last-Modified')
+            self.set_header('Cache-Control', 'no-store')
+            self.set_header('X-Cantus-Partial', 'xrefs')
+        else:
+            headers = []
+            for name in _CACHED_RESPONSE_HEADERS:
+                headers.extend((name, value) for value in self._headers.get_list(name))
+            RESPONSE_CACHE.put(cache_key, CachedResponse(body, headers))
+
+        if not self.head_request:
+            self.set_header('Content-Type', 'application/json; charset=UTF-8')
+            self.write(body)
+
     @util.request_wrapper
     @gen.coroutine
     def get(self, resource_id=None):  # pylint: disable=arguments-differ
@@ -669,27 +1280,59 @@ class SimpleHandler(web.RequestHandler):
 
         # if there is a resource_id, then this request is to a "view" URL
         is_browse_request = resource_id is None
+        if is_browse_request:
+            self.vary_on_accept()
 
         # first check the header-set values for sanity
         if not self.verify_request_headers(is_browse_request):
             return
 
+        # maybe the client wants every resource, not just a page
+        if is_browse_request and not self.head_request:
+            export_format = export.choose_format(self.request.headers.get('Accept'))
+            if export_format is not None:
+                yield self.write_export(export_format)
+                return
+
+        # maybe the client already has this response
+        cache_key = self.make_cache_key(resource_id)
+        if self.set_validators(cache_key) and self.is_not_modified():
+            self.set_status(304)
+            return
+
+        # maybe we already have this response
+        if self.write_cached_response(cache_key):
+            return
+
         # run the more specific GET request handler
         try:
             response, num_results = yield self.get_handler(resource_id)
             if response is None:
                 return
         except pysolrtornado.SolrError as err:
-            self.send_error(502, reason=_SOLR_502_ERROR)
-            log.warn('Solr problem: {0}'.format(err.args[0]))
+            self.send_solr_error(err)
             return
 
         # finally, prepare the response headers
         self.make_response_headers(is_browse_request, num_results)
 
-        if not self.head_request:
-            self.write(response)
+        yield self.write_response(response, cache_key)
 
+    @gen.coroutine
+    def write_export(self, export_format, query=None):
+        '''
+        Send every resource that matches the request in an NDJSON or CSV export, with
+        :func:`abbot.export.stream`.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        :param export_format: The return value of :func:`abbot.export.choose_format`.
+        :param str query: The Solr query for a SEARCH request, or ``None`` for a "browse" request.
+        '''
+        try:
+            yield export.stream(self, export_format, query=query)
+        except pysolrtornado.SolrError as err:
+            self.send_solr_error(err)
 
     @util.request_wrapper
     @gen.coroutine
@@ -700,35 +1343,30 @@ class SimpleHandler(web.RequestHandler):
 
         if resource_id:
             # "view" URL
-            self.add_header('Allow', SimpleHandler._ALLOWED_VIEW_METHODS)
-
             if resource_id.endswith('/') and len(resource_id) > 1:
                 resource_id = resource_id[:-1]
 
             try:
-                resp = yield util.ask_solr_by_id(self.type_name, resource_id)
+                resp = yield taxonomy.ask_by_id(self.type_name, resource_id, caller='options',
+                                                deadline=self.deadline)
             except ValueError:
                 self.send_error(422, reason=_INVALID_ID)
                 return
             except pysolrtornado.SolrError as err:
-                self.send_error(502, reason=_SOLR_502_ERROR)
-                log.warn('Solr problem: {0}'.format(err.args[0]))
+                self.send_solr_error(err)
                 return
 
             if not resp:
                 self.send_error(404, reason=_ID_NOT_FOUND.format(self.type_name, resource_id))
+                return
 
-            # add Cantus-specific request headers
-            for each_header in SimpleHandler._HEADERS_FOR_VIEW:
-                self.add_header(each_header, 'allow')
+            for name, value in self.route.view_options:
+                self.add_header(name, value)
 
         else:
             # "browse" URL
-            self.add_header('Allow', SimpleHandler._ALLOWED_BROWSE_METHODS)
-
-            # add Cantus-specific request headers
-            for each_header in SimpleHandler._HEADERS_FOR_BROWSE:
-                self.add_header(each_header, 'allow')
+            for name, value in self.route.browse_options:
+                self.add_header(name, value)
 
     @util.request_wrapper
     @gen.coroutine
@@ -752,13 +1390,28 @@ class SimpleHandler(web.RequestHandler):
         :param allow: A value for the "Allow" HTTP response header. Intended for "405 Method Not
             Allowed," but may also be useful in other situations.
         :type allow: list of str
+        :param int retry_after: A value for the "Retry-After" HTTP response header, in seconds.
+            Intended for "503 Service Unavailable."
         '''
 
+        if self._headers_written:
+            # this happens when an NDJSON or CSV export fails partway through; closing the
+            # connection before the final chunk lets the client see that the body is incomplete
+            log.error('Could not send error {} because the response was already started'.format(code))
+            self.request.connection.close()
+            return
+
         self.clear()
 
+        if self.vary_accept:
+            self.add_header('Vary', 'Accept')
+
         if 'allow' in kwargs:
             self.add_header('Allow', kwargs['allow'])
 
+        if 'retry_after' in kwargs:
+            self.set_header('Retry-After', kwargs['retry_after'])
+
         if 'per_page' in kwargs:
             self.add_header('X-Cantus-Per-Page', kwargs['per_page'])
 
@@ -775,43 +1428,86 @@ class SimpleHandler(web.RequestHandler):
 
         self.write(response)
 
-    @gen.coroutine
-    def search_handler(self):
+    def send_solr_error(self, err):
         '''
-        Conduct a search query.
+        Send the error response for a failed Solr query, and log the problem.
 
-        :returns: As per :meth:`get_handler`.
+        :param err: The error from :func:`abbot.util.search_solr` or a function that calls it.
+        :type err: :exc:`pysolrtornado.SolrError`
 
-        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+        The response is "503 Service Unavailable" with a "Retry-After" header when too many queries
+        are waiting for Solr (:exc:`abbot.util.Overloaded`), "504 Gateway Timeout" when the
+        request's deadline passed (:exc:`abbot.util.DeadlineExceeded`), and otherwise "502 Bad
+        Gateway."
+        '''
+        if isinstance(err, util.Overloaded):
+            self.send_error(503, reason=_OVERLOADED_503_ERROR, retry_after=options.solr_retry_after)
+        elif isinstance(err, util.DeadlineExceeded):
+            self.send_error(504, reason=_DEADLINE_504_ERROR)
+        else:
+            self.send_error(502, reason=_SOLR_502_ERROR)
+        log.warn('Solr problem: {0}'.format(err.args[0]))
 
-        .. note:: This method returns ``None`` in some situations when an error has been returned
-            to the client. In those situations, callers of this method must not call :meth:`write()`
-            or similar.
+    @gen.coroutine
+    def make_search_query(self):
+        '''
+        Prepare the Solr query for a SEARCH request, running any subqueries for cross-referenced
+        fields.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
 
         .. note:: The query string is obtained from the "search_query" header parameter.
 
-        This method works for :class:`ComplexHandler` too, where there may be "subqueries" that refer
-        to cross-referenced fields.
+        :returns: The query to give :meth:`get_handler`, or ``None`` when an error has been
+            returned to the client.
+        :rtype: str
+
+        If the request body has an "ids" member instead of a "query," the Solr query asks for all
+        those resources at once.
         '''
+        if self.hparams['ids']:
+            return '+type:{} +id:({})'.format(self.type_name, ' OR '.join(self.hparams['ids']))
 
         query = 'type:{type} AND ({query})'.format(type=self.type_name, query=self.hparams['search_query'])
 
         try:
-            query = util.parse_query(query)
+            with self.timing('parse'):
+                query = util.parse_query(query)
         except util.InvalidQueryError:
             self.send_error(400, reason=_INVALID_SEARCH_QUERY)
         else:
             try:
-                query = util.assemble_query((yield util.run_subqueries(query)))
+                with self.timing('subqueries'):
+                    components = yield util.run_subqueries(query, deadline=self.deadline)
+                return util.assemble_query(components)
             except util.InvalidQueryError:
                 self.send_error(404, reason=_NO_SEARCH_RESULTS)
             except ValueError as val_err:
                 self.send_error(400, reason=_INVALID_SEARCH_FIELD.format(val_err.the_field))
-            else:
-                return (yield self.get_handler(query=query))
 
         # if we reach this point, there was an error code somewhere
-        return (None, 0)
+        return None
+
+    @gen.coroutine
+    def search_handler(self):
+        '''
+        Conduct a search query.
+
+        :returns: As per :meth:`get_handler`.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        .. note:: This method returns ``None`` in some situations when an error has been returned
+            to the client. In those situations, callers of this method must not call :meth:`write()`
+            or similar.
+
+        This method works for :class:`ComplexHandler` too, where there may be "subqueries" that refer
+        to cross-referenced fields. They are handled by :meth:`make_search_query`.
+        '''
+        query = yield self.make_search_query()
+        if query is None:
+            return (None, 0)
+        return (yield self.get_handler(query=query))
 
     @util.request_wrapper
     @gen.coroutine
@@ -832,11 +1528,12 @@ class SimpleHandler(web.RequestHandler):
         if resource_id and resource_id != '/':
             self.send_error(405, allow=SimpleHandler._ALLOWED_VIEW_METHODS)
             return
+        self.vary_on_accept()
 
-        # If there was no "query" member in the request body, we'll still get called, even though
-        # send_error() will already have been called from initialize(). We have to quit now or
-        # we'll end up overwriting the error.
-        if self.hparams['search_query'] is None:
+        # If there was no "query" or "ids" member in the request body, we'll still get called, even
+        # though send_error() will already have been called from initialize(). We have to quit now
+        # or we'll end up overwriting the error.
+        if self.hparams['search_query'] is None and self.hparams['ids'] is None:
             return
 
         # every SEARCH query is a sub-type of browse
@@ -846,17 +1543,33 @@ class SimpleHandler(web.RequestHandler):
         if not self.verify_request_headers(is_browse_request):
             return
 
+        # maybe the client wants every resource, not just a page
+        export_format = export.choose_format(self.request.headers.get('Accept'))
+        if export_format is not None:
+            try:
+                query = yield self.make_search_query()
+            except pysolrtornado.SolrError as err:
+                self.send_solr_error(err)
+                return
+            if query is not None:
+                yield self.write_export(export_format, query=query)
+            return
+
+        # maybe we already have this response
+        cache_key = self.make_cache_key(None)
+        if self.write_cached_response(cache_key):
+            return
+
         # run the more specific SEARCH request handler
         try:
             response, num_results = yield self.search_handler()
             if response is None:
                 return
         except pysolrtornado.SolrError as err:
-            self.send_error(502, reason=_SOLR_502_ERROR)
-            log.warn('Solr problem: {0}'.format(err.args[0]))
+            self.send_solr_error(err)
             return
 
         # finally, prepare the response headers
         self.make_response_headers(is_browse_request, num_results)
 
-        self.write(response)
+        yield self.write_response(response, cache_key)
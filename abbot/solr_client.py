@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/solr_client.py
+# Purpose:                Connection to Solr for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Connection to Solr for the Abbot server.
+
+:class:`SolrClient` is a :class:`pysolrtornado.Solr` with its own HTTP client, so that the number
+of simultaneous connections to Solr and the timeouts are set by Abbot's options rather than by
+whatever other code made the first :class:`~tornado.httpclient.AsyncHTTPClient`. It also counts the
+requests it sends, so the queue of requests waiting for a connection can be monitored.
+
+If "pycurl" is installed, the HTTP client keeps connections to Solr open between requests.
+Tornado's default HTTP client opens a new connection for every request.
+'''
+
+from tornado import gen, httpclient
+from tornado.log import app_log as log
+from tornado.options import options
+import pysolrtornado
+
+try:
+    from tornado import curl_httpclient
+except ImportError:
+    curl_httpclient = None
+
+
+options.define('solr_max_clients', type=int, default=20,
+               help='maximum number of simultaneous connections to Solr, per worker process')
+options.define('solr_connect_timeout', type=float, default=2.0,
+               help='seconds to wait for a connection to Solr')
+options.define('solr_request_timeout', type=float, default=10.0,
+               help='seconds to wait for Solr to answer a request')
+options.define('solr_keep_alive', type=bool, default=True,
+               help='whether to keep connections to Solr open between requests (requires pycurl)')
+
+
+_NO_PYCURL = 'Connections to Solr cannot be kept alive without "pycurl".'
+
+
+class SolrClient(pysolrtornado.Solr):
+    '''
+    A :class:`pysolrtornado.Solr` with a dedicated, configurable HTTP client and request counters.
+    '''
+
+    def __init__(self, url, max_clients=10, connect_timeout=None, request_timeout=None,
+                 keep_alive=False, ioloop=None):
+        '''
+        :param str url: The URL to the Solr collection.
+        :param int max_clients: The maximum number of simultaneous requests to Solr. Others wait in
+            a queue until a connection is free.
+        :param float connect_timeout: Seconds to wait for a connection to Solr.
+        :param float request_timeout: Seconds to wait for Solr to answer, including the connection.
+        :param bool keep_alive: Whether to keep connections open between requests, if possible.
+        :param ioloop: The IOLoop on which to run requests, or ``None`` for the global instance.
+        :type ioloop: :class:`tornado.ioloop.IOLoop`
+        '''
+        super(SolrClient, self).__init__(url, timeout=request_timeout, ioloop=ioloop)
+
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self.total_requests = 0
+        self.max_in_flight = 0
+
+        defaults = {'connect_timeout': connect_timeout, 'request_timeout': self.timeout}
+        if keep_alive and curl_httpclient is not None:
+            client_class = curl_httpclient.CurlAsyncHTTPClient
+        else:
+            if keep_alive:
+                log.warn(_NO_PYCURL)
+            client_class = httpclient.AsyncHTTPClient
+        self._client = client_class(self._ioloop, force_instance=True, max_clients=max_clients,
+                                    defaults=defaults)
+
+    @gen.coroutine
+    def _send_request(self, method, path='', body=None, headers=None, files=None):
+        '''
+        Send a request to Solr, as in :class:`pysolrtornado.Solr`, counting the requests in flight.
+        '''
+        self.in_flight += 1
+        self.total_requests += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return (yield super(SolrClient, self)._send_request(method, path, body=body,
+                                                                headers=headers, files=files))
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        '''
+        Describe the requests sent through this client.
+
+        :returns: A dictionary with these keys:
+
+            - "in_flight": the number of requests started but not finished, including queued ones;
+            - "queued": the number of requests waiting for a connection;
+            - "max_in_flight": the most requests that were in flight at once;
+            - "max_clients": the maximum number of simultaneous connections; and
+            - "total_requests": the number of requests started.
+        :rtype: dict
+        '''
+        return {'in_flight': self.in_flight,
+                'queued': max(0, self.in_flight - self.max_clients),
+                'max_in_flight': self.max_in_flight,
+                'max_clients': self.max_clients,
+                'total_requests': self.total_requests,
+               }
+
+
+def from_options():
+    '''
+    Make a :class:`SolrClient` with the "solr_*" options.
+
+    :returns: The new client.
+    :rtype: :class:`SolrClient`
+    '''
+    return SolrClient(options.solr_url,
+                      max_clients=options.solr_max_clients,
+                      connect_timeout=options.solr_connect_timeout,
+                      request_timeout=options.solr_request_timeout,
+                      keep_alive=options.solr_keep_alive)
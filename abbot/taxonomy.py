@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               abbot/taxonomy.py
+# Purpose:                In-memory store of the "taxonomy" resources for the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+In-memory store of the "taxonomy" resources for the Abbot server.
+
+The resource types served by :class:`~abbot.simple_handler.SimpleHandler` hold only a few thousand
+small records in total, so Abbot can keep all of them in memory and answer "view" and "browse"
+requests without asking Solr. The :const:`STORE` is loaded when Abbot starts, then reloaded every
+``taxonomy_refresh`` seconds.
+'''
+
+from tornado import gen, ioloop
+from tornado.log import app_log as log
+from tornado.options import options
+import pysolrtornado
+
+from abbot import generation
+from abbot import util
+
+
+options.define('taxonomy_refresh', type=int, default=3600,
+               help='seconds between reloads of the in-memory taxonomy store (0 to disable it)')
+
+
+TAXONOMY_TYPES = ('century', 'feast', 'genre', 'indexer', 'notation', 'office', 'portfolio',
+                  'provenance', 'segment', 'siglum', 'source_status')
+'''
+The resource types held in the :class:`TaxonomyStore`.
+'''
+
+_MAX_ROWS = 50000
+# the most records of a single type we'll try to load; types with more records are left in Solr
+
+_TOO_MANY_RECORDS = 'Taxonomy store: {} has {} records, so it will be served by Solr.'
+_LOAD_FAILED = 'Taxonomy store: could not load {} ({}).'
+
+
+class TaxonomyStore(object):
+    '''
+    Hold every record of the :const:`TAXONOMY_TYPES` in memory, indexed by "id" and by every field
+    that may be used for sorting.
+
+    The store only answers for a resource type once that type has been loaded. Until then (or if
+    loading failed) :meth:`has` returns ``False`` and callers should ask Solr as usual.
+    '''
+
+    def __init__(self):
+        "Initialize an empty :class:`TaxonomyStore`."
+        self._records = {}  # type -> list of records, in the order Solr returned them
+        self._by_id = {}  # type -> {id -> record}
+        self._by_field = {}  # type -> {field -> (records with the field sorted ascending, records without it)}
+
+    def has(self, q_type):
+        '''
+        Determine whether the store can answer for a resource type.
+
+        :param str q_type: The resource type.
+        :returns: Whether all the resources of ``q_type`` are in the store.
+        :rtype: bool
+        '''
+        return q_type in self._records
+
+    def clear(self):
+        '''
+        Remove every record from the store.
+        '''
+        self._records = {}
+        self._by_id = {}
+        self._by_field = {}
+
+    def replace(self, q_type, records):
+        '''
+        Replace all the records of a resource type, rebuilding the indices.
+
+        :param str q_type: The resource type.
+        :param records: Every record of type ``q_type``, in Solr's default order.
+        :type records: list of dict
+        '''
+        records = list(records)
+
+        fields = set()
+        for record in records:
+            fields.update(field for field, value in record.items() if _sortable(value))
+
+        by_field = {}
+        for field in fields:
+            present = [record for record in records if _sortable(record.get(field))]
+            absent = [record for record in records if not _sortable(record.get(field))]
+            present.sort(key=lambda record, field=field: record[field])
+            by_field[field] = (present, absent)
+
+        # these are replaced together so a request never sees half of an update
+        self._by_id[q_type] = {record['id']: record for record in records}
+        self._by_field[q_type] = by_field
+        self._records[q_type] = records
+
+    def search(self, q_type, q_id, start=None, rows=None, sort=None):
+        '''
+        Answer a query like :func:`util.ask_solr_by_id` does, but from memory.
+
+        :param str q_type: The resource type, which must be held in the store.
+        :param str q_id: The "id" of the resource, or ``'*'`` for all resources of ``q_type``.
+        :param int start: As described in :func:`util.search_solr`.
+        :param int rows: As described in :func:`util.search_solr`.
+        :param str sort: As described in :func:`util.search_solr`.
+        :returns: The results, just like they would come from Solr.
+        :rtype: :class:`pysolrtornado.Results`
+        :raises: :exc:`KeyError` when ``q_type`` is not held in the store.
+
+        Records that do not have a sort field are put after those that do, whatever the direction.
+        '''
+        if q_id != '*':
+            record = self._by_id[q_type].get(q_id)
+            docs = [record] if record is not None else []
+        else:
+            docs = self._sorted(q_type, sort)
+
+        hits = len(docs)
+        start = start or 0
+        if rows is None:
+            rows = 10  # Solr's default
+        docs = docs[start:start + rows]
+
+        return pysolrtornado.Results({'response': {'numFound': hits, 'docs': docs}})
+
+    def _sorted(self, q_type, sort):
+        '''
+        Return all the records of a type, sorted with a Solr "sort" parameter.
+
+        :param str q_type: The resource type.
+        :param str sort: The "sort" parameter, like ``'name asc,id desc'``, or ``None``.
+        :returns: All the records, sorted.
+        :rtype: list of dict
+        '''
+        if not sort:
+            return self._records[q_type]
+
+        specs = [each.split() for each in sort.split(',')]
+
+        if len(specs) == 1:
+            # the common case: use the index for this field
+            field, direction = specs[0]
+            if field not in self._by_field[q_type]:
+                return self._records[q_type]
+            present, absent = self._by_field[q_type][field]
+            if direction == 'desc':
+                return list(reversed(present)) + absent
+            else:
+                return present + absent
+
+        # sort by each field in reverse order of importance, since list.sort() is stable
+        post = self._records[q_type]
+        for field, direction in reversed(specs):
+            present = [record for record in post if _sortable(record.get(field))]
+            absent = [record for record in post if not _sortable(record.get(field))]
+            present.sort(key=lambda record, field=field: record[field], reverse=(direction == 'desc'))
+            post = present + absent
+        return post
+
+    @gen.coroutine
+    def load(self):
+        '''
+        Load (or reload) every record of the :const:`TAXONOMY_TYPES` from Solr.
+
+        .. note:: This method is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+        If a resource type cannot be loaded, a message is logged and the previous records of that
+        type are kept.
+        '''
+        for q_type in TAXONOMY_TYPES:
+            try:
+                resp = yield util.search_solr('type:{}'.format(q_type), rows=_MAX_ROWS,
+                                              caller='TaxonomyStore.load')
+            except pysolrtornado.SolrError as err:
+                log.warn(_LOAD_FAILED.format(q_type, err.args[0]))
+                continue
+
+            if resp.hits > len(resp.docs):
+                log.warn(_TOO_MANY_RECORDS.format(q_type, resp.hits))
+                self._records.pop(q_type, None)
+                continue
+
+            self.replace(q_type, resp.docs)
+
+        log.info('Taxonomy store: loaded {} types'.format(len(self._records)))
+
+
+def _sortable(value):
+    '''
+    Determine whether a field's value can be used by :class:`TaxonomyStore` for sorting.
+    '''
+    return isinstance(value, (str, int, float)) and not isinstance(value, bool)
+
+
+STORE = TaxonomyStore()
+'''
+The process-wide :class:`TaxonomyStore`.
+'''
+
+
+@gen.coroutine
+def ask_by_id(q_type, q_id, start=None, rows=None, sort=None, fields=None, cursor=None,
+              caller='other', deadline=None):
+    '''
+    Like :func:`util.ask_solr_by_id`, but answered from the :const:`STORE` whenever it holds
+    ``q_type`` and there is no ``cursor``. Otherwise, the query is sent to Solr.
+
+    Records from the :const:`STORE` hold every field, whatever the ``fields`` argument.
+
+    .. note:: This function is a Tornado coroutine, so you must call it with a ``yield`` statement.
+
+    :param str q_type: As described in :func:`util.ask_solr_by_id`.
+    :param str q_id: As described in :func:`util.ask_solr_by_id`.
+    :param start: As described in :func:`util.search_solr`.
+    :param rows: As described in :func:`util.search_solr`.
+    :param sort: As described in :func:`util.search_solr`.
+    :param fields: As described in :func:`util.search_solr`.
+    :param cursor: As described in :func:`util.search_solr`.
+    :param caller: As described in :func:`util.search_solr`.
+    :param deadline: As described in :func:`util.search_solr`.
+    :returns: As described in :func:`util.search_solr`.
+    :raises: :exc:`pysolrtornado.SolrError` as described in :func:`util.search_solr`.
+    :raises: :exc:`ValueError` when the `q_id` is invalid as per the Cantus API.
+    '''
+    if STORE.has(q_type) and not cursor:
+        util._verify_resource_id(q_id)  # pylint: disable=protected-access
+        return STORE.search(q_type, q_id, start=start, rows=rows, sort=sort)
+    else:
+        return (yield util.ask_solr_by_id(q_type, q_id, start=start, rows=rows, sort=sort,
+                                          fields=fields, cursor=cursor, caller=caller,
+                                          deadline=deadline))
+
+
+def start_refreshing():  # pragma: no cover
+    '''
+    Load the :const:`STORE` as soon as the IOLoop starts, then reload it every ``taxonomy_refresh``
+    seconds and whenever the data generation changes. Nothing happens if ``taxonomy_refresh`` is
+    ``0``.
+
+    :returns: The :class:`PeriodicCallback` that reloads the store, or ``None``.
+    '''
+    if options.taxonomy_refresh <= 0:
+        return None
+
+    ioloop.IOLoop.current().spawn_callback(STORE.load)
+    generation.CURRENT.add_listener(lambda: ioloop.IOLoop.current().spawn_callback(STORE.load))
+    refresher = ioloop.PeriodicCallback(STORE.load, options.taxonomy_refresh * 1000)
+    refresher.start()
+    return refresher
@@ -38,6 +38,11 @@ from tornado.options import options
 import pysolrtornado
 import abbot
 from abbot import __main__ as main
+from abbot import complex_handler
+from abbot import generation
+from abbot import simple_handler
+from abbot import taxonomy
+from abbot import util
 
 # ensure we have a consistent "server_name" for all the tests
 options.server_name = 'https://cantus.org/'
@@ -71,11 +76,29 @@ def _solr_side_effect(*args, **kwargs):
     raise AssertionError('abbot.tests.shared.TestHandler blocks access to Solr; your test is misconfigured')
 
 
+def solr_fields(type_name):
+    '''
+    Find the "fl" parameter that the handler for "type_name" resources sends to Solr, when the
+    request has no X-Cantus-Fields header.
+
+    :param str type_name: The resource type, as given to the handler in :const:`abbot.__main__.HANDLERS`.
+    :returns: The value of the "fl" parameter.
+    :rtype: str
+    '''
+    for spec in main.HANDLERS:
+        if spec.kwargs and spec.kwargs.get('type_name') == type_name:
+            fields = list(simple_handler.SimpleHandler._DEFAULT_RETURNED_FIELDS)
+            fields.extend(spec.kwargs.get('additional_fields', []))
+            handler = mock.Mock(returned_fields=fields)
+            return ','.join(simple_handler.SimpleHandler.solr_fields(handler))
+    raise KeyError(type_name)
+
+
 class TestHandler(testing.AsyncHTTPTestCase):
     "Base class for classes that test a ___Handler."
 
     def get_app(self):
-        return web.Application(main.HANDLERS)
+        return web.Application(main.compile_routes(main.HANDLERS))
 
     def check_standard_header(self, on_this):
         '''
@@ -102,16 +125,35 @@ class TestHandler(testing.AsyncHTTPTestCase):
         - drupal_url: None
         - server_name: 'https://cantus.org/'
         - cors_allow_origin: 'https://cantus.org:5733/'
+        - batch_view_limit: 100
+        - server_timing: False
+        - request_deadline: 0.0
+        - solr_retry_after: 1
 
         The mock on Solr simply raises an AssertionError. If you want to use Solr in a test, call
         the :meth:`setUpSolr` method.
+
+        The process-wide caches are emptied and the data generation is unknown, so that no test sees
+        the results of another.
         '''
         super(TestHandler, self).setUp()
+        generation.CURRENT.tag = None
+        generation.CURRENT.last_modified = None
+        complex_handler.XREF_CACHE.clear()
+        taxonomy.STORE.clear()
+        simple_handler.RESPONSE_CACHE.clear()
+        simple_handler.FRAGMENT_CACHE.clear()
+        util.SUBQUERY_CACHE.clear()
+        util._IN_FLIGHT.clear()
         self._simple_options_patcher = mock.patch('abbot.simple_handler.options')
         self._simple_options = self._simple_options_patcher.start()
         self._simple_options.drupal_url = None
         self._simple_options.server_name = 'https://cantus.org/'
         self._simple_options.cors_allow_origin = 'https://cantus.org:5733/'
+        self._simple_options.batch_view_limit = 100
+        self._simple_options.server_timing = False
+        self._simple_options.request_deadline = 0.0
+        self._simple_options.solr_retry_after = 1
 
         self._solr_patcher = mock.patch('abbot.util.SOLR')
         self._solr = self._solr_patcher.start()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_cache.py
+# Purpose:                Tests for abbot/cache.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/cache.py of the Abbot server.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import mock, TestCase
+
+from abbot import cache
+
+
+class TestLRUCache(TestCase):
+    '''
+    Tests for abbot.cache.LRUCache.
+    '''
+
+    def test_get_1(self):
+        "A missing key returns the default."
+        lru = cache.LRUCache(4)
+        assert lru.get('a') is None
+        assert lru.get('a', 'zzz') == 'zzz'
+
+    def test_get_2(self):
+        "A key that was put() is returned."
+        lru = cache.LRUCache(4)
+        lru.put('a', 1)
+        assert lru.get('a') == 1
+        assert 'a' in lru
+        assert len(lru) == 1
+
+    def test_eviction_1(self):
+        "The least-recently-put entry is evicted first."
+        lru = cache.LRUCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.put('c', 3)
+        assert 'a' not in lru
+        assert lru.get('b') == 2
+        assert lru.get('c') == 3
+
+    def test_eviction_2(self):
+        "Calling get() makes an entry recently-used, so it is not evicted."
+        lru = cache.LRUCache(2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        assert lru.get('a') == 1
+        assert 'b' not in lru
+
+    def test_disabled(self):
+        "With a maxsize of 0, nothing is stored."
+        lru = cache.LRUCache(0)
+        lru.put('a', 1)
+        assert len(lru) == 0
+        assert lru.get('a') is None
+
+    @mock.patch('abbot.cache._now_wrapper')
+    def test_ttl_1(self, mock_now):
+        "An entry is returned before its TTL runs out, and not afterward."
+        mock_now.return_value = 100.0
+        lru = cache.LRUCache(4, ttl=10)
+        lru.put('a', 1)
+        mock_now.return_value = 109.0
+        assert lru.get('a') == 1
+        mock_now.return_value = 110.0
+        assert lru.get('a') is None
+        assert len(lru) == 0
+
+    @mock.patch('abbot.cache._now_wrapper')
+    def test_ttl_2(self, mock_now):
+        "With no TTL, entries never expire."
+        mock_now.return_value = 100.0
+        lru = cache.LRUCache(4)
+        lru.put('a', 1)
+        mock_now.return_value = 1e12
+        assert lru.get('a') == 1
+
+    def test_resize(self):
+        "Making the cache smaller evicts the least-recently-used entries."
+        lru = cache.LRUCache(4)
+        for key in 'abcd':
+            lru.put(key, key)
+        lru.resize(maxsize=2)
+        assert len(lru) == 2
+        assert 'c' in lru
+        assert 'd' in lru
+
+    def test_getsizeof_1(self):
+        "With a getsizeof() function, entries are evicted to keep the total size under maxsize."
+        lru = cache.LRUCache(10, getsizeof=len)
+        lru.put('a', 'xxxx')
+        lru.put('b', 'xxxx')
+        assert lru.currsize == 8
+        lru.put('c', 'xxxx')
+        assert 'a' not in lru
+        assert lru.currsize == 8
+
+    def test_getsizeof_2(self):
+        "A value larger than maxsize is not stored."
+        lru = cache.LRUCache(10, getsizeof=len)
+        lru.put('a', 'x' * 11)
+        assert 'a' not in lru
+        assert lru.currsize == 0
+
+    def test_getsizeof_3(self):
+        "Replacing a value replaces its size."
+        lru = cache.LRUCache(10, getsizeof=len)
+        lru.put('a', 'xxxx')
+        lru.put('a', 'xx')
+        assert lru.currsize == 2
+
+    def test_counters(self):
+        "get() counts hits and misses, but the 'in' operator does not."
+        lru = cache.LRUCache(4)
+        lru.put('a', 1)
+        lru.get('a')
+        lru.get('b')
+        lru.get('b')
+        assert 'a' in lru
+        assert lru.hits == 1
+        assert lru.misses == 2
+
+    def test_clear(self):
+        "clear() removes everything."
+        lru = cache.LRUCache(4)
+        lru.put('a', 1)
+        lru.clear()
+        assert len(lru) == 0
@@ -35,13 +35,19 @@ Tests for the Abbot server's ComplexHandler.
 
 from unittest import mock
 import pysolrtornado
+import pytest
 from tornado import httpclient, testing
 from abbot import __main__ as main
 from abbot import complex_handler
+from abbot import limiter
+from abbot import util
 import shared
 ComplexHandler = complex_handler.ComplexHandler
 Xref = complex_handler.Xref
 
+_XREF_FL = 'description,display_name,id,name,title,type'
+# the "fl" parameter for cross-reference lookups
+
 
 class TestXref(shared.TestHandler):
     '''
@@ -147,7 +153,7 @@ class TestXref(shared.TestHandler):
 
         yield Xref.lookup(set(['id:123']))
 
-        self.solr.search.assert_called_with('id:123', df='default_search', rows=1)
+        self.solr.search.assert_called_with('id:123', df='default_search', rows=1, fl=_XREF_FL)
 
     @testing.gen_test
     def test_lookup_6(self):
@@ -158,20 +164,80 @@ class TestXref(shared.TestHandler):
 
         yield Xref.lookup(['id:123', 'id:124', 'id:125'])
 
-        self.solr.search.assert_called_with('id:123 OR id:124 OR id:125', df='default_search', rows=3)
+        self.solr.search.assert_called_with('id:123 OR id:124 OR id:125', df='default_search', rows=3,
+                                            fl=_XREF_FL)
 
     @mock.patch('abbot.complex_handler.log.warn')
     @testing.gen_test
     def test_lookup_7(self, mock_warn):
-        "Returns an empty dictionary when the Solr request produces a SolrError."
+        "A SolrError is not caught, so look_up_xrefs() can mark the response as partial."
         self.solr = self.setUpSolr()
         self.solr.search = mock.Mock(side_effect=pysolrtornado.SolrError('test_lookup_7()'))
 
+        with pytest.raises(pysolrtornado.SolrError) as exc:
+            yield Xref.lookup(set(['id:123']))
+
+        assert exc.value.args[0] == 'test_lookup_7()'
+        assert mock_warn.call_count == 0
+
+    @testing.gen_test
+    def test_lookup_8(self):
+        "Results are cached, so a second lookup for the same IDs does not ask Solr."
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('id:123', {'id': '123', 'display_name': 'Carte Blanche'})
+
+        yield Xref.lookup(set(['id:123']))
         actual = yield Xref.lookup(set(['id:123']))
 
-        assert actual == {}
-        assert mock_warn.call_count == 1
-        assert mock_warn.call_args[0][0].endswith('test_lookup_7()')
+        assert actual == {'123': {'id': '123', 'display_name': 'Carte Blanche'}}
+        assert self.solr.search.call_count == 1
+
+    @testing.gen_test
+    def test_lookup_9(self):
+        "With a partial cache hit, only the missing IDs are requested from Solr."
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('id:124', {'id': '124', 'display_name': 'Blarte Canche'})
+        complex_handler.XREF_CACHE.put('123', {'id': '123', 'display_name': 'Carte Blanche'})
+
+        actual = yield Xref.lookup(['id:123', 'id:124'])
+
+        assert actual == {
+            '123': {'id': '123', 'display_name': 'Carte Blanche'},
+            '124': {'id': '124', 'display_name': 'Blarte Canche'},
+        }
+        self.solr.search.assert_called_once_with('id:124', df='default_search', rows=1, fl=_XREF_FL)
+
+    @testing.gen_test
+    def test_lookup_10(self):
+        "When Solr fails, the SolrError is not caught, but from_cache() has the cached resources."
+        self.solr = self.setUpSolr()
+        self.solr.search = mock.Mock(side_effect=pysolrtornado.SolrError('test_lookup_10()'))
+        complex_handler.XREF_CACHE.put('123', {'id': '123', 'display_name': 'Carte Blanche'})
+
+        with pytest.raises(pysolrtornado.SolrError):
+            yield Xref.lookup(['id:123', 'id:124'])
+
+        actual = Xref.from_cache(['id:123', 'id:124'])
+        assert actual == ({'123': {'id': '123', 'display_name': 'Carte Blanche'}}, ['id:124'])
+
+    @testing.gen_test
+    def test_lookup_11(self):
+        "The deadline is given to search_solr(), and DeadlineExceeded is not caught."
+        self.solr = self.setUpSolr()
+        with pytest.raises(util.DeadlineExceeded):
+            yield Xref.lookup(['id:123'], deadline=self.io_loop.time() - 1.0)
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_lookup_12(self):
+        "Overloaded is not caught, so the handler can leave out the cross-references."
+        self.solr = self.setUpSolr()
+        the_limiter = limiter.AdaptiveLimiter(1, queue_size=0)
+        the_limiter.in_flight = 1
+        with mock.patch('abbot.util.LIMITER', the_limiter):
+            with pytest.raises(util.Overloaded):
+                yield Xref.lookup(['id:123'])
+        assert self.solr.search.call_count == 0
 
     def test_fill_1(self):
         "Fills a single, non-list field."
@@ -368,6 +434,23 @@ class TestXref(shared.TestHandler):
 
         assert expected == actual
 
+    @mock.patch('abbot.complex_handler.log.warn')
+    @testing.gen_test
+    def test_look_up_xrefs_solr_error(self, mock_warn):
+        "When the lookup fails, the cached cross-references are used and the response is partial."
+        results = {'1': {'id': '1', 'genre_id': '162', 'feast_id': '1984'},
+                   'resources': {'1': {'self': 'wee!'}},
+                   'sort_order': ['1']}
+        self.solr = self.setUpSolr()
+        self.solr.search = mock.Mock(side_effect=pysolrtornado.SolrError('look_up_xrefs()'))
+        complex_handler.XREF_CACHE.put('162', {'id': '162', 'type': 'genre', 'description': 'V'})
+
+        actual = yield self.handler.look_up_xrefs(results, False)
+
+        assert actual['1'] == {'id': '1', 'genre': 'V'}
+        assert self.handler.partial_response is True
+        assert mock_warn.call_count == 1
+
 
 class TestLookupNameForResponse(shared.TestHandler):
     '''
@@ -438,103 +521,73 @@ class TestMakeExtraFields(shared.TestHandler):
                                                          'indexing_notes', 'indexing_date',
                                                          'indexers', 'editors', 'proofreaders',
                                                          'provenance_detail'])
-    @testing.gen_test
     def test_both_things_to_lookup(self):
         "with both a feast_id and source_status_id to look up"
         record = {}
         orig_record = {'feast_id': '123', 'source_status_id': '456'}
+        xrefs = {'123': {'id': '123', 'description': 'boiled goose and collard greens'},
+                 '456': {'id': '456', 'description': 'Ready'}}
         expected = {'feast_desc': 'boiled goose and collard greens', 'source_status_desc': 'Ready'}
-        self.handler.returned_fields.append('feast_id')  # otherwise Source wouldn't usually do it!
-
-        self.solr.search_se.add('id:123', {'id': '123', 'description': 'boiled goose and collard greens'})
-        self.solr.search_se.add('id:456', {'id': '456', 'description': 'Ready'})
+        self.handler.returned_fields = list(self.handler.returned_fields) + ['feast_id']  # otherwise Source wouldn't usually do it!
 
-        actual = yield self.handler.make_extra_fields(record, orig_record)
+        actual = self.handler.make_extra_fields(record, orig_record, xrefs)
 
         self.assertEqual(expected, actual)
+        assert self.solr.search.call_count == 0
 
-    @testing.gen_test
     def test_both_things_but_return_nothing(self):
-        "with both a feast_id and source_status_id to look up, but they both return nothing"
+        "with both a feast_id and source_status_id to look up, but they weren't cross-referenced"
         record = {}
         orig_record = {'feast_id': '123', 'source_status_id': '456'}
         expected = {}
-        self.handler.returned_fields.append('feast_id')  # otherwise Source wouldn't usually do it!
+        self.handler.returned_fields = list(self.handler.returned_fields) + ['feast_id']  # otherwise Source wouldn't usually do it!
 
-        actual = yield self.handler.make_extra_fields(record, orig_record)
+        actual = self.handler.make_extra_fields(record, orig_record, {})
 
-        self.solr.search.assert_any_call('+type:feast +id:123', df='default_search')
-        self.solr.search.assert_any_call('+type:source_status +id:456', df='default_search')
+        assert self.solr.search.call_count == 0
         self.assertEqual(expected, actual)
 
-    @testing.gen_test
     def test_nothing_to_lookup(self):
         "with neither a feast_id nor a source_status_id to look up"
         record = {}
         orig_record = {'feast_id': '123', 'source_status_id': '456'}
+        xrefs = {'123': {'id': '123', 'description': 'boiled goose and collard greens'},
+                 '456': {'id': '456', 'description': 'Ready'}}
         expected = {}
         self.handler.returned_fields = ['id']  # remove everything, so we get nothing back
 
-        actual = yield self.handler.make_extra_fields(record, orig_record)
+        actual = self.handler.make_extra_fields(record, orig_record, xrefs)
 
-        assert self.solr.search.call_count == 0
         self.assertEqual(expected, actual)
 
-    @mock.patch('abbot.complex_handler.log.warn')
-    @testing.gen_test
-    def test_feast_lookup_fails(self, mock_warn):
-        '''
-        Both a feast_id and source_status_id to look up, but the feast lookup fails. The source
-        status lookup should still succeed.
-        '''
+    def test_xref_without_description(self):
+        "the cross-referenced feast has no description, but the source status does"
         record = {}
         orig_record = {'feast_id': '123', 'source_status_id': '456'}
+        xrefs = {'123': {'id': '123', 'name': 'Thanksgiving'},
+                 '456': {'id': '456', 'description': 'Ready'}}
         expected = {'source_status_desc': 'Ready'}
-        self.handler.returned_fields.append('feast_id')  # otherwise Source wouldn't usually do it!
-        def local_search_side_effect(query, **kwargs):
-            '''
-            This is a test-specific side effect for the util.search_solr() function.
-            '''
-            if '456' in query:
-                return shared.make_future(shared.make_results([
-                    {'id': '456', 'description': 'Ready'},
-                ]))
-            else:
-                raise pysolrtornado.SolrError('test_feast_lookup_fails()')
-        self.solr.search = mock.Mock(side_effect=local_search_side_effect)
-
-        actual = yield self.handler.make_extra_fields(record, orig_record)
+        self.handler.returned_fields = list(self.handler.returned_fields) + ['feast_id']  # otherwise Source wouldn't usually do it!
+
+        actual = self.handler.make_extra_fields(record, orig_record, xrefs)
 
         assert expected == actual
-        assert mock_warn.call_args[0][0].endswith('test_feast_lookup_fails()')
 
-    @mock.patch('abbot.complex_handler.log.warn')
     @testing.gen_test
-    def test_status_lookup_fails(self, mock_warn):
-        '''
-        Both a feast_id and source_status_id to look up, but the source status lookup fails. The
-        feast lookup should still succeed.
-        '''
-        record = {}
-        orig_record = {'feast_id': '123', 'source_status_id': '456'}
-        expected = {'feast_desc': 'boiled goose and collard greens'}
-        self.handler.returned_fields.append('feast_id')  # otherwise Source wouldn't usually do it!
-        def local_search_side_effect(query, **kwargs):
-            '''
-            This is a test-specific side effect for the util.search_solr() function.
-            '''
-            if '123' in query:
-                return shared.make_future(shared.make_results([
-                    {'id': '123', 'description': 'boiled goose and collard greens'},
-                ]))
-            else:
-                raise pysolrtornado.SolrError('test_feast_lookup_fails()')
-        self.solr.search = mock.Mock(side_effect=local_search_side_effect)
-
-        actual = yield self.handler.make_extra_fields(record, orig_record)
+    def test_single_query_for_many_records(self):
+        "look_up_xrefs() fills the extra fields from its single cross-reference query"
+        self.handler.returned_fields = list(self.handler.returned_fields) + ['feast_id']  # otherwise Source wouldn't usually do it!
+        self.solr.search_se.add('id:123', {'id': '123', 'name': 'Pascha', 'description': 'Easter'})
+        results = {'sort_order': ['1', '2', '3']}
+        for each_id in results['sort_order']:
+            results[each_id] = {'id': each_id, 'type': 'source', 'feast_id': '123'}
 
-        assert expected == actual
-        assert mock_warn.call_args[0][0].endswith('test_feast_lookup_fails()')
+        actual = yield self.handler.look_up_xrefs(results, False)
+
+        assert self.solr.search.call_count == 1
+        for each_id in results['sort_order']:
+            assert actual[each_id]['feast'] == 'Pascha'
+            assert actual[each_id]['feast_desc'] == 'Easter'
 
 
 class TestGetHandler(shared.TestHandler):
@@ -574,65 +627,44 @@ class TestGetHandler(shared.TestHandler):
         assert actual == (None, 0)
         mock_basic.assert_called_with(resource_id=resource_id, query=query)
 
-    @mock.patch('abbot.complex_handler.ComplexHandler.make_extra_fields')
     @mock.patch('abbot.complex_handler.ComplexHandler.look_up_xrefs')
     @mock.patch('abbot.complex_handler.ComplexHandler.basic_get')
     @testing.gen_test
-    def test_normal_behaviour_1(self, mock_basic, mock_xrefs, mock_extra):
+    def test_normal_behaviour_1(self, mock_basic, mock_xrefs):
         '''
         A request that goes normally.
 
         - self.hparams['include_resources'] is True
-        # - output doesn't include "resources"
-        # - self.look_up_xrefs() is called with every record
-        # - self.make_extra_fields() is called with the output of look_up_xrefs()
-        # - a returned resource is whatever make_extra_fields() returns
+        - self.look_up_xrefs() is called with the output of basic_get()
+        - the returned resources are whatever look_up_xrefs() returns
         '''
         self.handler.hparams['include_resources'] = True
-        mock_basic.return_value = shared.make_future(
-            ({'sort_order': ['1', '2', '3'], 'resources': 'res', '1': 'r1', '2': 'r2', '3': 'r3'}, 23))
-        mock_xrefs.side_effect = lambda res, incl: shared.make_future(
-            {'sort_order': ['1', '2', '3'], 'resources': 'res', '1': 'r1x', '2': 'r2x', '3': 'r3x'})
-        # returns like 'r1xx'
-        mock_extra.side_effect = lambda x, y: shared.make_future('{}x'.format(x))
+        basic_results = {'sort_order': ['1', '2', '3'], 'resources': 'res', '1': 'r1', '2': 'r2', '3': 'r3'}
+        mock_basic.return_value = shared.make_future((basic_results, 23))
+        expected = {'sort_order': ['1', '2', '3'], 'resources': 'res', '1': 'r1x', '2': 'r2x', '3': 'r3x'}
+        mock_xrefs.return_value = shared.make_future(expected)
 
         actual = yield self.handler.get_handler()
 
         assert actual[1] == 23
-        assert actual[0] == {
-            '1': 'r1xx',
-            '2': 'r2xx',
-            '3': 'r3xx',
-            'resources': 'res',
-            'sort_order': ['1', '2', '3'],
-        }
+        assert actual[0] == expected
         mock_basic.assert_called_once_with(resource_id=None, query=None)
-        # mock_xrefs.assert_called_once_with((yield mock_basic.return_value)[0], True)
-        assert mock_extra.call_count == 3
-        mock_extra.assert_any_call('r1x', 'r1')
-        mock_extra.assert_any_call('r2x', 'r2')
-        mock_extra.assert_any_call('r3x', 'r3')
+        mock_xrefs.assert_called_once_with(basic_results, True)
 
-    @mock.patch('abbot.complex_handler.ComplexHandler.make_extra_fields')
     @mock.patch('abbot.complex_handler.ComplexHandler.look_up_xrefs')
     @mock.patch('abbot.complex_handler.ComplexHandler.basic_get')
     @testing.gen_test
-    def test_normal_behaviour_2(self, mock_basic, mock_xrefs, mock_extra):
+    def test_normal_behaviour_2(self, mock_basic, mock_xrefs):
         '''
         Same as def test_normal_behaviour_1() BUT self.hparams['include_resources'] is False.
         '''
         self.handler.hparams['include_resources'] = False
-        mock_basic.return_value = shared.make_future(
-            ({'sort_order': ['1', '2', '3'], '1': 'r1', '2': 'r2', '3': 'r3'}, 23))
-        mock_xrefs.side_effect = lambda res, incl: shared.make_future(
-            {'sort_order': ['1', '2', '3'], '1': 'r1x', '2': 'r2x', '3': 'r3x'})
-        mock_extra.side_effect = lambda x, y: shared.make_future('{}x'.format(x))
+        basic_results = {'sort_order': ['1', '2', '3'], '1': 'r1', '2': 'r2', '3': 'r3'}
+        mock_basic.return_value = shared.make_future((basic_results, 23))
+        expected = {'sort_order': ['1', '2', '3'], '1': 'r1x', '2': 'r2x', '3': 'r3x'}
+        mock_xrefs.return_value = shared.make_future(expected)
 
         actual = yield self.handler.get_handler()
 
-        assert actual[0] == {
-            '1': 'r1xx',
-            '2': 'r2xx',
-            '3': 'r3xx',
-            'sort_order': ['1', '2', '3'],
-        }
+        assert actual[0] == expected
+        mock_xrefs.assert_called_once_with(basic_results, False)
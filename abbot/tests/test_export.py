@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_export.py
+# Purpose:                Tests for abbot/export.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/export.py of the Abbot server.
+
+The exports themselves are tested with the other GET and SEARCH requests, in
+test_get_integration.py and test_search_integration.py.
+'''
+
+# pylint: disable=no-self-use
+
+from unittest import TestCase
+
+from tornado import escape
+
+from abbot import export
+
+
+class TestChooseFormat(TestCase):
+    '''
+    Tests for abbot.export.choose_format().
+    '''
+
+    def test_no_export(self):
+        "Without an export media type, there is no export."
+        assert export.choose_format(None) is None
+        assert export.choose_format('') is None
+        assert export.choose_format('application/json, */*') is None
+
+    def test_formats(self):
+        "Each export media type is recognized, with or without parameters."
+        assert export.choose_format('application/x-ndjson') is export.NdjsonFormat
+        assert export.choose_format('application/ndjson; charset=UTF-8') is export.NdjsonFormat
+        assert export.choose_format('text/html, TEXT/CSV;q=0.5') is export.CsvFormat
+
+    def test_refused(self):
+        "A media type with q=0 is refused, so the next one is used."
+        assert export.choose_format('text/csv;q=0, application/x-ndjson') is export.NdjsonFormat
+        assert export.choose_format('text/csv; q=0.0') is None
+
+
+class TestFormats(TestCase):
+    '''
+    Tests for abbot.export.NdjsonFormat and abbot.export.CsvFormat.
+    '''
+
+    RECORDS = [{'id': '1', 'type': 'source', 'indexers': ['Ann', 'Bob']},
+               {'id': '2', 'type': 'source', 'title': 'Line\nbreak'}]
+    COLUMNS = ['id', 'type', 'title', 'indexers']
+
+    def test_ndjson(self):
+        "One JSON object per line, with every field."
+        assert export.NdjsonFormat.header(self.COLUMNS) == ''
+        lines = export.NdjsonFormat.rows(self.RECORDS, self.COLUMNS).split(b'\n')
+        assert [escape.json_decode(line) for line in lines[:-1]] == self.RECORDS
+        assert lines[-1] == b''
+
+    def test_csv(self):
+        "One row per record, with missing fields empty and lists joined with '|'."
+        assert export.CsvFormat.header(self.COLUMNS) == 'id,type,title,indexers\r\n'
+        actual = export.CsvFormat.rows(self.RECORDS, self.COLUMNS)
+        assert actual == '1,source,,Ann|Bob\r\n2,source,"Line\nbreak",\r\n'
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_generation.py
+# Purpose:                Tests for abbot/generation.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/generation.py of the Abbot server, and for the "ETag" and "Last-Modified" headers.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+import datetime
+import os.path
+import sqlite3
+import tempfile
+from unittest import mock, TestCase
+
+import pysolrtornado
+from tornado import httputil, testing
+
+from abbot import generation
+from abbot import simple_handler
+import shared
+
+
+LAST_MODIFIED = datetime.datetime(2016, 4, 1, 12, 30, 0, tzinfo=datetime.timezone.utc)
+
+
+class TestGeneration(TestCase):
+    '''
+    Tests for abbot.generation.Generation.update().
+    '''
+
+    def test_update_1(self):
+        "A new tag calls the listeners."
+        gen = generation.Generation()
+        listener = mock.Mock()
+        gen.add_listener(listener)
+        gen.update('1', LAST_MODIFIED)
+        assert gen.tag == '1'
+        assert gen.last_modified == LAST_MODIFIED
+        assert listener.call_count == 1
+
+    def test_update_2(self):
+        "The same tag does not call the listeners."
+        gen = generation.Generation()
+        gen.update('1', LAST_MODIFIED)
+        listener = mock.Mock()
+        gen.add_listener(listener)
+        gen.update('1', LAST_MODIFIED)
+        assert listener.call_count == 0
+
+
+class TestAskUpdatesDb(TestCase):
+    '''
+    Tests for abbot.generation.ask_updates_db().
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tempdir.name, 'updates.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE rtypes (id INTEGER PRIMARY KEY, name TEXT, updated TEXT);')
+        conn.execute('INSERT INTO rtypes (id, name, updated) VALUES (0, "chant", "never");')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_never_updated(self):
+        "When nothing was ever updated, the time is the Unix epoch."
+        tag, last_modified = generation.ask_updates_db(self.db_path)
+        assert last_modified.timestamp() == 0.0
+        assert tag == last_modified.isoformat()
+
+    def test_most_recent(self):
+        "The most recent update time is used."
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('INSERT INTO rtypes (id, name, updated) VALUES (1, "feast", ?);',
+                     (LAST_MODIFIED.isoformat(),))
+        conn.execute('INSERT INTO rtypes (id, name, updated) VALUES (2, "genre", ?);',
+                     ((LAST_MODIFIED - datetime.timedelta(days=1)).isoformat(),))
+        conn.commit()
+        conn.close()
+
+        tag, last_modified = generation.ask_updates_db(self.db_path)
+        assert last_modified == LAST_MODIFIED
+        assert tag == LAST_MODIFIED.isoformat()
+
+    def test_missing_db(self):
+        "A missing database raises sqlite3.Error."
+        with self.assertRaises(sqlite3.Error):
+            generation.ask_updates_db(os.path.join(self.tempdir.name, 'nope.db'))
+
+
+class TestRefresh(shared.TestHandler):
+    '''
+    Tests for abbot.generation.Generation.refresh() and abbot.generation.ask_solr().
+    '''
+
+    def setUp(self):
+        super(TestRefresh, self).setUp()
+        self._gen_options_patcher = mock.patch('abbot.generation.options')
+        self._gen_options = self._gen_options_patcher.start()
+        self._gen_options.updates_db = ''
+
+    def tearDown(self):
+        self._gen_options_patcher.stop()
+        super(TestRefresh, self).tearDown()
+
+    @testing.gen_test
+    def test_solr_1(self):
+        "The index version and time come from Solr's Luke request handler."
+        luke = '{"index": {"version": 1234, "lastModified": "2016-04-01T12:30:00Z"}}'
+        self._solr._send_request = mock.Mock(return_value=shared.make_future(luke))
+        gen = generation.Generation()
+        yield gen.refresh()
+        self._solr._send_request.assert_called_once_with('get', generation._LUKE_PATH)
+        assert gen.tag == '1234'
+        assert gen.last_modified == LAST_MODIFIED
+
+    @mock.patch('abbot.generation.log.warn')
+    @testing.gen_test
+    def test_solr_2(self, mock_warn):
+        "When Solr fails, the previous generation is kept."
+        self._solr._send_request = mock.Mock(side_effect=pysolrtornado.SolrError('test_solr_2()'))
+        gen = generation.Generation()
+        gen.update('1', LAST_MODIFIED)
+        yield gen.refresh()
+        assert gen.tag == '1'
+        assert mock_warn.call_count == 1
+
+    @mock.patch('abbot.generation.log.warn')
+    @testing.gen_test
+    def test_solr_3(self, mock_warn):
+        "When Solr's response is unexpected, the previous generation is kept."
+        self._solr._send_request = mock.Mock(return_value=shared.make_future('{"index": {}}'))
+        gen = generation.Generation()
+        gen.update('1', LAST_MODIFIED)
+        yield gen.refresh()
+        assert gen.tag == '1'
+        assert mock_warn.call_count == 1
+
+    @mock.patch('abbot.generation.ask_updates_db')
+    @testing.gen_test
+    def test_updates_db(self, mock_ask):
+        "When the updates database is set, Solr is not asked."
+        self._gen_options.updates_db = '/var/db/updates.db'
+        mock_ask.return_value = ('x', LAST_MODIFIED)
+        gen = generation.Generation()
+        yield gen.refresh()
+        mock_ask.assert_called_once_with('/var/db/updates.db')
+        assert gen.tag == 'x'
+
+
+class TestValidators(shared.TestHandler):
+    '''
+    Integration tests for the "ETag" and "Last-Modified" response headers, and for conditional
+    requests.
+    '''
+
+    def setUp(self):
+        super(TestValidators, self).setUp()
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('id:7', {'id': '7', 'type': 'genre', 'name': 'seven'})
+        self.url = self.get_url('/genres/7/')
+        generation.CURRENT.update('1', LAST_MODIFIED)
+
+    @testing.gen_test
+    def test_headers(self):
+        "A GET response has both validators."
+        actual = yield self.http_client.fetch(self.url)
+        assert actual.headers['ETag'].startswith('"')
+        assert actual.headers['Last-Modified'] == httputil.format_timestamp(LAST_MODIFIED)
+
+    @testing.gen_test
+    def test_no_generation(self):
+        "When the generation is unknown, Abbot does not set Last-Modified."
+        generation.CURRENT.tag = None
+        actual = yield self.http_client.fetch(self.url)
+        assert 'Last-Modified' not in actual.headers
+
+    @testing.gen_test
+    def test_if_none_match_1(self):
+        "A matching If-None-Match gets a 304 without asking Solr."
+        first = yield self.http_client.fetch(self.url)
+        num_calls = self.solr.search.call_count
+        headers = {'If-None-Match': first.headers['ETag']}
+        actual = yield self.http_client.fetch(self.url, headers=headers, raise_error=False)
+        assert actual.code == 304
+        assert actual.body == b''
+        assert self.solr.search.call_count == num_calls
+
+    @testing.gen_test
+    def test_if_none_match_2(self):
+        "After the generation changes, the old ETag does not match."
+        first = yield self.http_client.fetch(self.url)
+        generation.CURRENT.update('2', LAST_MODIFIED)
+        headers = {'If-None-Match': first.headers['ETag']}
+        actual = yield self.http_client.fetch(self.url, headers=headers, raise_error=False)
+        assert actual.code == 200
+        assert actual.headers['ETag'] != first.headers['ETag']
+
+    @testing.gen_test
+    def test_if_none_match_3(self):
+        "Different request headers give a different ETag."
+        first = yield self.http_client.fetch(self.url)
+        headers = {'X-Cantus-Include-Resources': 'false'}
+        second = yield self.http_client.fetch(self.url, headers=headers)
+        assert first.headers['ETag'] != second.headers['ETag']
+
+    @testing.gen_test
+    def test_if_modified_since_1(self):
+        "An If-Modified-Since that is not older than Last-Modified gets a 304."
+        headers = {'If-Modified-Since': httputil.format_timestamp(LAST_MODIFIED)}
+        actual = yield self.http_client.fetch(self.url, headers=headers, raise_error=False)
+        assert actual.code == 304
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_if_modified_since_2(self):
+        "An older If-Modified-Since gets a 200."
+        headers = {'If-Modified-Since':
+                   httputil.format_timestamp(LAST_MODIFIED - datetime.timedelta(seconds=1))}
+        actual = yield self.http_client.fetch(self.url, headers=headers, raise_error=False)
+        assert actual.code == 200
+
+    @testing.gen_test
+    def test_if_modified_since_3(self):
+        "If-Modified-Since is ignored when there is an If-None-Match."
+        headers = {'If-Modified-Since': httputil.format_timestamp(LAST_MODIFIED),
+                   'If-None-Match': '"nope"'}
+        actual = yield self.http_client.fetch(self.url, headers=headers, raise_error=False)
+        assert actual.code == 200
+
+    @mock.patch('abbot.complex_handler.log.warn')
+    @testing.gen_test
+    def test_partial(self, mock_warn):
+        "A response missing its cross-references after a Solr error has no validators."
+        self.solr.search_se.add('type:source', {'type': 'source', 'id': '999', 'century_id': '830'})
+        self.solr.search_se.add('id:830', {'type': 'century', 'id': '830', 'name': '21st century'})
+        answered = self.solr.search.side_effect
+        def side_effect(query, *args, **kwargs):
+            "Fail the cross-reference lookup."
+            if query.startswith('id:'):
+                raise pysolrtornado.SolrError('test_partial()')
+            return answered(query, *args, **kwargs)
+        self.solr.search = mock.Mock(side_effect=side_effect)
+
+        actual = yield self.http_client.fetch(self.get_url('/sources/'))
+
+        assert actual.headers['X-Cantus-Partial'] == 'xrefs'
+        assert 'ETag' not in actual.headers
+        assert 'Last-Modified' not in actual.headers
+        assert len(simple_handler.RESPONSE_CACHE) == 0
+        assert mock_warn.call_count == 1
+
+        # once Solr answers, the response is complete and has validators again
+        self.solr.search.side_effect = answered
+        actual = yield self.http_client.fetch(self.get_url('/sources/'))
+        assert 'X-Cantus-Partial' not in actual.headers
+        assert 'ETag' in actual.headers
+
+    @testing.gen_test
+    def test_generation_clears_cache(self):
+        "When the generation changes, the response cache is emptied."
+        yield self.http_client.fetch(self.url)
+        num_calls = self.solr.search.call_count
+        generation.CURRENT.update('2', LAST_MODIFIED)
+        yield self.http_client.fetch(self.url)
+        assert self.solr.search.call_count > num_calls
@@ -35,8 +35,9 @@ Integration tests for GET requests in SimpleHandler and ComplexHandler.
 
 from unittest import mock
 
-from tornado import escape, testing
+from tornado import concurrent, escape, httpclient, testing, web
 import pysolrtornado
+import pytest
 
 import abbot
 from abbot import simple_handler
@@ -83,6 +84,7 @@ class TestSimple(shared.TestHandler):
         - -Total-Results response header is set properly
         - "sort_order" is correct as per what Solr returns
         - it returns properly-formatted output
+        - "Vary: Accept" is set, since "Accept" may ask for an export instead
         - the default "resources" behaviour is checked later
         '''
         self.add_default_resources()
@@ -91,6 +93,7 @@ class TestSimple(shared.TestHandler):
 
         self.check_standard_header(actual)
         assert actual.headers['X-Cantus-Total-Results'] == '3'
+        assert actual.headers['Vary'] == 'Accept'
         actual = escape.json_decode(actual.body)
         assert ['6', '2', '9'] == actual['sort_order']
         assert {'id': '6', 'name': 'six', 'type': self._type[0]} == actual['6']
@@ -122,10 +125,12 @@ class TestSimple(shared.TestHandler):
         # the query is modified before submission for a SEARCH query
         if self._method == 'SEARCH':
             self.solr.search.assert_any_call('type:{}  AND  ( *  ) '.format(self._type[0]),
-                sort='id desc', start=4, rows=4, df='default_search')
+                sort='id desc', start=4, rows=4, df='default_search',
+                fl=shared.solr_fields(self._type[0]))
         else:
             self.solr.search.assert_any_call('+type:{} +id:*'.format(self._type[0]),
-                sort='id desc', start=4, rows=4, df='default_search')
+                sort='id desc', start=4, rows=4, df='default_search',
+                fl=shared.solr_fields(self._type[0]))
 
     @testing.gen_test
     def test_view_request(self):
@@ -250,6 +255,8 @@ class TestSimple(shared.TestHandler):
         actual = escape.json_decode(actual.body)
         for each_id in exp_order:
             assert 'name' not in actual[each_id]
+        # only the requested fields are asked of Solr
+        assert self.solr.search.call_args[1]['fl'] == 'id,type,drupal_path'
 
     @testing.gen_test
     def test_resource_id_not_found(self):
@@ -269,7 +276,8 @@ class TestSimple(shared.TestHandler):
                                               method='GET',
                                               raise_error=False)
 
-        self.solr.search.assert_called_with('+type:{0} +id:{1}'.format(self._type[0], resource_id), df='default_search')
+        self.solr.search.assert_called_with('+type:{0} +id:{1}'.format(self._type[0], resource_id), df='default_search',
+                                            fl=shared.solr_fields(self._type[0]))
         self.check_standard_header(actual)
         assert 404 == actual.code
         assert expected_reason == actual.reason
@@ -317,6 +325,260 @@ class TestSimple(shared.TestHandler):
         self.assertEqual(slash.headers, noslash.headers)
         self.assertEqual(slash.body, noslash.body)
 
+    @testing.gen_test
+    def test_response_cache(self):
+        '''
+        - the same request twice is only sent to Solr once, with the same response
+        - a request with different request headers is sent to Solr
+        '''
+        self.add_default_resources()
+        headers = {'X-Cantus-Per-Page': '2'}
+
+        first = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+        num_calls = self.solr.search.call_count
+        second = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert num_calls == self.solr.search.call_count
+        assert first.body == second.body
+        for header in ('X-Cantus-Total-Results', 'X-Cantus-Per-Page', 'X-Cantus-Page',
+                       'X-Cantus-Include-Resources', 'Content-Type'):
+            assert first.headers[header] == second.headers[header]
+
+        headers['X-Cantus-Per-Page'] = '3'
+        yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+        assert num_calls < self.solr.search.call_count
+
+    @testing.gen_test
+    def test_fragment_cache(self):
+        '''
+        - after a request, its resources are in the FRAGMENT_CACHE
+        - a different request for the same resources doesn't format them again
+        - the response is the same as without the cache, including the X-Cantus-Fields header
+        '''
+        self.add_default_resources()
+        headers = {'X-Cantus-Per-Page': '3'}
+
+        yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+        assert len(simple_handler.FRAGMENT_CACHE) == 3
+
+        headers['X-Cantus-Per-Page'] = '4'
+        with mock.patch.object(simple_handler.SimpleHandler, 'format_record', autospec=True,
+                               side_effect=simple_handler.SimpleHandler.format_record) as mock_format:
+            cached = yield self.http_client.fetch(self._browse_url, method=self._method,
+                allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+        assert mock_format.call_count == 0
+
+        simple_handler.RESPONSE_CACHE.clear()
+        simple_handler.FRAGMENT_CACHE.clear()
+        uncached = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+        assert escape.json_decode(cached.body) == escape.json_decode(uncached.body)
+        assert cached.headers['X-Cantus-Fields'] == uncached.headers['X-Cantus-Fields']
+
+    def add_cursor_results(self, docs, num_found, next_cursor):
+        '''
+        Make Solr return the same "docs" for every query, with a "nextCursorMark."
+        '''
+        results = pysolrtornado.Results({'response': {'numFound': num_found, 'docs': docs},
+                                         'nextCursorMark': next_cursor})
+        self.solr.search = mock.Mock(side_effect=lambda *args, **kwargs: shared.make_future(results))
+
+    @testing.gen_test
+    def test_cursor_1(self):
+        '''
+        - X-Cantus-Cursor is sent to Solr as "cursorMark," without "start," and with an "id" sort
+        - a full page gets an X-Cantus-Cursor for the next page, and no X-Cantus-Page
+        '''
+        docs = [{'id': '6', 'name': 'six', 'type': self._type[0]},
+                {'id': '2', 'name': 'two', 'type': self._type[0]}]
+        self.add_cursor_results(docs, 5, 'AoE/Mg==')
+        headers = {'X-Cantus-Cursor': '*', 'X-Cantus-Per-Page': '2', 'X-Cantus-Sort': 'name;asc'}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert actual.headers['X-Cantus-Cursor'] == 'AoE/Mg=='
+        assert 'X-Cantus-Page' not in actual.headers
+        assert actual.headers['X-Cantus-Total-Results'] == '5'
+        assert escape.json_decode(actual.body)['sort_order'] == ['6', '2']
+        kwargs = self.solr.search.call_args_list[0][1]
+        assert kwargs['cursorMark'] == '*'
+        assert kwargs['sort'] == 'name asc,id asc'
+        assert 'start' not in kwargs
+
+    @testing.gen_test
+    def test_cursor_2(self):
+        "The last page has no X-Cantus-Cursor."
+        docs = [{'id': '6', 'name': 'six', 'type': self._type[0]}]
+        self.add_cursor_results(docs, 3, 'AoE/Ng==')
+        headers = {'X-Cantus-Cursor': 'AoE/Mg==', 'X-Cantus-Per-Page': '2'}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert 'X-Cantus-Cursor' not in actual.headers
+        assert self.solr.search.call_args_list[0][1]['cursorMark'] == 'AoE/Mg=='
+
+    @testing.gen_test
+    def test_cursor_3(self):
+        "A cursor after the last result gets a 409."
+        self.add_cursor_results([], 3, 'AoE/Mg==')
+        headers = {'X-Cantus-Cursor': 'AoE/Mg=='}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers,
+            raise_error=False)
+
+        self.assertEqual(409, actual.code)
+        self.assertEqual(simple_handler._CURSOR_AT_END, actual.reason)
+
+    @testing.gen_test
+    def test_cursor_4(self):
+        "Responses for different cursors are cached separately."
+        docs = [{'id': '6', 'name': 'six', 'type': self._type[0]}]
+        self.add_cursor_results(docs, 3, 'AoE/Ng==')
+
+        for cursor in ('*', 'AoE/Mg==', '*'):
+            yield self.http_client.fetch(self._browse_url, method=self._method,
+                allow_nonstandard_methods=True, body=b'{"query":"*"}',
+                headers={'X-Cantus-Cursor': cursor})
+
+        cursors = [call[1]['cursorMark'] for call in self.solr.search.call_args_list
+                   if 'cursorMark' in call[1]]
+        assert cursors == ['*', 'AoE/Mg==']
+
+    def add_export_batches(self):
+        '''
+        Make Solr return three resources in two batches, as when asked with a cursor.
+        '''
+        docs = [{'id': '6', 'name': 'six', 'type': self._type[0]},
+                {'id': '2', 'name': 'two', 'type': self._type[0]},
+                {'id': '9', 'name': 'nine, or "nein"', 'type': self._type[0]}]
+        batches = [pysolrtornado.Results({'response': {'numFound': 3, 'docs': docs[:2]},
+                                          'nextCursorMark': 'AoE/Mg=='}),
+                   pysolrtornado.Results({'response': {'numFound': 3, 'docs': docs[2:]},
+                                          'nextCursorMark': 'AoE/OQ=='})]
+        self.solr.search = mock.Mock(side_effect=[shared.make_future(x) for x in batches])
+
+    @mock.patch('abbot.export.options')
+    @testing.gen_test
+    def test_export_ndjson(self, mock_options):
+        '''
+        - an NDJSON export has every resource, one per line, fetched in batches with a cursor
+        - X-Cantus-Page and X-Cantus-Per-Page are ignored
+        - "Vary: Accept" is set, since the same URL also gives JSON
+        '''
+        mock_options.export_batch_size = 2
+        self.add_export_batches()
+        headers = {'Accept': 'application/x-ndjson', 'X-Cantus-Page': '4', 'X-Cantus-Per-Page': '1'}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        self.check_standard_header(actual)
+        assert actual.headers['Content-Type'] == 'application/x-ndjson; charset=UTF-8'
+        assert actual.headers['X-Cantus-Total-Results'] == '3'
+        assert actual.headers['Vary'] == 'Accept'
+        lines = actual.body.decode('utf-8').split('\n')
+        assert lines[-1] == ''
+        assert [escape.json_decode(line)['id'] for line in lines[:-1]] == ['6', '2', '9']
+        assert 'resources' not in escape.json_decode(lines[0])
+        cursors = [call[1]['cursorMark'] for call in self.solr.search.call_args_list]
+        assert cursors == ['*', 'AoE/Mg==']
+        assert all(call[1]['rows'] == 2 for call in self.solr.search.call_args_list)
+
+    @mock.patch('abbot.export.options')
+    @testing.gen_test
+    def test_export_csv(self, mock_options):
+        "A CSV export has a header row, then one row per resource."
+        mock_options.export_batch_size = 2
+        self.add_export_batches()
+        headers = {'Accept': 'text/csv', 'X-Cantus-Fields': 'name'}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert actual.headers['Content-Type'] == 'text/csv; charset=UTF-8'
+        assert actual.body.decode('utf-8').split('\r\n') == [
+            'name,id,type',
+            'six,6,{}'.format(self._type[0]),
+            'two,2,{}'.format(self._type[0]),
+            '"nine, or ""nein""",9,{}'.format(self._type[0]),
+            '',
+        ]
+
+    @mock.patch('abbot.export.options')
+    @testing.gen_test
+    def test_export_fails_later(self, mock_options):
+        "When a later batch fails, the connection is closed so the export is visibly incomplete."
+        mock_options.export_batch_size = 2
+        self.add_export_batches()
+        first = next(self.solr.search.side_effect)
+        self.solr.search.side_effect = [first, pysolrtornado.SolrError('second batch')]
+        headers = {'Accept': 'application/x-ndjson'}
+
+        with pytest.raises(httpclient.HTTPError) as exc:
+            yield self.http_client.fetch(self._browse_url, method=self._method,
+                allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert exc.value.code == 599
+
+    @mock.patch('abbot.export.options')
+    @testing.gen_test
+    def test_export_past_deadline(self, mock_options):
+        "An export is not bound by the request deadline, even when a batch answers after it."
+        mock_options.export_batch_size = 2
+        self._simple_options.request_deadline = 0.05
+        self.add_export_batches()
+        first, second = self.solr.search.side_effect
+        late = concurrent.Future()
+        self.io_loop.call_later(0.15, lambda: late.set_result(second.result()))
+        self.solr.search.side_effect = [first, late]
+        headers = {'Accept': 'application/x-ndjson'}
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
+
+        assert actual.code == 200
+        lines = actual.body.decode('utf-8').split('\n')
+        assert [escape.json_decode(line)['id'] for line in lines[:-1]] == ['6', '2', '9']
+
+    @mock.patch('abbot.export.options')
+    @testing.gen_test
+    def test_export_record_fields(self, mock_options):
+        "An export keeps no per-resource state between batches, since it uses no fragments."
+        mock_options.export_batch_size = 2
+        self.add_export_batches()
+        sizes = []
+
+        def flush(handler, *args, **kwargs):
+            "Note how much per-resource state the handler holds after each batch."
+            sizes.append((len(handler.record_fields), len(handler.partial_records)))
+            return web.RequestHandler.flush(handler, *args, **kwargs)
+
+        with mock.patch.object(simple_handler.SimpleHandler, 'flush', autospec=True,
+                               side_effect=flush):
+            yield self.http_client.fetch(self._browse_url, method=self._method,
+                allow_nonstandard_methods=True, body=b'{"query":"*"}',
+                headers={'Accept': 'application/x-ndjson'})
+
+        assert len(sizes) >= 2
+        assert set(sizes) == {(0, 0)}
+
+    @testing.gen_test
+    def test_export_no_results(self):
+        "An export with no results gets the usual 404, which still varies on \"Accept\"."
+        headers = {'Accept': 'text/csv'}
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers,
+            raise_error=False)
+        assert actual.code == 404
+        assert actual.headers['Vary'] == 'Accept'
+
     @testing.gen_test
     def test_cors_success(self):
         '''
@@ -331,7 +593,7 @@ class TestSimple(shared.TestHandler):
         actual = yield self.http_client.fetch(self._browse_url, method=self._method,
             allow_nonstandard_methods=True, body=b'{"query":"*"}', headers=headers)
 
-        assert 'Origin' == actual.headers['Vary']
+        assert actual.headers.get_list('Vary') == ['Origin', 'Accept']
         assert exp_expose_headers == actual.headers['Access-Control-Expose-Headers']
         assert exp_allow_origin == actual.headers['Access-Control-Allow-Origin']
 
@@ -580,6 +842,22 @@ class TestComplex(TestSimple):
         assert 'century' not in actual['498']
         assert 'century_id' not in actual['498']
 
+    @testing.gen_test
+    def test_xref_missing_not_cached(self):
+        '''
+        - a resource with a cross-reference that wasn't found is not put in the FRAGMENT_CACHE
+        '''
+        # NOTE: this "view" request doesn't apply for SEARCH
+        if self._method == 'SEARCH':
+            return
+
+        self.add_resource_complex()
+
+        yield self.http_client.fetch(self.get_url('/sources/498/'), method='GET')
+        assert len(simple_handler.FRAGMENT_CACHE) == 0
+        yield self.http_client.fetch(self.get_url('/sources/842/'), method='GET')
+        assert len(simple_handler.FRAGMENT_CACHE) == 1
+
     @testing.gen_test
     def test_xref_request_fails(self):
         '''
@@ -614,6 +892,23 @@ class TestComplex(TestSimple):
             '234': {'id': '234', 'type': 'source'},
         }
 
+    @mock.patch('abbot.complex_handler.log.warn')
+    @testing.gen_test
+    def test_export_missing_xrefs(self, mock_warn):
+        "An export batch whose cross-references could not be looked up is an error."
+        docs = [{'id': '123', 'type': 'source', 'century_id': '61'}]
+        batch = pysolrtornado.Results({'response': {'numFound': 1, 'docs': docs},
+                                       'nextCursorMark': 'AoE/Mg=='})
+        self.solr.search = mock.Mock(side_effect=[shared.make_future(batch),
+                                                  pysolrtornado.SolrError('xrefs')])
+
+        actual = yield self.http_client.fetch(self._browse_url, method=self._method,
+            allow_nonstandard_methods=True, body=b'{"query":"*"}',
+            headers={'Accept': 'application/x-ndjson'}, raise_error=False)
+
+        assert actual.code == 502
+        assert actual.reason == simple_handler._SOLR_502_ERROR
+
 
 class TestBadRequestHeadersSimple(shared.TestHandler):
     '''
@@ -694,10 +989,10 @@ class TestBadRequestHeadersSimple(shared.TestHandler):
         # the SEARCH query gets modified before it hits Solr
         if self._method == 'SEARCH':
             self.solr.search.assert_called_with('type:{}  AND  (  +id:*  ) '.format(self._type[0]), start=90,
-                rows=10, df='default_search')
+                rows=10, df='default_search', fl=shared.solr_fields(self._type[0]))
         else:
             self.solr.search.assert_called_with('+type:{} +id:*'.format(self._type[0]), start=90,
-                rows=10, df='default_search')
+                rows=10, df='default_search', fl=shared.solr_fields(self._type[0]))
         self.check_standard_header(actual)
         self.assertEqual(409, actual.code)
         self.assertEqual(simple_handler._TOO_LARGE_PAGE, actual.reason)
@@ -717,6 +1012,36 @@ class TestBadRequestHeadersSimple(shared.TestHandler):
         self.assertEqual(400, actual.code)
         self.assertEqual(simple_handler._TOO_SMALL_PAGE, actual.reason)
 
+    @testing.gen_test
+    def test_cursor_1(self):
+        "returns 400 when X-Cantus-Cursor is not a cursor"
+        actual = yield self.http_client.fetch(self._browse_url,
+                                              method=self._method,
+                                              allow_nonstandard_methods=True,
+                                              raise_error=False,
+                                              headers={'X-Cantus-Cursor': 'next page'},
+                                              body=b'{"query":""}')
+
+        assert 0 == self.solr.search.call_count
+        self.check_standard_header(actual)
+        self.assertEqual(400, actual.code)
+        self.assertEqual(simple_handler._INVALID_CURSOR, actual.reason)
+
+    @testing.gen_test
+    def test_cursor_2(self):
+        "returns 400 when there are both X-Cantus-Cursor and X-Cantus-Page"
+        actual = yield self.http_client.fetch(self._browse_url,
+                                              method=self._method,
+                                              allow_nonstandard_methods=True,
+                                              raise_error=False,
+                                              headers={'X-Cantus-Cursor': '*', 'X-Cantus-Page': '2'},
+                                              body=b'{"query":""}')
+
+        assert 0 == self.solr.search.call_count
+        self.check_standard_header(actual)
+        self.assertEqual(400, actual.code)
+        self.assertEqual(simple_handler._CURSOR_WITH_PAGE, actual.reason)
+
     @testing.gen_test
     def test_fields_1(self):
         "returns 400 when X-Cantus-Fields has a field name that doesn't exist"
@@ -782,7 +1107,6 @@ class TestBadRequestHeadersSimple(shared.TestHandler):
         actual = escape.json_decode(actual.body)
         assert '7' in actual
 
-
 class TestBadRequestHeadersComplex(TestBadRequestHeadersSimple):
     '''
     Runs the TestBadRequestHeadersSimple tests with a ComplexHandler.
@@ -38,11 +38,15 @@ import pysolrtornado
 from tornado import httpclient, testing
 
 from abbot.complex_handler import ComplexHandler
-from abbot import simple_handler
+from abbot import serialize, simple_handler
 from abbot.simple_handler import SimpleHandler
 import shared
 
 
+_FL = 'id,type,name,description,drupal_path'
+# the "fl" parameter that a handler for "century" resources sends to Solr
+
+
 class TestBasicGetSimple(shared.TestHandler):
     '''
     Unit tests for the SimpleHandler.basic_get().
@@ -87,7 +91,7 @@ class TestBasicGetSimple(shared.TestHandler):
         yield self.handler.basic_get()
 
         self.solr.search.assert_called_with('+type:century +id:*', start=15, rows=5, sort='roar',
-            df='default_search')
+            df='default_search', fl=_FL)
 
     @testing.gen_test
     def test_prep_and_run_2(self):
@@ -102,7 +106,7 @@ class TestBasicGetSimple(shared.TestHandler):
 
         yield self.handler.basic_get(resource_id=resource_id)
 
-        self.solr.search.assert_called_with('+type:century +id:911', df='default_search')
+        self.solr.search.assert_called_with('+type:century +id:911', df='default_search', fl=_FL)
 
     @testing.gen_test
     def test_prep_and_run_3(self):
@@ -116,7 +120,7 @@ class TestBasicGetSimple(shared.TestHandler):
 
         yield self.handler.basic_get(resource_id=resource_id, query=query)
 
-        self.solr.search.assert_called_with(query, df='default_search')
+        self.solr.search.assert_called_with(query, df='default_search', fl=_FL)
 
     @testing.gen_test
     def test_prep_and_run_4(self):
@@ -135,7 +139,7 @@ class TestBasicGetSimple(shared.TestHandler):
 
         yield self.handler.basic_get(resource_id=resource_id, query=query)
 
-        self.solr.search.assert_called_with(query, start=15, rows=5, sort='roar', df='default_search')
+        self.solr.search.assert_called_with(query, start=15, rows=5, sort='roar', df='default_search', fl=_FL)
 
     @testing.gen_test
     def test_prep_and_run_5(self):
@@ -409,7 +413,7 @@ class TestGetSimple(shared.TestHandler):
         self.mock_ghandler.return_value = shared.make_future(('yo', 5))
         yield self.handler.get()
         self.mock_mrh.assert_called_with(True, 5)
-        self.handler.write.assert_called_with('yo')
+        self.handler.write.assert_called_with(serialize.encode('yo'))
 
     @testing.gen_test
     def test_works_is_head(self):
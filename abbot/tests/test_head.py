@@ -57,7 +57,8 @@ class TestSimpleIntegration(shared.TestHandler):
 
         actual = yield self.http_client.fetch(self.get_url('/centuries/'), method='HEAD')
 
-        self.solr.search.assert_called_once_with('+type:century +id:*', df='default_search', rows=10)
+        self.solr.search.assert_called_once_with('+type:century +id:*', df='default_search', rows=10,
+                                                 fl=shared.solr_fields('century'))
         self.check_standard_header(actual)
         self.assertEqual('true', actual.headers['X-Cantus-Include-Resources'])
         self.assertEqual('3', actual.headers['X-Cantus-Total-Results'])
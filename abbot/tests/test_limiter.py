@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_limiter.py
+# Purpose:                Tests for abbot/limiter.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/limiter.py of the Abbot server.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+import random
+from unittest import TestCase, mock
+
+import pytest
+from tornado import gen, testing
+
+from abbot import limiter
+
+
+class TestAcquire(testing.AsyncTestCase):
+    '''
+    Tests for AdaptiveLimiter.acquire() and release().
+    '''
+
+    def setUp(self):
+        super(TestAcquire, self).setUp()
+        self.limiter = limiter.AdaptiveLimiter(2, queue_size=1)
+
+    @testing.gen_test
+    def test_acquire_1(self):
+        "Queries start at once up to the limit, then wait until another is released."
+        yield self.limiter.acquire()
+        yield self.limiter.acquire()
+        waiting = self.limiter.acquire()
+        assert not waiting.done()
+        assert self.limiter.queued == 1
+        self.limiter.release()
+        yield waiting
+        assert self.limiter.in_flight == 2
+        assert self.limiter.queued == 0
+
+    @testing.gen_test
+    def test_acquire_2(self):
+        "When the queue is full, QueueFull is raised at once and counted."
+        yield self.limiter.acquire()
+        yield self.limiter.acquire()
+        self.limiter.acquire()
+        with pytest.raises(limiter.QueueFull):
+            yield self.limiter.acquire()
+        assert self.limiter.stats() == {'limit': 2, 'in_flight': 2, 'queued': 1, 'rejected': 1}
+
+    @testing.gen_test
+    def test_acquire_3(self):
+        "A query that waits past its deadline leaves the queue."
+        yield self.limiter.acquire()
+        yield self.limiter.acquire()
+        with pytest.raises(gen.TimeoutError):
+            yield self.limiter.acquire(deadline=self.io_loop.time() + 0.01)
+        assert self.limiter.queued == 0
+        self.limiter.release()
+        assert self.limiter.in_flight == 1
+
+
+class TestAdapt(TestCase):
+    '''
+    Tests for how AdaptiveLimiter.release() changes the limit.
+    '''
+
+    def release(self, the_limiter, started, finished, failed=False, kind=None):
+        "Release a query that was started and finished at these times."
+        with mock.patch('abbot.limiter.time.monotonic', return_value=finished):
+            the_limiter.release(started, failed=failed, kind=kind)
+
+    def warm_up(self, the_limiter, kind=None, latency=0.1):
+        "Release enough queries of this ``kind`` that their usual latency is ``latency``."
+        in_flight = the_limiter.in_flight
+        for i in range(20):
+            the_limiter.in_flight = in_flight
+            self.release(the_limiter, i - 100.0, i - 100.0 + latency, kind=kind)
+
+    def test_adapt_1(self):
+        "Fast queries grow the limit while at least half of it is used, up to the largest limit."
+        the_limiter = limiter.AdaptiveLimiter(4)
+        the_limiter.limit = 2.0
+        the_limiter.in_flight = 3
+        self.release(the_limiter, 0.0, 0.1)
+        assert the_limiter.limit == 2.5
+        for i in range(20):
+            the_limiter.in_flight = 3
+            self.release(the_limiter, float(i), i + 0.1)
+        assert the_limiter.limit == 4.0
+
+    def test_adapt_2(self):
+        "The limit does not grow while less than half of it is used."
+        the_limiter = limiter.AdaptiveLimiter(4)
+        the_limiter.limit = 3.0
+        the_limiter.in_flight = 1
+        self.release(the_limiter, 0.0, 0.1)
+        assert the_limiter.limit == 3.0
+
+    def test_adapt_3(self):
+        "A slow query shrinks the limit, once for all the queries started before the decrease."
+        the_limiter = limiter.AdaptiveLimiter(10, smoothing=1.0)
+        the_limiter.in_flight = 5
+        self.warm_up(the_limiter)
+        self.release(the_limiter, 1.0, 2.0)
+        assert the_limiter.limit == 9.0
+        self.release(the_limiter, 1.5, 2.5)
+        assert the_limiter.limit == 9.0
+        self.release(the_limiter, 3.0, 4.0)
+        assert the_limiter.limit == 8.1
+
+    def test_adapt_4(self):
+        "The limit does not shrink below the smallest limit."
+        the_limiter = limiter.AdaptiveLimiter(2, min_limit=1, smoothing=1.0)
+        the_limiter.in_flight = 30
+        self.warm_up(the_limiter)
+        for i in range(1, 10):
+            self.release(the_limiter, i * 2.0, i * 2.0 + 1.0)
+        assert the_limiter.limit == 1.0
+        assert the_limiter.stats()['limit'] == 1
+
+    def test_adapt_5(self):
+        "A failed query is not the usual latency, and a query that was not sent changes nothing."
+        the_limiter = limiter.AdaptiveLimiter(10)
+        the_limiter.in_flight = 3
+        self.release(the_limiter, 0.0, 0.001, failed=True)
+        assert the_limiter._usual == {}
+        the_limiter.release()
+        assert the_limiter.limit == 10.0
+        assert the_limiter.in_flight == 1
+
+    def test_adapt_6(self):
+        "The usual latency follows lasting changes, and a failed query only counts as recent."
+        the_limiter = limiter.AdaptiveLimiter(10, window=2, smoothing=0.5)
+        the_limiter.in_flight = 10
+        self.release(the_limiter, 0.0, 0.1)
+        self.release(the_limiter, 1.0, 1.5)
+        self.release(the_limiter, 2.0, 2.5)
+        assert the_limiter._usual[None] == pytest.approx(0.4)
+        assert the_limiter._recent[None] == pytest.approx(0.4)
+        self.release(the_limiter, 3.0, 3.2, failed=True)
+        assert the_limiter._usual[None] == pytest.approx(0.4)
+        assert the_limiter._recent[None] == pytest.approx(0.3)
+
+    def test_adapt_7(self):
+        "Every kind of query has its own usual latency."
+        the_limiter = limiter.AdaptiveLimiter(10, smoothing=1.0)
+        the_limiter.in_flight = 10
+        self.warm_up(the_limiter, kind='Xref.lookup', latency=0.002)
+        self.warm_up(the_limiter, kind='basic_get', latency=0.1)
+        self.release(the_limiter, 2.0, 2.002, kind='Xref.lookup')
+        assert the_limiter.limit == 10.0
+        self.release(the_limiter, 3.0, 3.3, kind='basic_get')
+        assert the_limiter.limit == 9.0
+
+    def test_adapt_8(self):
+        '''
+        With a healthy mix of fast and slow queries, the limit stays at the largest limit, but it
+        still shrinks when every query slows down.
+        '''
+        the_limiter = limiter.AdaptiveLimiter(20)
+        rng = random.Random(8)
+        latencies = {'basic_get': (0.002, 0.030), 'Xref.lookup': (0.001, 0.003),
+                     'run_subqueries': (0.001,) * 9 + (0.020,), 'TaxonomyStore.load': (0.5,)}
+        kinds = ['basic_get'] * 10 + ['Xref.lookup'] * 5 + ['run_subqueries'] * 5 + \
+            ['TaxonomyStore.load']
+
+        def run(slowdown):
+            "Release 2000 queries from 15 clients, returning the lowest limit on the way."
+            lowest = the_limiter.limit
+            for i in range(2000):
+                kind = rng.choice(kinds)
+                started = slowdown * 100.0 + i * 0.01
+                the_limiter.in_flight = 15
+                self.release(the_limiter, started, started + rng.choice(latencies[kind]) * slowdown,
+                             kind=kind)
+                lowest = min(lowest, the_limiter.limit)
+            return lowest
+
+        assert run(1) == 20.0
+        assert run(5) < 20.0
+
+
+class TestFromOptions(TestCase):
+    '''
+    Tests for limiter.from_options().
+    '''
+
+    @mock.patch('abbot.limiter.options')
+    def test_from_options_1(self, mock_options):
+        "The largest limit is the number of connections to Solr."
+        mock_options.solr_adaptive_limit = True
+        mock_options.solr_max_clients = 8
+        mock_options.solr_queue_size = 30
+        mock_options.solr_latency_tolerance = 3.0
+        actual = limiter.from_options()
+        assert (actual.limit, actual.max_limit, actual.queue_size, actual.tolerance) == \
+            (8.0, 8, 30, 3.0)
+
+    @mock.patch('abbot.limiter.options')
+    def test_from_options_2(self, mock_options):
+        "There is no limiter when \"solr_adaptive_limit\" is False."
+        mock_options.solr_adaptive_limit = False
+        assert limiter.from_options() is None
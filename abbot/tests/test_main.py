@@ -31,12 +31,17 @@ Tests for the __main__ module.
 # pylint: disable=too-many-public-methods
 
 import logging
+import os
+import socket
+import tempfile
 from unittest import mock
 
 import pytest
+from tornado import escape, web
 from tornado.options import Error as OptionsError
 
 from abbot import __main__ as main
+from abbot import handlers, metrics, simple_handler
 
 
 class TestLoadOptions(object):
@@ -194,3 +199,141 @@ class TestSetAddresses(object):
         mock_options.ciphers = 'ff'
         main._set_addresses()
         assert mock_options.server_name == 'https://com.com:4000/'
+
+
+class TestNumWorkers(object):
+    '''
+    Tests for _num_workers().
+    '''
+
+    @mock.patch('abbot.__main__.options')
+    def test_1(self, mock_options):
+        '''
+        The "workers" option is used.
+        '''
+        mock_options.workers = 4
+        assert main._num_workers() == 4
+
+    @mock.patch('abbot.__main__.options')
+    def test_2(self, mock_options):
+        '''
+        Zero means one per CPU core, which is up to Tornado.
+        '''
+        mock_options.workers = 0
+        assert main._num_workers() == 0
+
+    @mock.patch('abbot.__main__.options')
+    def test_3(self, mock_options):
+        '''
+        An invalid number of workers starts one.
+        '''
+        mock_options.workers = -2
+        assert main._num_workers() == 1
+
+
+class TestSocketActivation(object):
+    '''
+    Tests for _socket_activated() and _bind_sockets() with a socket from systemd.
+    '''
+
+    def test_activated(self):
+        "systemd socket activation names this process in LISTEN_PID"
+        with mock.patch.dict('os.environ', {'LISTEN_PID': str(os.getpid())}):
+            assert main._socket_activated() is True
+        with mock.patch.dict('os.environ', {'LISTEN_PID': str(os.getpid() + 1)}):
+            assert main._socket_activated() is False
+        with mock.patch.dict('os.environ', clear=True):
+            assert main._socket_activated() is False
+
+    def check_family(self, family, address):
+        "the socket inherited from systemd keeps its address family"
+        try:
+            original = socket.socket(family, socket.SOCK_STREAM)
+        except OSError:
+            pytest.skip('no socket of this family here')
+        with original:
+            try:
+                original.bind(address if family == socket.AF_UNIX else (address, 0))
+            except OSError:
+                pytest.skip('cannot bind to {}'.format(address))
+            original.listen(1)
+            with mock.patch('abbot.__main__.SYSTEMD_SOCKET_FD', os.dup(original.fileno())):
+                sockets = main._bind_sockets(True)
+            try:
+                assert len(sockets) == 1
+                assert sockets[0].family == family
+                assert sockets[0].getsockname() == original.getsockname()
+            finally:
+                sockets[0].close()
+
+    def test_ipv4(self):
+        "an IPv4 socket from systemd is not mistaken for IPv6"
+        self.check_family(socket.AF_INET, '127.0.0.1')
+
+    def test_ipv6(self):
+        "an IPv6 socket from systemd"
+        self.check_family(socket.AF_INET6, '::1')
+
+    def test_unix(self):
+        "a Unix socket from systemd"
+        with tempfile.TemporaryDirectory() as tempdir:
+            self.check_family(socket.AF_UNIX, os.path.join(tempdir, 'abbot.sock'))
+
+
+class TestCompileRoutes(object):
+    '''
+    Tests for compile_routes().
+    '''
+
+    def test_routes(self):
+        "every SimpleHandler URL gets a Route, and HANDLERS is not modified"
+        routes = main.compile_routes(main.HANDLERS)
+        assert len(routes) == len(main.HANDLERS)
+        for spec, compiled in zip(main.HANDLERS, routes):
+            assert compiled.name == spec.name
+            assert compiled.handler_class is spec.handler_class
+            if issubclass(spec.handler_class, simple_handler.SimpleHandler):
+                assert 'route' not in spec.kwargs
+                route = compiled.kwargs['route']
+                assert route.type_name == spec.kwargs['type_name']
+                for field in spec.kwargs.get('additional_fields', []):
+                    assert field in route.returned_field_set
+
+    @mock.patch.dict('abbot.simple_handler.URL_TEMPLATES', clear=True)
+    def test_url_templates(self):
+        "the URL_TEMPLATES have the singular and plural resource types"
+        main.compile_routes(main.HANDLERS)
+        assert simple_handler.URL_TEMPLATES['chant'] == 'chants/{}'
+        assert simple_handler.URL_TEMPLATES['chants'] == 'chants/{}'
+        assert simple_handler.URL_TEMPLATES['source_status'] == 'statii/{}'
+        assert simple_handler.URL_TEMPLATES['source_statii'] == 'statii/{}'
+        assert '*' not in simple_handler.URL_TEMPLATES
+
+    def test_root_document(self):
+        "the RootHandler gets the same document it would make for every request"
+        routes = main.compile_routes(main.HANDLERS)
+        expected = handlers.make_root_document(web.Application(main.HANDLERS).reverse_url)
+        for spec in routes:
+            if spec.handler_class is handlers.RootHandler:
+                assert escape.json_decode(spec.kwargs['document']) == expected
+                break
+        else:
+            raise AssertionError('no RootHandler')
+
+
+class TestMakeApp(object):
+    '''
+    Tests for make_app().
+    '''
+
+    @mock.patch('abbot.__main__.options')
+    def test_settings(self, mock_options):
+        "the settings are given to the Application itself, not nested"
+        mock_options.debug = False
+        app = main.make_app(main.compile_routes(main.HANDLERS))
+        assert app.settings['log_function'] is metrics.log_request
+        assert app.settings['compress_response'] is True
+        assert app.settings['debug'] is False
+        assert 'settings' not in app.settings
+        assert app.reverse_url('view_chants', '1/')
+
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_metrics.py
+# Purpose:                Tests for abbot/metrics.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/metrics.py of the Abbot server.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import mock, TestCase
+
+import pysolrtornado
+import pytest
+from tornado import concurrent, testing, web
+
+from abbot import __main__ as main
+from abbot import cache, metrics, util
+from abbot.tests import shared
+
+
+class TestMetricClasses(TestCase):
+    '''
+    Tests for metrics.Counter, metrics.Gauge, and metrics.Histogram.
+    '''
+
+    def setUp(self):
+        self._metrics_patcher = mock.patch('abbot.metrics._METRICS', [])
+        self._metrics_patcher.start()
+
+    def tearDown(self):
+        self._metrics_patcher.stop()
+
+    def test_counter(self):
+        "Counters add up, for every combination of label values."
+        counter = metrics.Counter('things_total', 'Things.', ('kind', 'status'))
+        counter.inc('a', 200)
+        counter.inc('a', 200, amount=2)
+        counter.inc('b', 404)
+        assert counter.get('a', 200) == 3
+        assert counter.get('c', 500) == 0
+        assert counter.samples() == ['things_total{kind="a",status="200"} 3',
+                                     'things_total{kind="b",status="404"} 1']
+
+    def test_gauge(self):
+        "Gauges go up and down, and a gauge without labels has no braces."
+        gauge = metrics.Gauge('things', 'Things.')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        assert gauge.samples() == ['things 1']
+        gauge.set(0.5)
+        assert gauge.samples() == ['things 0.5']
+        gauge.set(float('nan'))
+        assert gauge.samples() == ['things NaN']
+
+    def test_histogram(self):
+        "Histogram buckets are cumulative, with the sum and count."
+        histogram = metrics.Histogram('seconds', 'Seconds.', ('caller',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'x')
+        histogram.observe(0.5, 'x')
+        histogram.observe(20, 'x')
+        assert histogram.get('x') == 3
+        assert histogram.samples() == ['seconds_bucket{caller="x",le="0.1"} 1',
+                                       'seconds_bucket{caller="x",le="1.0"} 2',
+                                       'seconds_bucket{caller="x",le="+Inf"} 3',
+                                       'seconds_sum{caller="x"} 20.55',
+                                       'seconds_count{caller="x"} 3']
+
+    def test_histogram_inc(self):
+        "Histograms only take observations."
+        histogram = metrics.Histogram('seconds', 'Seconds.')
+        with pytest.raises(TypeError):
+            histogram.inc()
+
+    def test_escape_labels(self):
+        "Backslashes, quotes, and newlines in label values are escaped."
+        counter = metrics.Counter('things_total', 'Things.', ('kind',))
+        counter.inc('a"b\\c\nd')
+        assert counter.samples() == ['things_total{kind="a\\"b\\\\c\\nd"} 1']
+
+    def test_render(self):
+        "Every metric has HELP and TYPE comments, and the collectors are called first."
+        counter = metrics.Counter('things_total', 'Things.')
+        collector = mock.Mock(side_effect=lambda: counter.set(4))
+        with mock.patch('abbot.metrics._COLLECTORS', [collector]):
+            actual = metrics.render()
+        assert actual == '# HELP things_total Things.\n# TYPE things_total counter\nthings_total 4\n'
+
+
+class TestCollectors(TestCase):
+    '''
+    Tests for the cache and Solr client metrics.
+    '''
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_watch_cache(self):
+        "The hits, misses, ratio, and size of a cache."
+        lru = cache.LRUCache(4)
+        lru.put('a', 1)
+        lru.get('a')
+        lru.get('a')
+        lru.get('a')
+        lru.get('b')
+        with mock.patch('abbot.metrics._CACHES', [('test', lru)]):
+            metrics._collect_caches()
+        assert metrics.CACHE_HITS.get('test') == 3
+        assert metrics.CACHE_MISSES.get('test') == 1
+        assert metrics.CACHE_HIT_RATIO.get('test') == 0.75
+        assert metrics.CACHE_ENTRIES.get('test') == 1
+        assert metrics.CACHE_SIZE.get('test') == 1
+
+    def test_watched_caches(self):
+        "Abbot's caches are watched."
+        names = [name for name, _ in metrics._CACHES]
+        for name in ('query', 'subquery', 'xref', 'fragment'):
+            assert name in names
+
+    def test_solr_stats(self):
+        "The Solr client metrics come from SolrClient.stats()."
+        stats = {'in_flight': 7, 'queued': 2, 'max_in_flight': 9, 'max_clients': 5,
+                 'total_requests': 80}
+        with mock.patch('abbot.util.SOLR') as mock_solr:
+            mock_solr.stats.return_value = stats
+            util._collect_solr_metrics()
+        assert metrics.SOLR_IN_FLIGHT.get() == 7
+        assert metrics.SOLR_QUEUED.get() == 2
+        assert metrics.SOLR_MAX_CLIENTS.get() == 5
+
+    def test_limiter_stats(self):
+        "The adaptive limit metrics come from AdaptiveLimiter.stats()."
+        stats = {'limit': 6, 'in_flight': 6, 'queued': 3, 'rejected': 12}
+        with mock.patch('abbot.util.LIMITER') as mock_limiter:
+            mock_limiter.stats.return_value = stats
+            util._collect_solr_metrics()
+        assert metrics.SOLR_LIMIT.get() == 6
+        assert metrics.SOLR_LIMIT_QUEUED.get() == 3
+        assert metrics.SOLR_REJECTED.get() == 12
+
+
+class TestSolrMetrics(shared.TestHandler):
+    '''
+    Tests for the Solr metrics recorded by util.search_solr().
+    '''
+
+    def setUp(self):
+        super(TestSolrMetrics, self).setUp()
+        self.solr = self.setUpSolr()
+        metrics.reset()
+
+    @testing.gen_test
+    def test_duration(self):
+        "Every Solr request is timed, by caller."
+        yield util.search_solr('q', caller='basic_get')
+        yield util.search_solr('q')
+        assert metrics.SOLR_DURATION.get('basic_get') == 1
+        assert metrics.SOLR_DURATION.get('other') == 1
+
+    @testing.gen_test
+    def test_shared(self):
+        "A query that shares one already in flight is counted, but not timed again."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        first = util.search_solr('q', caller='basic_get')
+        second = util.search_solr('q', caller='Xref.lookup')
+        response.set_result(shared.make_results([{'id': '1'}]))
+        yield [first, second]
+        assert metrics.SOLR_DURATION.get('basic_get') == 1
+        assert metrics.SOLR_DURATION.get('Xref.lookup') == 0
+        assert metrics.SOLR_SHARED.get('Xref.lookup') == 1
+
+    @testing.gen_test
+    def test_error(self):
+        "A failed Solr request is counted and timed."
+        response = concurrent.Future()
+        response.set_exception(pysolrtornado.SolrError('test_error()'))
+        self.solr.search = mock.Mock(return_value=response)
+        with pytest.raises(pysolrtornado.SolrError):
+            yield util.search_solr('q', caller='run_subqueries')
+        assert metrics.SOLR_ERRORS.get('run_subqueries') == 1
+        assert metrics.SOLR_DURATION.get('run_subqueries') == 1
+
+
+class TestLogRequest(shared.TestHandler):
+    '''
+    Tests for metrics.log_request(), the in-flight requests, and the MetricsHandler.
+    '''
+
+    def get_app(self):
+        routes = main.compile_routes(main.HANDLERS)
+        routes.insert(0, web.url(r'/metrics', metrics.MetricsHandler))
+        return main.make_app(routes)
+
+    def setUp(self):
+        super(TestLogRequest, self).setUp()
+        self.solr = self.setUpSolr()
+        metrics.reset()
+
+    def test_simple_handler(self):
+        "Requests are counted by route, method, and status, and Solr queries by caller."
+        self.solr.search_se.add('genre', {'id': '162', 'type': 'genre'})
+        self.fetch('/genres/162/')
+        self.fetch('/genres/162/', method='OPTIONS')
+        self.fetch('/genres/-1/')
+        assert metrics.HTTP_REQUESTS.get('genre', 'GET', 200) == 1
+        assert metrics.HTTP_REQUESTS.get('genre', 'OPTIONS', 200) == 1
+        assert metrics.HTTP_REQUESTS.get('genre', 'GET', 422) == 1
+        assert metrics.HTTP_DURATION.get('genre', 'GET') == 2
+        assert metrics.HTTP_IN_FLIGHT.get('genre') == 0
+        assert metrics.SOLR_DURATION.get('basic_get') == 1
+        assert metrics.SOLR_DURATION.get('options') == 1
+
+    def test_other_handlers(self):
+        "Other handlers are labelled with their class name."
+        self.fetch('/')
+        self.fetch('/genres')
+        assert metrics.HTTP_REQUESTS.get('RootHandler', 'GET', 200) == 1
+        assert metrics.HTTP_REQUESTS.get('CanonicalHandler', 'GET', 301) == 1
+
+    def test_in_flight(self):
+        "SimpleHandler requests are counted in flight until they finish."
+        in_flight = []
+        def side_effect(*args, **kwargs):
+            in_flight.append(metrics.HTTP_IN_FLIGHT.get('*'))
+            return shared.make_future(shared.make_results([]))
+        self.solr.search = mock.Mock(side_effect=side_effect)
+        self.fetch('/browse/')
+        assert in_flight == [1]
+        assert metrics.HTTP_IN_FLIGHT.get('*') == 0
+
+    def test_metrics_handler(self):
+        "The metrics are served in the Prometheus text format."
+        self.fetch('/')
+        self._solr.stats = mock.Mock(return_value={'in_flight': 0, 'queued': 0,
+                                                   'max_clients': 20})
+        response = self.fetch('/metrics')
+        assert response.code == 200
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        body = response.body.decode('utf-8')
+        assert '# TYPE abbot_http_request_duration_seconds histogram\n' in body
+        assert 'abbot_http_requests_total{route="RootHandler",method="GET",status="200"} 1\n' in body
+        assert 'abbot_solr_max_clients 20\n' in body
+
+
+class TestListen(TestCase):
+    '''
+    Tests for metrics.listen().
+    '''
+
+    @mock.patch('abbot.metrics.options')
+    def test_disabled(self, mock_options):
+        "Nothing listens when metrics_port is 0."
+        mock_options.metrics_port = 0
+        assert metrics.listen() is None
+
+    @mock.patch('abbot.metrics.web.Application.listen')
+    @mock.patch('abbot.metrics.options')
+    def test_workers(self, mock_options, mock_listen):
+        "Each worker listens on its own port."
+        mock_options.metrics_port = 9100
+        mock_options.metrics_address = '127.0.0.1'
+        metrics.listen()
+        mock_listen.assert_called_with(9100, address='127.0.0.1')
+        metrics.listen(3)
+        mock_listen.assert_called_with(9103, address='127.0.0.1')
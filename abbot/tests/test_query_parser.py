@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_query_parser.py
+# Purpose:                Tests for abbot/query_parser.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/query_parser.py of the Abbot server.
+
+Most of these are "differential" tests: every query must give the same result from the
+hand-written parser as from the Parsimonious grammar in abbot/search_grammar.py.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import TestCase
+
+from hypothesis import given, strategies as strats
+import pytest
+
+from abbot import query_parser, search_grammar, util
+
+
+# pieces from which to build queries, chosen to visit every part of the grammar, including the
+# parts that are easy to get wrong (like "ANDROID" starting with the "AND" operator)
+_PIECES = ['a', 'genre', 'Deus', 'é', '1', '.', '_', 'ANDROID', 'ORGAN', 'NOTE', 'x y',
+           ' ', ' ', ' ', ':', '(', ')', '"', '*', '?', '??', '+', '-', '!', '\t',
+           'AND', 'OR', 'NOT', '&&', '||']
+
+
+def grammar_result(query):
+    "Parse a query with the Parsimonious grammar, returning None if it's invalid."
+    try:
+        return util._parse_nodes(search_grammar.parse(query))
+    except RuntimeError:
+        return None
+
+
+def parser_result(query):
+    "Parse a query with abbot.query_parser, returning None if it's invalid."
+    try:
+        return query_parser.parse(query)
+    except RuntimeError:
+        return None
+
+
+class TestDifferential(TestCase):
+    '''
+    The hand-written parser must agree with the Parsimonious grammar.
+    '''
+
+    @given(strats.lists(elements=strats.sampled_from(_PIECES), max_size=16))
+    def test_pieces(self, pieces):
+        "Queries built from pieces of the grammar."
+        query = ''.join(pieces)
+        assert grammar_result(query) == parser_result(query)
+
+    @given(strats.text(alphabet='aZ1é:() "*?+-!&|ANDORT', max_size=24))
+    def test_characters(self, query):
+        "Queries built from single characters."
+        assert grammar_result(query) == parser_result(query)
+
+    def test_examples(self):
+        "The examples from the util.parse_query() tests and documentation."
+        examples = [
+            'antiphon',
+            'genre:antiphon',
+            '"in taberna" genre:antiphon',
+            'size: drink:Dunkelweiß',
+            'genre:antiphon AND incipit:Deus*',
+            'genre:antiphon AND (incipit:Deus* OR incipit:Gloria*)',
+            'incipit:deus* AND century:(20th OR 21st) AND genre:antiphon',
+            '+type:"sal ad" -name:Caesar !Caesar',
+            'drink:Dunkel**',
+            '"in ?" genre:???iphon',
+            '(a (b (c)))',
+            'a AND OR b',
+            'a ',
+            'a AND',
+            '',
+        ]
+        for query in examples:
+            assert grammar_result(query) == parser_result(query), query
+
+
+class TestLimits(TestCase):
+    '''
+    The hand-written parser refuses queries that are too long or too deeply nested.
+    '''
+
+    def test_length(self):
+        "A query longer than MAX_LENGTH is refused, even when it would be valid."
+        query = 'a ' * (query_parser.MAX_LENGTH // 2) + 'a'
+        with pytest.raises(RuntimeError):
+            query_parser.parse(query)
+
+    def test_depth_1(self):
+        "Nesting up to MAX_DEPTH works."
+        query = '(' * query_parser.MAX_DEPTH + 'a' + ')' * query_parser.MAX_DEPTH
+        assert query_parser.parse(query)[query_parser.MAX_DEPTH] == ('default', 'a')
+
+    def test_depth_2(self):
+        "Nesting deeper than MAX_DEPTH is refused."
+        query = '(' * (query_parser.MAX_DEPTH + 1) + 'a' + ')' * (query_parser.MAX_DEPTH + 1)
+        with pytest.raises(RuntimeError):
+            query_parser.parse(query)
+
+    def test_long_quoted_text(self):
+        "A long quoted string is parsed."
+        query = '"{}"'.format('in taberna ' * 300)
+        assert query_parser.parse(query) == [('default', query)]
@@ -36,11 +36,16 @@ Integration tests for SEARCH requests in SimpleHandler and ComplexHandler.
 import pysolrtornado
 from tornado import escape, testing
 
-from abbot import simple_handler
+from abbot import complex_handler, simple_handler
 
+import shared
 import test_get_integration
 
 
+_XREF_FL = ','.join(complex_handler._XREF_FIELDS)
+# the "fl" parameter for cross-reference lookups
+
+
 class TestSimple(test_get_integration.TestSimple):
     '''
     Runs the GET method's TestSimple suite with the SEARCH HTTP method.
@@ -68,7 +73,8 @@ class TestSimple(test_get_integration.TestSimple):
                                               body=b'{"query":"id:830"}')
 
         self.solr.search.assert_any_call('type:{}  AND  ( id:830  ) '.format(self._type[0]),
-            df='default_search', rows=10)
+            df='default_search', rows=10,
+            fl=shared.solr_fields(self._type[0]))
         self.check_standard_header(actual)
 
     @testing.gen_test
@@ -99,7 +105,8 @@ class TestSimple(test_get_integration.TestSimple):
                                               body=b'{"query":"name:Todd"}')
 
         self.solr.search.assert_called_with('type:{}  AND  ( name:Todd  ) '.format(self._type[0]),
-            df='default_search', rows=10)
+            df='default_search', rows=10,
+            fl=shared.solr_fields(self._type[0]))
         self.check_standard_header(actual)
         self.assertEqual(404, actual.code)
         self.assertEqual(simple_handler._NO_SEARCH_RESULTS, actual.reason)
@@ -136,6 +143,63 @@ class TestSimple(test_get_integration.TestSimple):
         assert simple_handler._INVALID_SEARCH_FIELD.format('gingerbread') == actual.reason
 
 
+    def fetch_ids(self, body):
+        "Send a SEARCH request with this body, which should have an \"ids\" member."
+        return self.http_client.fetch(self._browse_url,
+                                      method='SEARCH',
+                                      allow_nonstandard_methods=True,
+                                      raise_error=False,
+                                      body=escape.json_encode(body))
+
+    @testing.gen_test
+    def test_ids_1(self):
+        '''
+        - "ids" asks Solr for all the resources at once
+        - "sort_order" is the order of "ids," without repeats, and missing resources are left out
+        '''
+        self.solr.search_se.add('id:', {'id': '6', 'name': 'six', 'type': self._type[0]})
+        self.solr.search_se.add('id:', {'id': '9', 'name': 'nine', 'type': self._type[0]})
+
+        actual = yield self.fetch_ids({'ids': ['9', '4', '6', '9']})
+
+        self.check_standard_header(actual)
+        assert actual.code == 200
+        assert actual.headers['X-Cantus-Total-Results'] == '2'
+        actual = escape.json_decode(actual.body)
+        assert actual['sort_order'] == ['9', '6']
+        assert actual['6'] == {'id': '6', 'name': 'six', 'type': self._type[0]}
+        self.solr.search.assert_any_call('+type:{} +id:(9 OR 4 OR 6)'.format(self._type[0]),
+            df='default_search', rows=3, fl=shared.solr_fields(self._type[0]))
+
+    @testing.gen_test
+    def test_ids_2(self):
+        "returns 400 when \"ids\" isn't a list of strings, or there's also a \"query\""
+        for body, reason in (({'ids': '6'}, simple_handler._INVALID_IDS),
+                             ({'ids': []}, simple_handler._INVALID_IDS),
+                             ({'ids': [6]}, simple_handler._INVALID_IDS),
+                             ({'ids': ['6'], 'query': 'six'}, simple_handler._QUERY_WITH_IDS)):
+            actual = yield self.fetch_ids(body)
+            assert actual.code == 400
+            assert actual.reason == reason
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_ids_3(self):
+        "returns 507 when there are too many \"ids\""
+        self._simple_options.batch_view_limit = 2
+        actual = yield self.fetch_ids({'ids': ['1', '2', '3']})
+        assert actual.code == 507
+        assert actual.reason == simple_handler._TOO_MANY_IDS
+
+    @testing.gen_test
+    def test_ids_4(self):
+        "returns 422 when one of the \"ids\" is invalid"
+        for ids in (['1', '2 OR *'], ['*']):
+            actual = yield self.fetch_ids({'ids': ids})
+            assert actual.code == 422
+        assert self.solr.search.call_count == 0
+
+
 class TestComplex(test_get_integration.TestComplex):
     '''
     Runs the GET method's TestComplex suite with the SEARCH HTTP method.
@@ -154,6 +218,24 @@ class TestComplex(test_get_integration.TestComplex):
     test_invalid_search_string = TestSimple.test_invalid_search_string
     test_no_results = TestSimple.test_no_results
     test_search_to_view = TestSimple.test_search_to_view
+    fetch_ids = TestSimple.fetch_ids
+    test_ids_2 = TestSimple.test_ids_2
+
+    @testing.gen_test
+    def test_ids_xrefs(self):
+        "The cross-references for every resource in \"ids\" are looked up at once."
+        self.solr.search_se.add('+id:', {'type': 'source', 'id': '1', 'century_id': '830'})
+        self.solr.search_se.add('+id:', {'type': 'source', 'id': '2', 'century_id': '831'})
+        self.solr.search_se.add('id:830', {'type': 'century', 'id': '830', 'name': '14th century'})
+        self.solr.search_se.add('id:831', {'type': 'century', 'id': '831', 'name': '15th century'})
+
+        actual = yield self.fetch_ids({'ids': ['2', '1']})
+
+        actual = escape.json_decode(actual.body)
+        assert actual['sort_order'] == ['2', '1']
+        assert actual['1']['century'] == '14th century'
+        assert actual['2']['century'] == '15th century'
+        assert self.solr.search.call_count == 2
 
     @testing.gen_test
     def test_subquery_returns_nothing(self):
@@ -165,7 +247,7 @@ class TestComplex(test_get_integration.TestComplex):
                                               body=b'{"query":"century:21st"}')
 
         # as submitted by run_subqueries()
-        self.solr.search.assert_called_with('type:century AND (21st)', df='default_search')
+        self.solr.search.assert_called_with('type:century AND (21st)', df='default_search', fl='id')
         self.check_standard_header(actual)
         self.assertEqual(404, actual.code)
         self.assertEqual(simple_handler._NO_SEARCH_RESULTS, actual.reason)
@@ -186,11 +268,12 @@ class TestComplex(test_get_integration.TestComplex):
                                               body=b'{"query":"century:21st"}')
 
         # as submitted by run_subqueries()
-        self.solr.search.assert_any_call('type:century AND (21st)', df='default_search')
+        self.solr.search.assert_any_call('type:century AND (21st)', df='default_search', fl='id')
         # as submitted by the search itself
-        self.solr.search.assert_any_call('type:source  AND  ( century_id:830  ) ', df='default_search', rows=10)
+        self.solr.search.assert_any_call('type:source  AND  ( century_id:830  ) ', df='default_search', rows=10,
+            fl=shared.solr_fields(self._type[0]))
         # as submitted for the cross-reference
-        self.solr.search.assert_any_call('id:830', df='default_search', rows=1)
+        self.solr.search.assert_any_call('id:830', df='default_search', rows=1, fl=_XREF_FL)
         self.check_standard_header(actual)
 
     @testing.gen_test
@@ -211,12 +294,13 @@ class TestComplex(test_get_integration.TestComplex):
                                               body=b'{"query":"century:21st"}')
 
         # as submitted by run_subqueries()
-        self.solr.search.assert_any_call('type:century AND (21st)', df='default_search')
+        self.solr.search.assert_any_call('type:century AND (21st)', df='default_search', fl='id')
         # as submitted by the search itself
         self.solr.search.assert_any_call('type:source  AND  ( (century_id:830^3 OR century_id:831^2 OR century_id:832^1)  ) ',
-            df='default_search', rows=10)
+            df='default_search', rows=10,
+            fl=shared.solr_fields(self._type[0]))
         # as submitted for the cross-reference
-        self.solr.search.assert_any_call('id:830', df='default_search', rows=1)
+        self.solr.search.assert_any_call('id:830', df='default_search', rows=1, fl=_XREF_FL)
         self.check_standard_header(actual)
 
     @testing.gen_test
@@ -231,7 +315,7 @@ class TestComplex(test_get_integration.TestComplex):
                                               body=b'{"query":"century:21st"}')
 
         # as submitted by run_subqueries()
-        self.solr.search.assert_called_with('type:century AND (21st)', df='default_search')
+        self.solr.search.assert_called_with('type:century AND (21st)', df='default_search', fl='id')
         self.check_standard_header(actual)
         self.assertEqual(502, actual.code)
         self.assertEqual(simple_handler._SOLR_502_ERROR, actual.reason)
@@ -316,7 +400,8 @@ class TestComplex(test_get_integration.TestComplex):
         # check how Solr was called for the main query
         self.solr.search.assert_any_call(
             'type:source  AND  ( (century_id:829 OR century_id:830)  &&  ( notation_style_id:757  OR notation_style_id:767  )  NOT century_id:800  ) ',
-            df='default_search', rows=10)
+            df='default_search', rows=10,
+            fl=shared.solr_fields(self._type[0]))
         # check the right results were returned
         actual = escape.json_decode(actual.body)
         assert actual['sort_order'] == ['4412', '4413']
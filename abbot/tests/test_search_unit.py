@@ -37,7 +37,7 @@ import pysolrtornado
 from tornado import httpclient, testing
 from unittest import mock
 
-from abbot import simple_handler
+from abbot import serialize, simple_handler
 from abbot.simple_handler import SimpleHandler
 from abbot import util
 import shared
@@ -196,7 +196,7 @@ class TestSimple(shared.TestHandler):
         actual = yield self.handler.search()
         self.assertIsNone(actual)
         mock_search_handler.assert_called_once_with()
-        mock_write.assert_called_once_with([1, 2, 3])
+        mock_write.assert_called_once_with(serialize.encode([1, 2, 3]))
         mock_mrh.assert_called_once_with(True, 42)
 
     @mock.patch('abbot.simple_handler.SimpleHandler.make_response_headers')
@@ -215,7 +215,7 @@ class TestSimple(shared.TestHandler):
         actual = yield self.handler.search()
         self.assertIsNone(actual)
         mock_search_handler.assert_called_once_with()
-        mock_write.assert_called_once_with([1, 2, 3, 'resources'])
+        mock_write.assert_called_once_with(serialize.encode([1, 2, 3, 'resources']))
         mock_mrh.assert_called_once_with(True, 42)
 
     @mock.patch('abbot.simple_handler.SimpleHandler.send_error')
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_serialize.py
+# Purpose:                Tests for abbot/serialize.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/serialize.py of the Abbot server.
+
+The "differential" tests run against every encoder that is installed: each one must give JSON that
+decodes to the same value as Tornado's encoder.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import mock, TestCase
+
+from hypothesis import given, strategies as strats
+from tornado import escape, testing
+
+from abbot import serialize
+
+
+# JSON-compatible values like those in a Cantus API response
+_JSON = strats.recursive(
+    strats.none() | strats.booleans() | strats.integers(min_value=-2 ** 53, max_value=2 ** 53) |
+    strats.text(alphabet='aZ1é "\\/<>\n\tß☃'),
+    lambda children: strats.lists(children, max_size=4) |
+    strats.dictionaries(strats.text(alphabet='az_é', max_size=6), children, max_size=4),
+    max_leaves=16)
+
+_RESPONSE = {
+    '123': {'type': 'chant', 'id': '123', 'incipit': 'Deus in adjutorium </script>',
+            'indexers': ['Débora', 'Jan'], 'folio': '001r', 'sequence': 4},
+    'resources': {'123': {'self': 'https://abbot/chants/123/'}},
+    'sort_order': ['123'],
+}
+
+
+class TestEncode(TestCase):
+    '''
+    Tests for serialize.encode() and serialize.use_encoder().
+    '''
+
+    def tearDown(self):
+        serialize.use_encoder('auto')
+        super(TestEncode, self).tearDown()
+
+    @given(_JSON)
+    def test_differential(self, obj):
+        "Every encoder gives the same value as Tornado's encoder."
+        expected = escape.json_decode(escape.json_encode(obj))
+        for encoder in serialize.ENCODERS.values():
+            assert escape.json_decode(encoder(obj)) == expected
+
+    def test_stdlib(self):
+        "The standard library encoder gives the same bytes as Tornado."
+        serialize.use_encoder('stdlib')
+        assert serialize.NAME == 'stdlib'
+        assert serialize.encode(_RESPONSE) == escape.utf8(escape.json_encode(_RESPONSE))
+
+    def test_escape_script(self):
+        "Every encoder escapes '</' like Tornado does."
+        for name in serialize.ENCODERS:
+            serialize.use_encoder(name)
+            actual = serialize.encode(_RESPONSE)
+            assert b'</' not in actual
+            assert escape.json_decode(actual) == _RESPONSE
+
+    def test_auto(self):
+        "'auto' chooses the first installed encoder in order of preference."
+        serialize.use_encoder('auto')
+        assert serialize.NAME in serialize.ENCODERS
+        assert serialize._PREFERENCE.index(serialize.NAME) == min(
+            serialize._PREFERENCE.index(name) for name in serialize.ENCODERS)
+
+    @mock.patch('abbot.serialize.log')
+    def test_unknown(self, mock_log):
+        "An encoder that isn't installed logs a warning and chooses the fastest encoder."
+        serialize.use_encoder('simplejson')
+        assert serialize.NAME in serialize.ENCODERS
+        assert mock_log.warn.call_count == 1
+
+    def test_fallback(self):
+        "When an encoder fails, the standard library encoder is used."
+        serialize.use_encoder('stdlib')
+        with mock.patch('abbot.serialize._encoder', side_effect=OverflowError):
+            assert serialize.encode(2 ** 70) == b'1180591620717411303424'
+
+
+class TestSplice(TestCase):
+    '''
+    Tests for serialize.encode() with serialize.Raw values.
+    '''
+
+    def test_splice_1(self):
+        "Raw values are copied into the output, and the other values are serialized."
+        raw = serialize.Raw(b'{"id": "123"}')
+        actual = serialize.encode({'123': raw, 'sort_order': ['123']})
+        assert raw in actual
+        assert escape.json_decode(actual) == {'123': {'id': '123'}, 'sort_order': ['123']}
+
+    def test_splice_2(self):
+        "Raw values in a dictionary inside the outer dictionary are spliced too."
+        response = {'123': serialize.Raw(serialize.encode(_RESPONSE['123'])),
+                    'resources': {'123': serialize.Raw(serialize.encode(_RESPONSE['resources']['123']))},
+                    'sort_order': ['123']}
+        assert escape.json_decode(serialize.encode(response)) == _RESPONSE
+
+    def test_no_raw(self):
+        "Without Raw values, a dictionary is serialized as usual."
+        assert serialize.encode(_RESPONSE) == serialize._encoder(_RESPONSE)
+
+
+class TestEncodeAsync(testing.AsyncTestCase):
+    '''
+    Tests for serialize.encode_async().
+    '''
+
+    @mock.patch('abbot.serialize.futures.ThreadPoolExecutor')
+    @testing.gen_test
+    def test_below_threshold(self, mock_executor):
+        "A small body, or a threshold of 0, is serialized on the event loop."
+        for threshold in (0, 4):
+            with mock.patch('abbot.serialize.options') as mock_options:
+                mock_options.json_executor_threshold = threshold
+                actual = yield serialize.encode_async(_RESPONSE)
+            assert actual == serialize.encode(_RESPONSE)
+        assert mock_executor.call_count == 0
+
+    @testing.gen_test
+    def test_above_threshold(self):
+        "A large body is serialized on a thread."
+        with mock.patch('abbot.serialize.options') as mock_options:
+            mock_options.json_executor_threshold = 3
+            with mock.patch('abbot.serialize.encode', wraps=serialize.encode) as mock_encode:
+                actual = yield serialize.encode_async(_RESPONSE)
+        assert actual == serialize.encode(_RESPONSE)
+        assert serialize._executor is not None
+        mock_encode.assert_called_once_with(_RESPONSE)
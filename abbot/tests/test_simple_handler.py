@@ -34,13 +34,18 @@ Tests for the Abbot server's SimpleHandler.
 # pylint: disable=too-many-public-methods
 
 from unittest import mock
-from tornado import httpclient
+
+import pysolrtornado
+from tornado import concurrent, escape, httpclient, testing
 
 import abbot
 from abbot import __main__ as main
+from abbot import limiter
+from abbot import metrics
 from abbot.complex_handler import ComplexHandler
 from abbot import simple_handler
 from abbot.simple_handler import SimpleHandler
+from abbot import util
 import shared
 
 
@@ -233,6 +238,59 @@ class TestMakeResourceUrl(shared.TestHandler):
         self.assertEqual(expected, actual)
 
 
+    def test_make_resource_url_4(self):
+        "without the URL_TEMPLATES, reverse_url() gives the same URLs"
+        expected = [self.handler.make_resource_url('420'),
+                    self.handler.make_resource_url('69', 'chant'),
+                    self.handler.make_resource_url('3.14159', 'sources'),
+                    self.handler.make_resource_url('12', 'source_status')]
+        with mock.patch.dict(simple_handler.URL_TEMPLATES, clear=True):
+            actual = [self.handler.make_resource_url('420'),
+                      self.handler.make_resource_url('69', 'chant'),
+                      self.handler.make_resource_url('3.14159', 'sources'),
+                      self.handler.make_resource_url('12', 'source_status')]
+        assert expected == actual
+        assert expected[3] == 'https://cantus.org/statii/12/'
+
+
+class TestRoutes(shared.TestHandler):
+    '''
+    Tests for simple_handler.compile_route() and how SimpleHandler uses a Route.
+    '''
+
+    def test_compile_route(self):
+        "the returned fields, Solr fields, and OPTIONS headers"
+        route = simple_handler.compile_route('genre', ['mass_or_office', 'id'])
+        assert route.type_name == 'genre'
+        assert route.type_name_plural == 'genres'
+        assert route.returned_fields == ('id', 'type', 'name', 'description', 'mass_or_office', 'id')
+        assert route.returned_field_set == frozenset(route.returned_fields)
+        assert route.solr_fields == ('id', 'type', 'name', 'description', 'mass_or_office',
+                                     'drupal_path')
+        assert ('Allow', SimpleHandler._ALLOWED_BROWSE_METHODS) in route.browse_options
+        assert ('X-Cantus-Page', 'allow') in route.browse_options
+        assert ('Allow', SimpleHandler._ALLOWED_VIEW_METHODS) in route.view_options
+        assert ('X-Cantus-Page', 'allow') not in route.view_options
+
+    def test_shared_route(self):
+        "handlers made with the same Route share its fields, until X-Cantus-Fields replaces them"
+        route = simple_handler.compile_route('genre', ['mass_or_office'])
+        handlers = []
+        for _ in range(2):
+            request = httpclient.HTTPRequest(url='/zool/', method='GET')
+            request.connection = mock.Mock()  # required for Tornado magic things
+            handlers.append(SimpleHandler(self.get_app(), request, type_name='genre', route=route))
+
+        assert handlers[0].returned_fields is handlers[1].returned_fields
+        assert handlers[0].returned_field_set is route.returned_field_set
+        assert handlers[0].solr_fields() is route.solr_fields
+
+        handlers[0].returned_fields = ['id', 'type', 'name']
+        assert handlers[0].returned_field_set == {'id', 'type', 'name'}
+        assert handlers[0].solr_fields() == ['id', 'type', 'name', 'drupal_path']
+        assert handlers[1].returned_fields is route.returned_fields
+
+
 class TestVerifyRequestHeaders(shared.TestHandler):
     '''
     Unit tests for SimpleHandler.verify_request_headers().
@@ -263,7 +321,7 @@ class TestVerifyRequestHeaders(shared.TestHandler):
         - include_resources = True
             - exp_include_resources = True
         - fields = None
-            - exp_fields = ['id', 'type', 'name', 'description']
+            - exp_fields = ('id', 'type', 'name', 'description')
                 - NOTE: exp_fields is compared against self.required_fields
         - per_page = None
             - exp_per_page = None
@@ -314,7 +372,7 @@ class TestVerifyRequestHeaders(shared.TestHandler):
         set_default('include_resources', True)
         set_default('exp_include_resources', True)
         set_default('fields', None)
-        set_default('exp_fields', ['id', 'type', 'name', 'description'])
+        set_default('exp_fields', ('id', 'type', 'name', 'description'))
         if kwargs['is_browse_request']:
             set_default('per_page', None)
             set_default('exp_per_page', 10)
@@ -398,7 +456,7 @@ class TestVerifyRequestHeaders(shared.TestHandler):
                                fields=fields,
                                exp_fields=parse_fields_header_return)
 
-        mock_pfh.assert_called_once_with('something', ['id', 'type', 'name', 'description'])
+        mock_pfh.assert_called_once_with('something', ('id', 'type', 'name', 'description'))
 
     @mock.patch('abbot.util.parse_fields_header')
     def test_not_browse_request_3(self, mock_pfh):
@@ -420,7 +478,7 @@ class TestVerifyRequestHeaders(shared.TestHandler):
                                expected=False,
                                mock_send_error=mock_send_error)
 
-        mock_pfh.assert_called_once_with('something', ['id', 'type', 'name', 'description'])
+        mock_pfh.assert_called_once_with('something', ('id', 'type', 'name', 'description'))
         mock_send_error.assert_called_with(400, reason=simple_handler._INVALID_FIELDS)
 
     def test_not_browse_request_4(self):
@@ -954,6 +1012,226 @@ class TestSendError(shared.TestHandler):
         mock_add_header.assert_called_with('Allow', allow)
 
 
+class TestServerTiming(shared.TestHandler):
+    '''
+    Tests for SimpleHandler.timing() and the "Server-Timing" header.
+    '''
+
+    def setUp(self):
+        super(TestServerTiming, self).setUp()
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('21st', {'type': 'century', 'id': '830', 'name': '21st century'})
+        self.solr.search_se.add('id:830', {'type': 'century', 'id': '830', 'name': '21st century'})
+        self.solr.search_se.add('type:source', {'type': 'source', 'id': '999', 'century_id': '830'})
+        metrics.reset()
+
+    def search(self):
+        "Submit a SEARCH request that goes through every stage."
+        return self.http_client.fetch(self.get_url('/sources/'), method='SEARCH',
+                                      allow_nonstandard_methods=True,
+                                      body=b'{"query":"century:21st"}')
+
+    @testing.gen_test
+    def test_disabled(self):
+        "Without the option, there is no header, but the stages are still in the metrics."
+        actual = yield self.search()
+        assert actual.code == 200
+        assert 'Server-Timing' not in actual.headers
+        assert metrics.STAGE_DURATION.get('solr') == 1
+
+    @testing.gen_test
+    def test_enabled(self):
+        "With the option, every stage is in the header, in order, and in the metrics."
+        self._simple_options.server_timing = True
+        actual = yield self.search()
+        assert actual.code == 200
+        stages = [each.split(';')[0] for each in actual.headers['Server-Timing'].split(', ')]
+        assert stages == ['parse', 'subqueries', 'solr', 'xrefs', 'extra_fields', 'encode']
+        for each in actual.headers['Server-Timing'].split(', '):
+            assert float(each.split(';dur=')[1]) >= 0.0
+        for stage in stages:
+            assert metrics.STAGE_DURATION.get(stage) == 1
+
+    @testing.gen_test
+    def test_error(self):
+        "An error response has the stages before the error."
+        self._simple_options.server_timing = True
+        actual = yield self.http_client.fetch(self.get_url('/sources/'), method='SEARCH',
+                                              allow_nonstandard_methods=True, raise_error=False,
+                                              body=b'{"query":"century:22nd"}')
+        assert actual.code == 404
+        assert actual.headers['Server-Timing'].startswith('parse;dur=')
+
+    def test_timing(self):
+        "A stage timed twice adds up."
+        request = httpclient.HTTPRequest(url='/zool/', method='GET')
+        request.connection = mock.Mock()  # required for Tornado magic things
+        handler = SimpleHandler(self.get_app(), request, type_name='century')
+        with mock.patch('abbot.simple_handler.time.monotonic', side_effect=[1.0, 1.5, 4.0, 4.25]):
+            with handler.timing('extra_fields'):
+                pass
+            with handler.timing('extra_fields'):
+                pass
+        assert handler.timings == {'extra_fields': 0.75}
+
+
+class TestDeadline(shared.TestHandler):
+    '''
+    Tests for the "request_deadline" option and the X-Cantus-Deadline header.
+    '''
+
+    def setUp(self):
+        super(TestDeadline, self).setUp()
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('type:source', {'type': 'source', 'id': '999', 'century_id': '830'})
+        self.solr.search_se.add('id:830', {'type': 'century', 'id': '830', 'name': '21st century'})
+        self.answered = self.solr.search.side_effect
+
+    def stall(self, prefix):
+        "Make Solr never answer queries that start with ``prefix``."
+        def side_effect(query, *args, **kwargs):
+            "Stall or answer."
+            if query.startswith(prefix):
+                return concurrent.Future()
+            return self.answered(query, *args, **kwargs)
+        self.solr.search = mock.Mock(side_effect=side_effect)
+
+    def fetch(self, path, **kwargs):  # pylint: disable=arguments-differ
+        "Fetch a URL, without raising an exception for an error response."
+        return self.http_client.fetch(self.get_url(path), raise_error=False, **kwargs)
+
+    @testing.gen_test
+    def test_option(self):
+        "When the main query stalls past the \"request_deadline\", the response is a 504."
+        self._simple_options.request_deadline = 0.05
+        self.stall('+type:source')
+        actual = yield self.fetch('/sources/')
+        assert actual.code == 504
+
+    @testing.gen_test
+    def test_header(self):
+        "X-Cantus-Deadline sets a deadline when the option does not, for SEARCH requests too."
+        self.stall('type:source')
+        actual = yield self.fetch('/sources/', method='SEARCH', allow_nonstandard_methods=True,
+                                  body=b'{"query":"*"}', headers={'X-Cantus-Deadline': '0.05'})
+        assert actual.code == 504
+
+    @testing.gen_test
+    def test_header_shorter(self):
+        "X-Cantus-Deadline may shorten the deadline, but not lengthen it."
+        self._simple_options.request_deadline = 0.05
+        self.stall('+type:source')
+        actual = yield self.fetch('/sources/', headers={'X-Cantus-Deadline': '60'})
+        assert actual.code == 504
+
+    @testing.gen_test
+    def test_invalid_header(self):
+        "X-Cantus-Deadline must be a positive, finite number of seconds."
+        for value in ('soon', '0', '-1', 'inf', 'nan'):
+            actual = yield self.fetch('/sources/', headers={'X-Cantus-Deadline': value})
+            assert actual.code == 400
+            assert actual.reason == simple_handler._INVALID_DEADLINE
+
+    @testing.gen_test
+    def test_partial(self):
+        "When only the cross-reference lookup stalls, the response has no cross-references."
+        self._simple_options.request_deadline = 0.2
+        self.stall('id:')
+        actual = yield self.fetch('/sources/')
+        assert actual.code == 200
+        assert actual.headers['X-Cantus-Partial'] == 'xrefs'
+        assert actual.headers['Cache-Control'] == 'no-store'
+        body = escape.json_decode(actual.body)
+        assert 'century' not in body['999']
+        assert 'century' not in body['resources']['999']
+        assert len(simple_handler.RESPONSE_CACHE) == 0
+        assert len(simple_handler.FRAGMENT_CACHE) == 0
+
+    @testing.gen_test
+    def test_in_time(self):
+        "A response before the deadline is complete and cached."
+        self._simple_options.request_deadline = 5.0
+        actual = yield self.fetch('/sources/', headers={'X-Cantus-Deadline': '4.5'})
+        assert actual.code == 200
+        assert 'X-Cantus-Partial' not in actual.headers
+        assert escape.json_decode(actual.body)['999']['century'] == '21st century'
+        assert len(simple_handler.RESPONSE_CACHE) == 1
+
+
+class TestOverload(shared.TestHandler):
+    '''
+    Tests for the 503 response when too many queries are waiting for Solr.
+    '''
+
+    def setUp(self):
+        super(TestOverload, self).setUp()
+        self.solr = self.setUpSolr()
+        self.solr.search_se.add('type:source', {'type': 'source', 'id': '999', 'century_id': '830'})
+        self.solr.search_se.add('id:830', {'type': 'century', 'id': '830', 'name': '21st century'})
+        self.limiter = limiter.AdaptiveLimiter(1, queue_size=0)
+        self._simple_options.solr_retry_after = 7
+        patcher = mock.patch('abbot.util.LIMITER', self.limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def fetch(self, path, **kwargs):  # pylint: disable=arguments-differ
+        "Fetch a URL, without raising an exception for an error response."
+        return self.http_client.fetch(self.get_url(path), raise_error=False, **kwargs)
+
+    @testing.gen_test
+    def test_get(self):
+        "When the limiter's queue is full, a GET request is refused with \"Retry-After.\""
+        self.limiter.in_flight = 1
+        actual = yield self.fetch('/sources/')
+        assert actual.code == 503
+        assert actual.reason == simple_handler._OVERLOADED_503_ERROR
+        assert actual.headers['Retry-After'] == '7'
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_search(self):
+        "When the limiter's queue is full, a SEARCH request is refused."
+        self.limiter.in_flight = 1
+        actual = yield self.fetch('/sources/', method='SEARCH', allow_nonstandard_methods=True,
+                                  body=b'{"query":"*"}')
+        assert actual.code == 503
+        assert actual.headers['Retry-After'] == '7'
+
+    @testing.gen_test
+    def test_partial(self):
+        "When only the cross-reference lookup is refused, the response has no cross-references."
+        answered = self.solr.search.side_effect
+        def side_effect(query, *args, **kwargs):
+            "Another request takes the only place while Solr answers the main query."
+            if query.startswith('+type:source'):
+                self.limiter.in_flight += 1
+            return answered(query, *args, **kwargs)
+        self.solr.search = mock.Mock(side_effect=side_effect)
+
+        actual = yield self.fetch('/sources/')
+        assert actual.code == 200
+        assert actual.headers['X-Cantus-Partial'] == 'xrefs'
+        assert 'century' not in escape.json_decode(actual.body)['999']
+        assert len(simple_handler.RESPONSE_CACHE) == 0
+
+
+    def test_send_solr_error(self):
+        "send_solr_error() chooses the response for each kind of SolrError."
+        request = httpclient.HTTPRequest(url='/zool/', method='GET')
+        request.connection = mock.Mock()  # required for Tornado magic things
+        handler = SimpleHandler(self.get_app(), request, type_name='century')
+        handler.send_error = mock.Mock()
+        expectations = (
+            (util.Overloaded('o'),
+             mock.call(503, reason=simple_handler._OVERLOADED_503_ERROR, retry_after=7)),
+            (util.DeadlineExceeded('d'), mock.call(504, reason=simple_handler._DEADLINE_504_ERROR)),
+            (pysolrtornado.SolrError('s'), mock.call(502, reason=simple_handler._SOLR_502_ERROR)),
+        )
+        for err, expected in expectations:
+            handler.send_solr_error(err)
+            assert handler.send_error.call_args == expected
+
+
 class TestCorsMethods(shared.TestHandler):
     '''
     Tests for SimpleHandler._cors_preflight() and _cors_actual().
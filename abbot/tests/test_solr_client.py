@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_solr_client.py
+# Purpose:                Tests for abbot/solr_client.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/solr_client.py of the Abbot server.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import mock
+
+import pysolrtornado
+import pytest
+from tornado import concurrent, httpclient, testing
+
+from abbot import solr_client
+
+
+class TestSolrClient(testing.AsyncTestCase):
+    '''
+    Tests for abbot.solr_client.SolrClient.
+    '''
+
+    def setUp(self):
+        super(TestSolrClient, self).setUp()
+        self.solr = solr_client.SolrClient('http://localhost:8983/solr/collection1/',
+                                           max_clients=2, connect_timeout=1.0,
+                                           request_timeout=5.0, ioloop=self.io_loop)
+
+    def tearDown(self):
+        self.solr._client.close()
+        super(TestSolrClient, self).tearDown()
+
+    def test_init_1(self):
+        "The HTTP client is not shared, and has the given settings."
+        assert self.solr._client is not httpclient.AsyncHTTPClient(self.io_loop)
+        assert self.solr._client.max_clients == 2
+        assert self.solr._client.defaults['connect_timeout'] == 1.0
+        assert self.solr._client.defaults['request_timeout'] == 5.0
+        assert self.solr.timeout == 5.0
+
+    @mock.patch('abbot.solr_client.curl_httpclient', None)
+    @mock.patch('abbot.solr_client.log.warn')
+    def test_init_2(self, mock_warn):
+        "Without pycurl, asking for keep-alive logs a warning."
+        solr = solr_client.SolrClient('http://localhost/', keep_alive=True, ioloop=self.io_loop)
+        solr._client.close()
+        mock_warn.assert_called_once_with(solr_client._NO_PYCURL)
+
+    @testing.gen_test
+    def test_stats_1(self):
+        "Requests are counted while in flight, and queued past max_clients."
+        futures = [concurrent.Future() for _ in range(3)]
+        with mock.patch('pysolrtornado.Solr._send_request', side_effect=futures):
+            requests = [self.solr._send_request('get', 'select/') for _ in range(3)]
+            stats = self.solr.stats()
+            assert stats['in_flight'] == 3
+            assert stats['queued'] == 1
+            assert stats['max_clients'] == 2
+
+            for each in futures:
+                each.set_result('{}')
+            for each in requests:
+                yield each
+
+        stats = self.solr.stats()
+        assert stats['in_flight'] == 0
+        assert stats['queued'] == 0
+        assert stats['max_in_flight'] == 3
+        assert stats['total_requests'] == 3
+
+    @testing.gen_test
+    def test_stats_2(self):
+        "A failed request is no longer in flight."
+        with mock.patch('pysolrtornado.Solr._send_request',
+                        side_effect=pysolrtornado.SolrError('test_stats_2()')):
+            with pytest.raises(pysolrtornado.SolrError):
+                yield self.solr._send_request('get', 'select/')
+        assert self.solr.stats()['in_flight'] == 0
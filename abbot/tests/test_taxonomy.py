@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               tests/test_taxonomy.py
+# Purpose:                Tests for abbot/taxonomy.py of the Abbot server.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for abbot/taxonomy.py of the Abbot server.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+from unittest import mock, TestCase
+
+import pysolrtornado
+import pytest
+from tornado import escape, testing
+
+from abbot import taxonomy
+import shared
+
+
+GENRES = [
+    {'id': '3', 'type': 'genre', 'name': 'B', 'description': 'Benedicamus'},
+    {'id': '1', 'type': 'genre', 'name': 'A', 'description': 'Antiphon'},
+    {'id': '2', 'type': 'genre', 'name': 'R'},
+    {'id': '4', 'type': 'genre', 'name': 'A', 'description': 'Alleluia'},
+]
+
+
+class TestTaxonomyStore(TestCase):
+    '''
+    Tests for abbot.taxonomy.TaxonomyStore.
+    '''
+
+    def setUp(self):
+        self.store = taxonomy.TaxonomyStore()
+        self.store.replace('genre', GENRES)
+
+    def test_has(self):
+        "Only loaded types are held."
+        assert self.store.has('genre')
+        assert not self.store.has('feast')
+
+    def test_view_1(self):
+        "A single resource by ID."
+        actual = self.store.search('genre', '2')
+        assert actual.hits == 1
+        assert actual.docs == [GENRES[2]]
+
+    def test_view_2(self):
+        "A missing resource."
+        actual = self.store.search('genre', '99')
+        assert actual.hits == 0
+        assert not actual
+
+    def test_browse_1(self):
+        "Without a sort, records come in the order Solr returned them, ten per page."
+        actual = self.store.search('genre', '*')
+        assert actual.hits == 4
+        assert [doc['id'] for doc in actual] == ['3', '1', '2', '4']
+
+    def test_browse_2(self):
+        "The 'start' and 'rows' arguments paginate."
+        actual = self.store.search('genre', '*', start=1, rows=2)
+        assert actual.hits == 4
+        assert [doc['id'] for doc in actual] == ['1', '2']
+
+    def test_browse_3(self):
+        "Past the last page, there are no records but the same number of hits."
+        actual = self.store.search('genre', '*', start=8, rows=2)
+        assert actual.hits == 4
+        assert actual.docs == []
+
+    def test_sort_1(self):
+        "Sort on one field, ascending; records without the field go last."
+        actual = self.store.search('genre', '*', sort='description asc')
+        assert [doc['id'] for doc in actual] == ['4', '1', '3', '2']
+
+    def test_sort_2(self):
+        "Sort on one field, descending; records without the field still go last."
+        actual = self.store.search('genre', '*', sort='description desc')
+        assert [doc['id'] for doc in actual] == ['3', '1', '4', '2']
+
+    def test_sort_3(self):
+        "Sort on two fields."
+        actual = self.store.search('genre', '*', sort='name asc,id desc')
+        assert [doc['id'] for doc in actual] == ['4', '1', '3', '2']
+
+    def test_sort_4(self):
+        "Sort on a field no record has."
+        actual = self.store.search('genre', '*', sort='feast_code asc')
+        assert [doc['id'] for doc in actual] == ['3', '1', '2', '4']
+
+
+class TestAskById(shared.TestHandler):
+    '''
+    Tests for abbot.taxonomy.ask_by_id() and TaxonomyStore.load().
+    '''
+
+    def setUp(self):
+        super(TestAskById, self).setUp()
+        self.solr = self.setUpSolr()
+
+    @testing.gen_test
+    def test_ask_1(self):
+        "When the type is not in the store, Solr is asked."
+        self.solr.search_se.add('id:162', {'id': '162'})
+        actual = yield taxonomy.ask_by_id('genre', '162')
+        assert actual.docs == [{'id': '162'}]
+        self.solr.search.assert_called_with('+type:genre +id:162', df='default_search')
+
+    @testing.gen_test
+    def test_ask_2(self):
+        "When the type is in the store, Solr is not asked."
+        taxonomy.STORE.replace('genre', GENRES)
+        actual = yield taxonomy.ask_by_id('genre', '1')
+        assert actual.docs == [GENRES[1]]
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_ask_4(self):
+        "With a cursor, Solr is asked even when the type is in the store."
+        taxonomy.STORE.replace('genre', GENRES)
+        self.solr.search_se.add('id:*', GENRES[0])
+        yield taxonomy.ask_by_id('genre', '*', sort='id asc', cursor='*')
+        self.solr.search.assert_called_with('+type:genre +id:*', df='default_search', sort='id asc',
+                                            cursorMark='*')
+
+    @testing.gen_test
+    def test_ask_3(self):
+        "An invalid ID raises ValueError even when the store answers."
+        taxonomy.STORE.replace('genre', GENRES)
+        with pytest.raises(ValueError):
+            yield taxonomy.ask_by_id('genre', '-1')
+
+    @testing.gen_test
+    def test_load_1(self):
+        "load() asks Solr for every type and fills the store."
+        self.solr.search_se.add('type:genre', GENRES[0])
+        yield taxonomy.STORE.load()
+        for q_type in taxonomy.TAXONOMY_TYPES:
+            self.solr.search.assert_any_call('type:{}'.format(q_type), rows=taxonomy._MAX_ROWS,
+                                             df='default_search')
+        assert taxonomy.STORE.has('genre')
+        assert taxonomy.STORE.search('genre', '3').docs == [GENRES[0]]
+
+    @mock.patch('abbot.taxonomy.log.warn')
+    @testing.gen_test
+    def test_load_2(self, mock_warn):
+        "When Solr fails, the previous records are kept."
+        taxonomy.STORE.replace('genre', GENRES)
+        self.solr.search = mock.Mock(side_effect=pysolrtornado.SolrError('test_load_2()'))
+        yield taxonomy.STORE.load()
+        assert taxonomy.STORE.has('genre')
+        assert mock_warn.call_count == len(taxonomy.TAXONOMY_TYPES)
+
+    @mock.patch('abbot.taxonomy.log.warn')
+    @testing.gen_test
+    def test_load_3(self, mock_warn):
+        "A type with more records than Solr returned is left in Solr."
+        results = shared.make_results(GENRES)
+        results.hits = taxonomy._MAX_ROWS + 1
+        self.solr.search = mock.Mock(return_value=shared.make_future(results))
+        yield taxonomy.STORE.load()
+        assert not taxonomy.STORE.has('genre')
+
+    @testing.gen_test
+    def test_browse_request(self):
+        "An integration test: a browse request is answered from the store."
+        taxonomy.STORE.replace('genre', GENRES)
+        headers = {'X-Cantus-Sort': 'id;desc', 'X-Cantus-Per-Page': '2'}
+        actual = yield self.http_client.fetch(self.get_url('/genres/'), headers=headers)
+        assert actual.headers['X-Cantus-Total-Results'] == '4'
+        actual = escape.json_decode(actual.body)
+        assert actual['sort_order'] == ['4', '3']
+        assert self.solr.search.call_count == 0
@@ -37,10 +37,14 @@ from unittest import mock, TestCase
 
 from hypothesis import given, strategies as strats
 import parsimonious
+import pysolrtornado
 import pytest
-from tornado import gen, testing, web
+from tornado import concurrent, gen, testing, web
+from tornado.options import options
 
 from abbot import __main__ as main
+from abbot import generation
+from abbot import limiter
 from abbot import util
 import shared
 
@@ -100,15 +104,184 @@ class TestSolrAskers(shared.TestHandler):
         assert len(actual) == 0
         assert self.solr.search.call_count == 0
 
+    @testing.gen_test
+    def test_search_solr_4(self):
+        "Identical queries in flight at the same time share one Solr request."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        first = util.search_solr('q', rows=5)
+        second = util.search_solr('q', rows=5)
+        assert self.solr.search.call_count == 1
+        response.set_result(shared.make_results([{'id': '1'}]))
+        first = yield first
+        second = yield second
+        assert first is second
+        assert util._IN_FLIGHT == {}
+
+    @testing.gen_test
+    def test_search_solr_5(self):
+        "Queries that differ in any parameter are not shared."
+        self.solr.search = mock.Mock(side_effect=lambda *args, **kwargs: concurrent.Future())
+        util.search_solr('q', rows=5)
+        util.search_solr('q', rows=6)
+        util.search_solr('q', rows=5, start=5)
+        util.search_solr('q', rows=5, sort='id asc')
+        util.search_solr('r', rows=5)
+        assert self.solr.search.call_count == 5
+        util._IN_FLIGHT.clear()
+
+    @testing.gen_test
+    def test_search_solr_6(self):
+        "Once a query is finished, the same query asks Solr again."
+        yield util.search_solr('q')
+        yield util.search_solr('q')
+        assert self.solr.search.call_count == 2
+
+    @testing.gen_test
+    def test_search_solr_7(self):
+        "When Solr fails, every call sharing the request gets the error."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        first = util.search_solr('q')
+        second = util.search_solr('q')
+        response.set_exception(pysolrtornado.SolrError('test_search_solr_7()'))
+        with pytest.raises(pysolrtornado.SolrError):
+            yield first
+        with pytest.raises(pysolrtornado.SolrError):
+            yield second
+        assert util._IN_FLIGHT == {}
+
+    @testing.gen_test
+    def test_search_solr_8(self):
+        "The 'fields' are sent as 'fl', and requests for different fields are not shared."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        first = util.search_solr('q', fields=['id', 'name'])
+        second = util.search_solr('q', fields=['id'])
+        response.set_result(shared.make_results([{'id': '1'}]))
+        yield [first, second]
+        self.solr.search.assert_any_call('q', df='default_search', fl='id,name')
+        self.solr.search.assert_any_call('q', df='default_search', fl='id')
+        assert self.solr.search.call_count == 2
+
+    @testing.gen_test
+    def test_search_solr_9(self):
+        "The 'cursor' is sent as 'cursorMark'."
+        yield util.search_solr('q', rows=5, sort='id asc', cursor='*')
+        self.solr.search.assert_called_with('q', df='default_search', rows=5, sort='id asc',
+                                            cursorMark='*')
+
+    @testing.gen_test
+    def test_search_solr_10(self):
+        "When the deadline has passed, Solr is not asked."
+        deadline = self.io_loop.time() - 1.0
+        with pytest.raises(util.DeadlineExceeded):
+            yield util.search_solr('q', deadline=deadline)
+        assert self.solr.search.call_count == 0
+
+    @testing.gen_test
+    def test_search_solr_11(self):
+        "When Solr is slower than the deadline, DeadlineExceeded is a SolrError."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        with pytest.raises(pysolrtornado.SolrError) as exc:
+            yield util.search_solr('q', deadline=self.io_loop.time() + 0.01)
+        assert isinstance(exc.value, util.DeadlineExceeded)
+
+    @testing.gen_test
+    def test_search_solr_12(self):
+        "A call that stops at its deadline leaves the query in flight for the others sharing it."
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        first = util.search_solr('q', deadline=self.io_loop.time() + 0.01)
+        second = util.search_solr('q')
+        with pytest.raises(util.DeadlineExceeded):
+            yield first
+        assert 'q' in [key[0] for key in util._IN_FLIGHT]
+        response.set_result(shared.make_results([{'id': '1'}]))
+        second = yield second
+        assert second.docs == [{'id': '1'}]
+        assert self.solr.search.call_count == 1
+        assert util._IN_FLIGHT == {}
+
+    @testing.gen_test
+    def test_search_solr_13(self):
+        "Solr answering before the deadline is no different from no deadline."
+        self.solr.search_se.add('q', {'id': '1'})
+        actual = yield util.search_solr('q', deadline=self.io_loop.time() + 5.0)
+        assert actual.docs == [{'id': '1'}]
+
+    @testing.gen_test
+    def test_search_solr_14(self):
+        "A query holds its place in the limiter until Solr answers."
+        the_limiter = limiter.AdaptiveLimiter(1)
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        with mock.patch('abbot.util.LIMITER', the_limiter):
+            first = util.search_solr('q')
+            second = util.search_solr('r')
+            assert the_limiter.in_flight == 1
+            assert the_limiter.queued == 1
+            assert self.solr.search.call_count == 1
+            response.set_result(shared.make_results([{'id': '1'}]))
+            yield [first, second]
+        assert self.solr.search.call_count == 2
+        assert the_limiter.in_flight == 0
+
+    @testing.gen_test
+    def test_search_solr_15(self):
+        "When the limiter's queue is full, Overloaded is a SolrError and Solr is not asked."
+        the_limiter = limiter.AdaptiveLimiter(1, queue_size=0)
+        the_limiter.in_flight = 1
+        with mock.patch('abbot.util.LIMITER', the_limiter):
+            with pytest.raises(pysolrtornado.SolrError) as exc:
+                yield util.search_solr('q')
+        assert isinstance(exc.value, util.Overloaded)
+        assert self.solr.search.call_count == 0
+        assert the_limiter.rejected == 1
+
+    @testing.gen_test
+    def test_search_solr_16(self):
+        "A query whose deadline passes while it waits for the limiter is never sent."
+        the_limiter = limiter.AdaptiveLimiter(1)
+        the_limiter.in_flight = 1
+        with mock.patch('abbot.util.LIMITER', the_limiter):
+            with pytest.raises(util.DeadlineExceeded):
+                yield util.search_solr('q', deadline=self.io_loop.time() + 0.01)
+        assert self.solr.search.call_count == 0
+        assert the_limiter.queued == 0
+
+    @testing.gen_test
+    def test_search_solr_17(self):
+        "A query that waited for the limiter shares an identical query sent in the meantime."
+        the_limiter = limiter.AdaptiveLimiter(2)
+        response = concurrent.Future()
+        self.solr.search = mock.Mock(return_value=response)
+        with mock.patch('abbot.util.LIMITER', the_limiter):
+            the_limiter.in_flight = 2  # two other queries
+            first = util.search_solr('q')
+            second = util.search_solr('q')
+            the_limiter.release()
+            yield gen.sleep(0.01)
+            the_limiter.release()
+            yield gen.sleep(0.01)
+            assert self.solr.search.call_count == 1
+            assert the_limiter.in_flight == 1
+            response.set_result(shared.make_results([{'id': '1'}]))
+            first, second = yield [first, second]
+        assert first.docs == second.docs == [{'id': '1'}]
+        assert self.solr.search.call_count == 1
+        assert the_limiter.in_flight == 0
+
     @testing.gen_test
     def test_ask_solr_by_id_1(self):
         "Ensure everything gets passed to search_solr()."
         expected = {'a': 'search results'}
         self.solr.search_se.add('id:162', expected)
-        actual = yield util.ask_solr_by_id('genre', '162', start=1, rows=2, sort=3)
+        actual = yield util.ask_solr_by_id('genre', '162', start=1, rows=2, sort=3, fields=['id'])
         assert [expected] == actual.docs
         self.solr.search.assert_called_with('+type:genre +id:162', start=1, rows=2, sort=3,
-            df='default_search')
+            df='default_search', fl='id')
 
 
 class TestFormattedSorts(TestCase):
@@ -189,6 +362,17 @@ class TestFormattedSorts(TestCase):
         actual = util.postpare_formatted_sort(sort)
         self.assertEqual(expected, actual)
 
+    def test_cursor_sort_1(self):
+        "The 'id' tiebreak is added to a sort without it, and to Solr's default sort."
+        assert util.make_cursor_sort('incipit asc') == 'incipit asc,id asc'
+        assert util.make_cursor_sort(None) == 'score desc,id asc'
+
+    def test_cursor_sort_2(self):
+        "A sort that already has 'id' is not changed."
+        assert util.make_cursor_sort('id desc') == 'id desc'
+        assert util.make_cursor_sort('incipit asc,id desc') == 'incipit asc,id desc'
+        assert util.make_cursor_sort('cantus_id asc') == 'cantus_id asc,id asc'
+
 
 class TestParseFieldsHeader(TestCase):
     '''
@@ -471,6 +655,27 @@ class TestParseQuery(TestCase):
     Tests for util.parse_query().
     '''
 
+    def setUp(self):
+        util.QUERY_CACHE.clear()
+
+    def test_cache_1(self):
+        "The same query string is only parsed once, and the result may be modified safely."
+        first = util.parse_query('genre:antiphon')
+        first.append('AND')
+        with mock.patch('abbot.search_grammar.parse') as mock_parse:
+            second = util.parse_query('genre:antiphon')
+        assert mock_parse.call_count == 0
+        assert second == [('genre', 'antiphon')]
+
+    def test_cache_2(self):
+        "A query that cannot be parsed is not cached."
+        misses = util.QUERY_CACHE.misses
+        for _ in range(2):
+            with pytest.raises(util.InvalidQueryError):
+                util.parse_query('size: drink:Dunkelweiß')
+        assert len(util.QUERY_CACHE) == 0
+        assert util.QUERY_CACHE.misses == misses + 2
+
     def test_basics(self):
         '''
         Basics:
@@ -1020,7 +1225,7 @@ class TestQueryParserAsync(shared.TestHandler):
         components = [('genre', 'antiphon')]
         with pytest.raises(util.InvalidQueryError):
             yield util.run_subqueries(components)
-        self.solr.search.assert_called_with('type:genre AND (antiphon)', df='default_search')
+        self.solr.search.assert_called_with('type:genre AND (antiphon)', df='default_search', fl='id')
 
     @testing.gen_test
     def test_run_subqueries_7(self):
@@ -1070,6 +1275,76 @@ class TestQueryParserAsync(shared.TestHandler):
 
         self.assertEqual(expected, actual)
 
+    @testing.gen_test
+    def test_run_subqueries_concurrent(self):
+        '''
+        Every subquery is sent before any of them has a response, and the results are put in the
+        order of the original query.
+
+            "genre:antiphon AND feast:Pascha AND office:Matins"
+        '''
+        responses = [concurrent.Future() for _ in range(3)]
+        self.solr.search = mock.Mock(side_effect=responses)
+        components = [('genre', 'antiphon'), 'AND', ('feast', 'Pascha'), 'AND', ('office', 'Matins')]
+
+        actual = util.run_subqueries(components)
+        assert self.solr.search.call_count == 3
+
+        # responses arrive in the opposite order
+        for each_id, response in reversed(list(zip(('1', '2', '3'), responses))):
+            response.set_result(shared.make_results([{'id': each_id}]))
+        actual = yield actual
+
+        assert actual == [('genre_id', '1'), 'AND', ('feast_id', '2'), 'AND', ('office_id', '3')]
+
+    @testing.gen_test
+    def test_run_subqueries_cache_1(self):
+        "A subquery that was answered is not sent to Solr again."
+        self.solr.search_se.add('type:genre AND (antiphon)', {'id': '162', 'type': 'genre'})
+        components = [('genre', 'antiphon')]
+
+        first = yield util.run_subqueries(components)
+        second = yield util.run_subqueries(components)
+
+        assert first == second == [('genre_id', '162')]
+        assert self.solr.search.call_count == 1
+
+    @testing.gen_test
+    def test_run_subqueries_cache_2(self):
+        "A subquery with no results is cached, and still raises InvalidQueryError."
+        components = [('genre', 'zzz')]
+        for _ in range(2):
+            with pytest.raises(util.InvalidQueryError):
+                yield util.run_subqueries(components)
+        assert self.solr.search.call_count == 1
+
+    @testing.gen_test
+    def test_run_subqueries_cache_3(self):
+        "When the data generation changes, the cache is emptied."
+        self.solr.search_se.add('type:genre AND (antiphon)', {'id': '162', 'type': 'genre'})
+        components = [('genre', 'antiphon')]
+
+        yield util.run_subqueries(components)
+        generation.CURRENT.update('test_run_subqueries_cache_3()', None)
+        yield util.run_subqueries(components)
+
+        assert self.solr.search.call_count == 2
+
+    @testing.gen_test
+    def test_run_subqueries_cache_4(self):
+        "A cached subquery is still used when the cache evicts it while the others are answered."
+        self.solr.search_se.add('type:genre AND (A)', {'id': '162', 'type': 'genre'})
+        self.solr.search_se.add('type:feast AND (B)', {'id': '1492', 'type': 'feast'})
+        yield util.run_subqueries([('genre', 'A')])
+        util.SUBQUERY_CACHE.resize(maxsize=1)
+        try:
+            actual = yield util.run_subqueries([('feast', 'B'), 'AND', ('genre', 'A')])
+        finally:
+            util.SUBQUERY_CACHE.resize(maxsize=options.subquery_cache_size)
+
+        assert actual == [('feast_id', '1492'), 'AND', ('genre_id', '162')]
+        assert self.solr.search.call_count == 2
+
     @testing.gen_test
     def test_run_subqueries_10(self):
         '''
@@ -26,19 +26,103 @@
 Utility functions for the Abbot server.
 '''
 
-from tornado import gen
+import functools
+import time
+
+from tornado import gen, ioloop
 from tornado.log import app_log as log
 from tornado.options import options
 import pysolrtornado
 
+from abbot import cache
+from abbot import limiter
+from abbot import metrics
+from abbot import query_parser
 from abbot import search_grammar
+from abbot import solr_client
 
 
 options.define('solr_url', type=str, help='Full URL path to the Solr instance and collection.',
                default='http://localhost:8983/solr/collection1/')
+options.define('query_cache_size', type=int, default=1024,
+               help='maximum number of parsed SEARCH query strings to cache (0 to disable)',
+               callback=lambda size: QUERY_CACHE.resize(maxsize=size))
+options.define('subquery_cache_size', type=int, default=1024,
+               help='maximum number of cross-reference subquery results to cache (0 to disable)',
+               callback=lambda size: SUBQUERY_CACHE.resize(maxsize=size))
+options.define('subquery_cache_ttl', type=int, default=3600,
+               help='number of seconds a cached cross-reference subquery result stays valid',
+               callback=lambda ttl: SUBQUERY_CACHE.resize(ttl=ttl))
+
+
+SOLR = None
+'''
+The :class:`~abbot.solr_client.SolrClient` instance used for every query. It is made by
+:func:`connect_solr` after the options are loaded, in every process that will use it.
+'''
+
+
+LIMITER = None
+'''
+The :class:`~abbot.limiter.AdaptiveLimiter` for every query sent to :const:`SOLR`, or ``None`` for
+no limit. It is made by :func:`connect_solr` along with :const:`SOLR`.
+'''
+
+
+def connect_solr():
+    '''
+    Make the :const:`SOLR` and :const:`LIMITER` instances using the "solr_url" and other "solr_*"
+    options.
+
+    The instance belongs to the IOLoop of the process that calls this function, so with several
+    worker processes you must call it in each worker, after forking.
+
+    :returns: The new :const:`SOLR` instance.
+    :rtype: :class:`~abbot.solr_client.SolrClient`
+    '''
+    global SOLR, LIMITER  # pylint: disable=global-statement
+    SOLR = solr_client.from_options()
+    LIMITER = limiter.from_options()
+    return SOLR
+
+
+def _collect_solr_metrics():
+    "Update the Solr metrics in :mod:`abbot.metrics` from :const:`SOLR` and :const:`LIMITER`."
+    if SOLR is not None:
+        stats = SOLR.stats()
+        metrics.SOLR_IN_FLIGHT.set(stats['in_flight'])
+        metrics.SOLR_QUEUED.set(stats['queued'])
+        metrics.SOLR_MAX_CLIENTS.set(stats['max_clients'])
+    if LIMITER is not None:
+        stats = LIMITER.stats()
+        metrics.SOLR_LIMIT.set(stats['limit'])
+        metrics.SOLR_LIMIT_QUEUED.set(stats['queued'])
+        metrics.SOLR_REJECTED.set(stats['rejected'])
+
+metrics.add_collector(_collect_solr_metrics)
+
+
+QUERY_CACHE = cache.LRUCache(options.query_cache_size)
+'''
+Process-wide cache of :func:`parse_query` results, keyed on the query string. The values are tuples
+so they cannot be modified by accident.
+'''
+
+SUBQUERY_CACHE = cache.LRUCache(options.subquery_cache_size, options.subquery_cache_ttl)
+'''
+Process-wide cache of the query components that :func:`run_subqueries` makes for cross-referenced
+fields, keyed on the field and the subquery. A subquery with no results is cached as ``None``. The
+cache must be cleared when the data change.
+'''
 
+metrics.watch_cache('query', QUERY_CACHE)
+metrics.watch_cache('subquery', SUBQUERY_CACHE)
 
-SOLR = pysolrtornado.Solr(options.solr_url, timeout=10)
+_NOT_CACHED = object()
+# for run_subqueries(), since None is a cached value in SUBQUERY_CACHE
+
+_IN_FLIGHT = {}
+# for search_solr(): (query, start, rows, sort) -> Future for the Solr response to that query
 
 
 # error messages for prepare_formatted_sort()
@@ -55,6 +139,10 @@ _INVALID_QUERY = 'Invalid search query.'
 # error message for _verify_resource_id()
 _INVALID_ID = 'Invalid resource ID for the Cantus API.'
 
+# error message for search_solr()
+_DEADLINE_EXCEEDED = 'The deadline passed before Solr answered "{}"'
+_OVERLOADED = 'Too many queries are waiting for Solr to send "{}"'
+
 # Used by prepare_formatted_sort() and assemble_query(). Put here, they might be used by
 # other methods to check whether they have proper values for these things.
 ALLOWED_CHARS = ',;_'
@@ -88,6 +176,24 @@ class InvalidQueryError(ValueError):
     pass
 
 
+class DeadlineExceeded(pysolrtornado.SolrError):
+    '''
+    Raised by :func:`search_solr` when the deadline of a query passes before Solr answers. It is a
+    :exc:`~pysolrtornado.SolrError`, so code that handles Solr errors also handles deadlines.
+    '''
+
+    pass
+
+
+class Overloaded(pysolrtornado.SolrError):
+    '''
+    Raised by :func:`search_solr` when a query is refused because too many others are waiting for
+    Solr (see :mod:`abbot.limiter`). Like :exc:`DeadlineExceeded`, it is a
+    :exc:`~pysolrtornado.SolrError`.
+    '''
+
+    pass
+
 
 def singular_resource_to_plural(singular):
     '''
@@ -200,6 +306,33 @@ def postpare_formatted_sort(sort):
     return ','.join(sort)
 
 
+def make_cursor_sort(sort):
+    '''
+    Prepare a Solr "sort" parameter for use with a cursor. Solr requires the sort to include the
+    "id" field, so that every record has a single place in the order, so this function adds it
+    unless it's already there.
+
+    :param str sort: The Solr "sort" parameter as returned by :func:`prepare_formatted_sort`, or
+        ``None`` for Solr's default order (by relevance).
+    :returns: The sort parameter, ending with "id" if it didn't already include it.
+    :rtype: str
+
+    **Examples**
+
+    >>> make_cursor_sort('incipit asc')
+    'incipit asc,id asc'
+    >>> make_cursor_sort(None)
+    'score desc,id asc'
+    >>> make_cursor_sort('id desc')
+    'id desc'
+    '''
+    if not sort:
+        sort = 'score desc'
+    if 'id' in [each_sort.split()[0] for each_sort in sort.split(',')]:
+        return sort
+    return '{},id asc'.format(sort)
+
+
 def parse_fields_header(header, returned_fields):
     '''
     Parse the value of an X-Cantus-Fields request header into a list of strings that contain valid
@@ -279,7 +412,8 @@ def _verify_resource_id(q_id):
 
 
 @gen.coroutine
-def ask_solr_by_id(q_type, q_id, start=None, rows=None, sort=None):
+def ask_solr_by_id(q_type, q_id, start=None, rows=None, sort=None, fields=None, cursor=None,
+                   caller='other', deadline=None):
     '''
     Query the Solr server for a record of "q_type" with an id of "q_id." The values are put directly
     into the Solr "q" parameter, so you may use any syntax allowed by the standard query parser.
@@ -292,6 +426,10 @@ def ask_solr_by_id(q_type, q_id, start=None, rows=None, sort=None):
     :param start: As described in :func:`search_solr`.
     :param rows: As described in :func:`search_solr`.
     :param sort: As described in :func:`search_solr`.
+    :param fields: As described in :func:`search_solr`.
+    :param cursor: As described in :func:`search_solr`.
+    :param caller: As described in :func:`search_solr`.
+    :param deadline: As described in :func:`search_solr`.
     :returns: As described in :func:`search_solr`.
     :raises: :exc:`pysolrtornado.SolrError` as described in :func:`search_solr`.
     :raises: :exc:`ValueError` when the `q_id` is invalid as per the Cantus API.
@@ -308,11 +446,13 @@ def ask_solr_by_id(q_type, q_id, start=None, rows=None, sort=None):
     <pysolrtornado results thing>
     '''
     _verify_resource_id(q_id)
-    return (yield search_solr('+type:{} +id:{}'.format(q_type, q_id), start=start, rows=rows, sort=sort))
+    return (yield search_solr('+type:{} +id:{}'.format(q_type, q_id), start=start, rows=rows, sort=sort,
+                              fields=fields, cursor=cursor, caller=caller, deadline=deadline))
 
 
 @gen.coroutine
-def search_solr(query, start=None, rows=None, sort=None):
+def search_solr(query, start=None, rows=None, sort=None, fields=None, cursor=None, caller='other',
+                deadline=None):
     '''
     Query the Solr server.
 
@@ -325,9 +465,31 @@ def search_solr(query, start=None, rows=None, sort=None):
         to include for a single search). Default is Solr default (effectively 10).
     :param str sort: The "sort" field to use when calling Solr, like ``'incipit asc'`` or
         ``'cantus_id desc'``. Default is Solr default.
+    :param fields: The fields Solr should return for every record (its "fl" parameter). Default is
+        every stored field. Records do not hold fields they lack, even when the fields are requested.
+    :type fields: list of str
+    :param str cursor: The "cursorMark" to use when calling Solr: ``'*'`` for the first page of
+        results, or the "nextCursorMark" of the previous page. Solr refuses a cursor with a
+        ``start``, or with a ``sort`` that lacks the "id" field; see :func:`make_cursor_sort`.
+    :param str caller: The "caller" label of this query in :mod:`abbot.metrics`, like
+        ``'basic_get'``. It does not change the query.
+    :param float deadline: The time, from :meth:`IOLoop.time`, by which Solr must answer. The
+        default, ``None``, waits as long as the Solr client allows (the "solr_request_timeout"
+        option).
     :returns: Results from the Solr server, in an object that acts like a list of dicts.
     :rtype: :class:`pysolrtornado.Results`
     :raises: :exc:`pysolrtornado.SolrError` when there's an error while connecting to Solr.
+    :raises: :exc:`DeadlineExceeded` when the ``deadline`` passes first. If it has already passed,
+        the query is not sent to Solr at all.
+    :raises: :exc:`Overloaded` when :const:`LIMITER` refuses the query.
+
+    When this function is called while an identical query (with the same ``start``, ``rows``,
+    ``sort``, ``fields``, and ``cursor``) is waiting for Solr, both calls share the same response. Therefore you must not modify
+    the :class:`Results` or the records it holds. A call that stops waiting at its ``deadline`` does
+    not stop the Solr request, so the other calls still get the response.
+
+    A new query waits for a place in :const:`LIMITER` before it is sent, and keeps its place until
+    Solr answers, even if the call stops waiting at its ``deadline``.
     '''
     extra_params = {}
     if start:
@@ -336,14 +498,81 @@ def search_solr(query, start=None, rows=None, sort=None):
         extra_params['rows'] = rows
     if sort:
         extra_params['sort'] = sort
+    if fields:
+        fields = tuple(fields)
+        extra_params['fl'] = ','.join(fields)
+    if cursor:
+        extra_params['cursorMark'] = cursor
 
-    if query:
-        log.debug('util.search_solr() submits "{}"'.format(query))
-        return (yield SOLR.search(query, df='default_search', **extra_params))
-    else:
+    if not query:
         log.debug('util.search_solr() received empty query')
         return pysolrtornado.Results({})
 
+    if deadline is not None and ioloop.IOLoop.current().time() >= deadline:
+        metrics.SOLR_ERRORS.inc(caller)
+        raise DeadlineExceeded(_DEADLINE_EXCEEDED.format(query))
+
+    # if the same query is already in flight, wait for its response instead of asking Solr again
+    key = (query, start, rows, sort, fields, cursor)
+    if key in _IN_FLIGHT:
+        log.debug('util.search_solr() joins in-flight "{}"'.format(query))
+        metrics.SOLR_SHARED.inc(caller)
+        return (yield _wait_for_solr(_IN_FLIGHT[key], query, deadline))
+
+    the_limiter = LIMITER
+    if the_limiter is not None:
+        try:
+            yield the_limiter.acquire(deadline)
+        except limiter.QueueFull:
+            raise Overloaded(_OVERLOADED.format(query))
+        except gen.TimeoutError:
+            metrics.SOLR_ERRORS.inc(caller)
+            raise DeadlineExceeded(_DEADLINE_EXCEEDED.format(query))
+
+        # while this query waited, an identical one may have been sent
+        if key in _IN_FLIGHT:
+            the_limiter.release()
+            metrics.SOLR_SHARED.inc(caller)
+            return (yield _wait_for_solr(_IN_FLIGHT[key], query, deadline))
+
+    log.debug('util.search_solr() submits "{}"'.format(query))
+    started = time.monotonic()
+    future = SOLR.search(query, df='default_search', **extra_params)
+    _IN_FLIGHT[key] = future
+    future.add_done_callback(functools.partial(_forget_in_flight, key))
+    if the_limiter is not None:
+        future.add_done_callback(functools.partial(_release_limiter, the_limiter, started, caller))
+    try:
+        return (yield _wait_for_solr(future, query, deadline))
+    except pysolrtornado.SolrError:
+        metrics.SOLR_ERRORS.inc(caller)
+        raise
+    finally:
+        metrics.SOLR_DURATION.observe(time.monotonic() - started, caller)
+
+
+def _forget_in_flight(key, future):
+    "Remove a finished query from _IN_FLIGHT, unless another query has taken its place."
+    if _IN_FLIGHT.get(key) is future:
+        del _IN_FLIGHT[key]
+
+
+def _release_limiter(the_limiter, started, caller, future):
+    "Give up the place in the limiter of a query that Solr has answered."
+    the_limiter.release(started, failed=future.exception() is not None, kind=caller)
+
+
+@gen.coroutine
+def _wait_for_solr(future, query, deadline):
+    "Wait for the Solr response in ``future`` until the ``deadline``, as in :func:`search_solr`."
+    if deadline is None:
+        return (yield future)
+    try:
+        return (yield gen.with_timeout(deadline, future,
+                                       quiet_exceptions=(pysolrtornado.SolrError,)))
+    except gen.TimeoutError:
+        raise DeadlineExceeded(_DEADLINE_EXCEEDED.format(query))
+
 
 def request_wrapper(func):
     '''
@@ -425,10 +654,15 @@ def parse_query(query):
     '''
     Parse a user-submitted query string into a list of field/value tuples.
 
-    :param str query: The raw, user-submitted search query string.
+    :param str query: The raw, user-submitted search query string. You may also give a tree
+        already parsed by :func:`search_grammar.parse`.
     :returns: A list of parsed query components (see below).
     :rtype: list of 2-tuple of str
-    :raises: :exc:`InvalidQueryError` when the search query string is invalid.
+    :raises: :exc:`InvalidQueryError` when the search query string is invalid, longer than
+        :const:`query_parser.MAX_LENGTH`, or nested more than :const:`query_parser.MAX_DEPTH` deep.
+
+    Query strings are parsed by :func:`query_parser.parse`, which accepts the same language as the
+    Parsimonious grammar in :mod:`search_grammar` but runs in linear time.
 
 
     **Return Value**
@@ -480,14 +714,35 @@ def parse_query(query):
     '''
 
     if isinstance(query, str):
+        cached = QUERY_CACHE.get(query)
+        if cached is not None:
+            return list(cached)
+
         log.debug('util.parse_query() begins "{}"'.format(query))
         try:
-            parsed = search_grammar.parse(query)
+            post = query_parser.parse(query)
         except RuntimeError:
             raise InvalidQueryError(_INVALID_QUERY)
+
+        QUERY_CACHE.put(query, tuple(post))
+        return post
+
     else:
-        parsed = query
+        return _parse_nodes(query)
 
+
+def _parse_nodes(parsed):
+    '''
+    Make the list of query components from a query parsed by :func:`search_grammar.parse`.
+
+    This is a helper function for :func:`parse_query`, which describes the return value. It is also
+    the reference against which :mod:`query_parser` is tested.
+
+    :param parsed: The parsed query, or a part of it.
+    :type parsed: :class:`parsimonious.nodes.Node`
+    :returns: The query components.
+    :rtype: list of str and 2-tuple of str
+    '''
     post = []
 
     for term in _collect_terms(parsed):
@@ -511,7 +766,7 @@ def parse_query(query):
                 if field.children[2].children[0].expr_name == 'grouped_term_list':
                     post.append((field.children[0].text, ''))
                     post.append('(')
-                    post.extend(parse_query(field.children[2]))
+                    post.extend(_parse_nodes(field.children[2]))
                     post.append(')')
                 else:
                     post.append((field.children[0].text, field.children[2].text))
@@ -519,7 +774,7 @@ def parse_query(query):
             elif field.expr_name == 'field_value':
                 if field.children[0].expr_name == 'grouped_term_list':
                     post.append('(')
-                    post.extend(parse_query(field))
+                    post.extend(_parse_nodes(field))
                     post.append(')')
                 else:
                     # This means "default_field"... because the rule for that is currently...
@@ -531,7 +786,7 @@ def parse_query(query):
 
 
 @gen.coroutine
-def run_subqueries(components):
+def run_subqueries(components, deadline=None):
     '''
     From the output of :func:`parse_query_components`, run cross-reference subqueries on the relevant
     fields. Returns the query components with cross-referenced fields substituted with the subquery
@@ -539,12 +794,18 @@ def run_subqueries(components):
 
     :param components: The output of :func:`parse_query_components`.
     :type components: list of str and 2-tuple of str
+    :param float deadline: As described in :func:`search_solr`, for every subquery.
     :returns: The cross-referenced. query components (see below).
     :rtype: list of str and 2-tuple of str
     :raises: :exc:`InvalidQueryError` if a cross-referenced field yields no results.
+    :raises: :exc:`pysolrtornado.SolrError` as described in :func:`search_solr`.
 
     .. note:: This function is a Tornado coroutine, so you must call it with a ``yield`` statement.
 
+    .. note:: All the subqueries are sent to Solr at once, so a query with several cross-referenced
+        fields waits about as long as a query with one. Subqueries answered recently (including
+        those with no results) are not sent again; see :const:`SUBQUERY_CACHE`.
+
     .. note:: In the future, this function may be modified according to whether server-side search
         help is requested, to modify cross-referenced fields with no results.
 
@@ -574,24 +835,24 @@ def run_subqueries(components):
     both "filling" IDs with an OR.
     '''
     reffed_comps = []
+    subqueries = []  # (index in reffed_comps, field, whether it's grouped, Future for the results)
 
+    # start every subquery, leaving a placeholder for its result
     enumerator = enumerate(components)
     for i, comp in enumerator:
         if comp[0] not in TRANSFORM_FIELDS:
             reffed_comps.append(comp)
         else:
             field = comp[0]
+            is_grouped = comp[1] == ''
 
-            if comp[1] == '':
+            if is_grouped:
                 # we have a situation like this:
                 #    century:(20th OR 21st)
 
                 # first use our helper function to figure out what this subquery should be
                 grouped = _make_xref_group(components, i)
-                results = yield search_solr(grouped[0])
-
-                if not results:
-                    raise InvalidQueryError('No results for cross-referenced field "{}"'.format(field))
+                subquery = grouped[0]
 
                 # Now skip through this subquery.
                 # The try/except deals with the subquery consuming the rest of the list.
@@ -605,34 +866,79 @@ def run_subqueries(components):
                     # execute, even though, in effect, it does execute.
                     pass
 
-                # and build the query
-                field_name = TRANSFORM_FIELDS[field]
-                subq_ids = ['{name}:{id}'.format(name=field_name, id=res['id']) for res in results]
-                reffed_comps.append(('default', '({})'.format(' OR '.join(subq_ids))))
-
             else:
-                results = yield search_solr('type:{} AND ({})'.format(field, comp[1]))
-
-                if not results:
-                    raise InvalidQueryError('No results for cross-referenced field "{}"'.format(field))
+                subquery = 'type:{} AND ({})'.format(field, comp[1])
+
+            subqueries.append((len(reffed_comps), field, is_grouped, subquery))
+            reffed_comps.append(None)
+
+    # start the subqueries that aren't cached; the cached components are copied now, since they
+    # may be evicted while we wait for the others
+    cached = {}
+    futures = {}
+    for _, field, _, subquery in subqueries:
+        key = (field, subquery)
+        if key in cached or key in futures:
+            continue
+        component = SUBQUERY_CACHE.get(key, _NOT_CACHED)
+        if component is _NOT_CACHED:
+            futures[key] = search_solr(subquery, fields=['id'], caller='run_subqueries',
+                                       deadline=deadline)
+        else:
+            cached[key] = component
+
+    # wait for them all at once, then fill in the placeholders in order
+    all_results = yield futures
+    for index, field, is_grouped, subquery in subqueries:
+        key = (field, subquery)
+        if key not in cached:
+            if all_results[key]:
+                cached[key] = _make_xref_component(field, is_grouped, all_results[key])
+            else:
+                cached[key] = None
+            SUBQUERY_CACHE.put(key, cached[key])
 
-                max_boost = len(results)  # so the min_boost is 1
-                if max_boost == 1:
-                    reffed_comps.append((TRANSFORM_FIELDS[field], results[0]['id']))
-                else:
-                    subq_ids = []
-                    field_name = TRANSFORM_FIELDS[field]
-                    for i, result in enumerate(results):
-                        subq_ids.append('{field}:{id}^{boost}'.format(
-                            field=field_name,
-                            id=result['id'],
-                            boost=(max_boost - i)
-                        ))
-                    reffed_comps.append(('default', '({})'.format(' OR '.join(subq_ids))))
+        if cached[key] is None:
+            raise InvalidQueryError('No results for cross-referenced field "{}"'.format(field))
+        reffed_comps[index] = cached[key]
 
     return reffed_comps
 
 
+def _make_xref_component(field, is_grouped, results):
+    '''
+    Make the query component that replaces a cross-referenced field, from the results of its
+    subquery.
+
+    This is a helper function for :func:`run_subqueries`, which describes the output.
+
+    :param str field: The cross-referenced field, like ``'genre'``.
+    :param bool is_grouped: Whether the subquery was for a group, like ``century:(20th OR 21st)``.
+    :param results: The results of the subquery, which must not be empty.
+    :type results: :class:`pysolrtornado.Results`
+    :returns: The query component.
+    :rtype: 2-tuple of str
+    '''
+    field_name = TRANSFORM_FIELDS[field]
+
+    if is_grouped:
+        subq_ids = ['{name}:{id}'.format(name=field_name, id=res['id']) for res in results]
+        return ('default', '({})'.format(' OR '.join(subq_ids)))
+
+    max_boost = len(results)  # so the min_boost is 1
+    if max_boost == 1:
+        return (field_name, results[0]['id'])
+    else:
+        subq_ids = []
+        for i, result in enumerate(results):
+            subq_ids.append('{field}:{id}^{boost}'.format(
+                field=field_name,
+                id=result['id'],
+                boost=(max_boost - i)
+            ))
+        return ('default', '({})'.format(' OR '.join(subq_ids)))
+
+
 def _make_xref_group(components, start):
     '''
     Given a list of query components and the index at which to start in the list, parse out the
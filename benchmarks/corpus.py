@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/corpus.py
+# Purpose:                Synthetic Cantus Database corpus for benchmarking Abbot.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Synthetic Cantus Database corpus for benchmarking Abbot.
+
+A :class:`Corpus` holds Solr documents shaped like those exported from the Cantus Database: every
+taxonomy type, sources, and chants, with the cross-references between them. The default size is
+about that of the real database (500,000 chants in 10,000 sources). The documents are made from a
+seeded random number generator, so the same arguments always give the same corpus, and the resource
+IDs are known without making the documents (see :meth:`Corpus.ids`), so the load-test driver can
+choose resources without holding the corpus itself.
+
+Run this module to write a corpus as newline-delimited JSON, which :mod:`benchmarks.fake_solr` can
+load instead of making its own:
+
+    $ python -m benchmarks.corpus --chants 50000 --sources 1000 > corpus.ndjson
+'''
+
+import argparse
+from collections import OrderedDict
+import json
+import random
+import sys
+
+
+TAXONOMY_SIZES = OrderedDict([
+    ('century', 20), ('feast', 1600), ('genre', 120), ('indexer', 300), ('notation', 30),
+    ('office', 20), ('portfolio', 10), ('provenance', 500), ('segment', 10), ('siglum', 400),
+    ('source_status', 8),
+])
+'''
+The number of resources of every taxonomy type, about as many as in the Cantus Database.
+'''
+
+ID_BASES = {'century': 1000, 'feast': 2000, 'genre': 4000, 'indexer': 5000, 'notation': 6000,
+            'office': 7000, 'portfolio': 8000, 'provenance': 9000, 'segment': 10000,
+            'siglum': 11000, 'source_status': 12000, 'source': 100000, 'chant': 1000000}
+'''
+The "id" of the first resource of every type. IDs are unique across types, as in Solr.
+'''
+
+TEXT_FIELDS = frozenset(['incipit', 'full_text', 'full_text_manuscript', 'full_text_simssa',
+                         'name', 'description', 'title', 'summary', 'notes', 'display_name',
+                         'given_name', 'family_name', 'institution', 'city', 'country',
+                         'liturgical_occasions', 'indexing_notes', 'provenance_detail'])
+'''
+The fields that Solr tokenizes, so they match single (case-insensitive) words. Other fields match
+only their whole value.
+'''
+
+DEFAULT_SEARCH_FIELDS = ('incipit', 'full_text', 'name', 'description', 'title', 'display_name',
+                         'siglum', 'rism', 'feast_code', 'cantus_id')
+'''
+The fields copied into Solr's "default_search" field, which Abbot uses as the default field.
+'''
+
+_WORDS = ('deus', 'in', 'adjutorium', 'meum', 'intende', 'domine', 'ad', 'adjuvandum', 'me',
+          'festina', 'gloria', 'patri', 'et', 'filio', 'spiritui', 'sancto', 'alleluia', 'ecce',
+          'dominus', 'veniet', 'virgo', 'maria', 'beata', 'sanctus', 'christus', 'natus', 'est',
+          'nobis', 'hodie', 'lux', 'magna', 'pax', 'terra', 'hominibus', 'bonae', 'voluntatis',
+          'laudate', 'pueri', 'nomen', 'domini', 'benedictus', 'qui', 'venit', 'regem', 'venturum',
+          'venite', 'adoremus', 'exsultemus', 'jubilemus', 'salutari', 'nostro', 'populus', 'sion',
+          'ierusalem', 'surge', 'illuminare', 'quia', 'angelus', 'apparuit', 'pastoribus', 'stella',
+          'magi', 'viderunt', 'gaudete', 'omnes', 'misericordia', 'veritas', 'obviaverunt',
+          'justitia', 'osculatae', 'sunt', 'rorate', 'caeli', 'desuper', 'nubes', 'pluant', 'justum')
+_GENRES = (('A', 'Antiphon'), ('R', 'Responsory'), ('V', 'Responsory verse'), ('H', 'Hymn'),
+           ('I', 'Invitatory antiphon'), ('In', 'Introit'), ('Gr', 'Gradual'), ('Al', 'Alleluia'),
+           ('Of', 'Offertory'), ('Cm', 'Communion'), ('Tc', 'Tract'), ('Sq', 'Sequence'),
+           ('Ky', 'Kyrie'), ('Gl', 'Gloria'), ('Sa', 'Sanctus'), ('Ag', 'Agnus Dei'),
+           ('W', 'Versicle'), ('Pr', 'Prefatio'), ('Ps', 'Psalm'), ('Tr', 'Trope'))
+_OFFICES = (('V', 'First Vespers'), ('C', 'Compline'), ('M', 'Matins'), ('L', 'Lauds'),
+            ('P', 'Prime'), ('T', 'Terce'), ('S', 'Sext'), ('N', 'None'), ('V2', 'Second Vespers'),
+            ('MI', 'Mass'), ('E', 'Antiphons for the Magnificat or Benedictus'),
+            ('R', 'Memorial chants'), ('X', 'Supplementary chants'), ('D', 'Day Hours'),
+            ('H', 'Antiphons for psalms of the Day Hours'), ('Q', 'Quodlibet'))
+_SEASONS = ('Adventus', 'Nativitas Domini', 'Epiphania', 'Septuagesima', 'Quadragesima',
+            'Passionis', 'Paschae', 'Ascensio Domini', 'Pentecostes', 'Trinitatis', 'Corporis Christi')
+_SAINTS = ('Andreae', 'Nicolai', 'Luciae', 'Thomae', 'Stephani', 'Johannis', 'Agnetis', 'Agathae',
+           'Gregorii', 'Benedicti', 'Georgii', 'Marci', 'Philippi et Jacobi', 'Petri et Pauli',
+           'Mariae Magdalenae', 'Laurentii', 'Augustini', 'Michaelis', 'Martini', 'Caeciliae',
+           'Clementis', 'Catharinae', 'Galli', 'Otmari', 'Afrae', 'Udalrici', 'Vincentii')
+_FIRST_NAMES = ('Debra', 'Jan', 'Gabriel', 'Ruth', 'Barbara', 'Anna', 'Michael', 'Lila', 'Karl',
+                'Hélène', 'Andrew', 'Jennifer', 'Kate', 'David', 'Rebecca', 'Maria', 'Sarah')
+_FAMILY_NAMES = ('Lacoste', 'Koláček', 'Steiner', 'Helsen', 'Swanson', 'Hankeln', 'Bacciagaluppi',
+                 'Wong', 'Boyce', 'Hiley', 'Crocker', 'Dobszay', 'Bruin', 'Walters')
+_CITIES = (('Zürich', 'Switzerland', 'CH-Zz'), ('St. Gallen', 'Switzerland', 'CH-SGs'),
+           ('Graz', 'Austria', 'A-Gu'), ('Klosterneuburg', 'Austria', 'A-KN'),
+           ('Paris', 'France', 'F-Pn'), ('London', 'United Kingdom', 'GB-Lbl'),
+           ('Toledo', 'Spain', 'E-Tc'), ('Kraków', 'Poland', 'PL-Kk'),
+           ('Waterloo', 'Canada', 'CDN-Wu'), ('Firenze', 'Italy', 'I-Fl'),
+           ('Praha', 'Czech Republic', 'CZ-Pu'), ('München', 'Germany', 'D-Mbs'))
+_NOTATIONS = ('German neumes', 'Square notation', 'Gothic', 'Aquitanian', 'Beneventan',
+              'St. Gall neumes', 'Messine neumes', 'Hufnagel', 'Staffless neumes', 'Mensural')
+_SEGMENTS = ('CANTUS Database', 'Sequence database', 'Hispanic Chant', 'Bower Sequences',
+             'Gradual Database', 'Old Hispanic Chant', 'Tropes', 'Processionals', 'Hymns',
+             'Offices')
+_STATII = ('Published / Complete', 'Published / Partial inventory', 'Unpublished / Indexed',
+           'Unpublished / Proofread', 'Unpublished / In progress', 'Unpublished / Indexing process',
+           'Published / Proofread pending', 'Unpublished / Proofread pending')
+_VOLPIANO_NOTES = 'fghjklmnop'
+
+
+def _rng(seed, part):
+    "A random number generator for one part of the corpus, so the parts are independent."
+    return random.Random('{}-{}'.format(seed, part))
+
+
+class Corpus(object):
+    '''
+    A synthetic set of Cantus Database documents, as Solr holds them.
+    '''
+
+    def __init__(self, chants=500000, sources=10000, seed=0):
+        '''
+        :param int chants: The number of chants.
+        :param int sources: The number of sources. The chants are divided among them evenly.
+        :param seed: The seed for the random number generator.
+        '''
+        if sources > ID_BASES['chant'] - ID_BASES['source']:
+            raise ValueError('too many sources')
+        self.num_chants = chants
+        self.num_sources = max(1, sources)
+        self.seed = seed
+        self.sizes = OrderedDict(TAXONOMY_SIZES)
+        self.sizes['source'] = self.num_sources
+        self.sizes['chant'] = self.num_chants
+
+    def ids(self, type_name):
+        '''
+        :param str type_name: A resource type, like ``'chant'``.
+        :returns: The "id" of every resource of that type.
+        :rtype: list of str
+        '''
+        base = ID_BASES[type_name]
+        return [str(base + i) for i in range(self.sizes[type_name])]
+
+    def random_id(self, type_name, rng):
+        '''
+        :param str type_name: A resource type, like ``'chant'``.
+        :param rng: The random number generator to use.
+        :type rng: :class:`random.Random`
+        :returns: The "id" of a resource of that type, chosen at random.
+        :rtype: str
+        '''
+        return str(ID_BASES[type_name] + rng.randrange(self.sizes[type_name]))
+
+    def documents(self):
+        '''
+        Make every document: first the taxonomy types, then the sources, then the chants.
+
+        :returns: The documents.
+        :rtype: iterator of dict
+        '''
+        yield from self.taxonomy()
+        yield from self.sources()
+        yield from self.chants()
+
+    def taxonomy(self):
+        '''
+        Make the documents of every taxonomy type.
+
+        :returns: The documents.
+        :rtype: iterator of dict
+        '''
+        rng = _rng(self.seed, 'taxonomy')
+        for type_name, size in TAXONOMY_SIZES.items():
+            maker = getattr(self, '_make_' + type_name)
+            for i in range(size):
+                doc = OrderedDict([('id', str(ID_BASES[type_name] + i)), ('type', type_name)])
+                doc.update(maker(i, rng))
+                doc['drupal_path'] = '/{}/{}'.format(type_name, doc['id'])
+                yield doc
+
+    def sources(self):
+        '''
+        Make the source documents.
+
+        :returns: The documents.
+        :rtype: iterator of dict
+        '''
+        rng = _rng(self.seed, 'source')
+        for i in range(self.num_sources):
+            city, country, siglum = rng.choice(_CITIES)
+            shelfmark = '{} {}'.format(rng.choice(('Cod.', 'Ms.', 'Rh.', 'Hs.')), rng.randint(1, 2000))
+            yield OrderedDict([
+                ('id', str(ID_BASES['source'] + i)),
+                ('type', 'source'),
+                ('title', '{}, {}, {}'.format(city, rng.choice(('Bibliothek', 'Archivio', 'Library')),
+                                              shelfmark)),
+                ('rism', '{} {}'.format(siglum, shelfmark)),
+                ('siglum', '{} {}'.format(siglum, shelfmark)),
+                ('provenance_id', self.random_id('provenance', rng)),
+                ('date', '{}-{}'.format(rng.randint(900, 1500), rng.randint(1500, 1600))),
+                ('century_id', self.random_id('century', rng)),
+                ('notation_style_id', self.random_id('notation', rng)),
+                ('segment_id', self.random_id('segment', rng)),
+                ('source_status_id', self.random_id('source_status', rng)),
+                ('summary', self._text(rng, 8, 30)),
+                ('liturgical_occasions', self._text(rng, 3, 10)),
+                ('description', self._text(rng, 20, 80)),
+                ('indexing_notes', self._text(rng, 3, 12)),
+                ('indexing_date', '{}-{:02}'.format(rng.randint(1990, 2016), rng.randint(1, 12))),
+                ('indexers', [self.random_id('indexer', rng) for _ in range(rng.randint(1, 3))]),
+                ('editors', [self.random_id('indexer', rng)]),
+                ('proofreaders', [self.random_id('indexer', rng)]),
+                ('provenance_detail', self._text(rng, 2, 6)),
+                ('drupal_path', '/source/{}'.format(ID_BASES['source'] + i)),
+            ])
+
+    def chants(self):
+        '''
+        Make the chant documents. Each source holds a run of consecutive chants, in folio order.
+
+        :returns: The documents.
+        :rtype: iterator of dict
+        '''
+        rng = _rng(self.seed, 'chant')
+        per_source = max(1, -(-self.num_chants // self.num_sources))  # round up
+        sigla = [source['siglum'] for source in self.sources()]
+
+        for i in range(self.num_chants):
+            source_number = i // per_source
+            sequence = i % per_source + 1
+            words = [rng.choice(_WORDS) for _ in range(rng.randint(8, 30))]
+            incipit = ' '.join(words[:rng.randint(2, 5)]).capitalize()
+            doc = OrderedDict([
+                ('id', str(ID_BASES['chant'] + i)),
+                ('type', 'chant'),
+                ('incipit', incipit),
+                ('folio', '{:03}{}'.format(sequence // 6 + 1, 'rv'[sequence // 3 % 2])),
+                ('position', str(rng.randint(1, 9))),
+                ('sequence', sequence),
+                ('mode', str(rng.randint(1, 8))),
+                ('cantus_id', '{:06}'.format(rng.randint(1, 210000))),
+                ('full_text', ' '.join(words).capitalize()),
+                ('volpiano', '1---' + '--'.join(rng.choice(_VOLPIANO_NOTES)
+                                                for _ in range(len(words) * 2)) + '---4'),
+                ('differentia', rng.choice(('g', 'a', 'c2', 'd', 'e'))),
+                ('finalis', rng.choice(('D', 'E', 'F', 'G'))),
+                ('siglum', sigla[source_number]),
+                ('source_id', str(ID_BASES['source'] + source_number)),
+                ('feast_id', self.random_id('feast', rng)),
+                ('genre_id', self.random_id('genre', rng)),
+                ('office_id', self.random_id('office', rng)),
+                ('drupal_path', '/chant/{}'.format(ID_BASES['chant'] + i)),
+            ])
+            if rng.random() < 0.3:
+                doc['full_text_manuscript'] = doc['full_text'].replace('ae', 'e')
+            if rng.random() < 0.1:
+                doc['notes'] = self._text(rng, 3, 12)
+            if rng.random() < 0.2:
+                doc['cao_concordances'] = ''.join(sorted(rng.sample('CGBEMVHRDFSL', rng.randint(1, 6))))
+            if rng.random() < 0.05:
+                doc['melody_id'] = 'm{}'.format(rng.randint(1, 9999))
+            yield doc
+
+    @staticmethod
+    def _text(rng, shortest, longest):
+        "Some Latin words."
+        return ' '.join(rng.choice(_WORDS) for _ in range(rng.randint(shortest, longest))).capitalize()
+
+    @staticmethod
+    def _make_century(i, rng):  # pylint: disable=unused-argument
+        return {'name': '{}th century{}'.format(9 + i // 2, ('', ' (second half)')[i % 2])}
+
+    @staticmethod
+    def _make_feast(i, rng):
+        if i < len(_SEASONS) * 8:
+            name = '{} {}'.format(('Dom.', 'Fer. 2', 'Fer. 3', 'Fer. 4', 'Fer. 5', 'Fer. 6',
+                                   'Sabbato', 'Hebd.')[i % 8], _SEASONS[i // 8])
+        else:
+            name = '{} {}'.format(rng.choice(_SAINTS), i)
+        return {'name': name,
+                'description': 'Feast of {}'.format(name),
+                'date': '{}.{}'.format(rng.randint(1, 28), rng.randint(1, 12)),
+                'feast_code': '{:08}'.format(i)}
+
+    @staticmethod
+    def _make_genre(i, rng):  # pylint: disable=unused-argument
+        name, description = _GENRES[i % len(_GENRES)]
+        if i >= len(_GENRES):
+            name, description = '{}{}'.format(name, i), '{} ({})'.format(description, i)
+        return {'name': name, 'description': description,
+                'mass_or_office': ['Mass', 'Office'][i % 2]}
+
+    @staticmethod
+    def _make_indexer(i, rng):
+        given, family = rng.choice(_FIRST_NAMES), rng.choice(_FAMILY_NAMES)
+        city, country, _ = rng.choice(_CITIES)
+        return {'display_name': '{} {}'.format(given, family), 'given_name': given,
+                'family_name': family, 'institution': 'University of {}'.format(city),
+                'city': city, 'country': country}
+
+    @staticmethod
+    def _make_notation(i, rng):  # pylint: disable=unused-argument
+        return {'name': '{} {}'.format(_NOTATIONS[i % len(_NOTATIONS)], i // len(_NOTATIONS) or '').strip()}
+
+    @staticmethod
+    def _make_office(i, rng):  # pylint: disable=unused-argument
+        name, description = _OFFICES[i % len(_OFFICES)]
+        if i >= len(_OFFICES):
+            name = '{}{}'.format(name, i)
+        return {'name': name, 'description': description}
+
+    @staticmethod
+    def _make_portfolio(i, rng):  # pylint: disable=unused-argument
+        return {'name': 'Portfolio {}'.format(i + 1)}
+
+    @staticmethod
+    def _make_provenance(i, rng):
+        return {'name': '{} {}'.format(rng.choice(_CITIES)[0], i)}
+
+    @staticmethod
+    def _make_segment(i, rng):  # pylint: disable=unused-argument
+        return {'name': _SEGMENTS[i % len(_SEGMENTS)]}
+
+    @staticmethod
+    def _make_siglum(i, rng):
+        return {'name': '{} {}'.format(rng.choice(_CITIES)[2], i)}
+
+    @staticmethod
+    def _make_source_status(i, rng):  # pylint: disable=unused-argument
+        return {'name': _STATII[i % len(_STATII)]}
+
+
+def main(args=None):
+    '''
+    Write a corpus to stdout as newline-delimited JSON.
+
+    :param args: The command-line arguments, or ``None`` for :data:`sys.argv`.
+    :type args: list of str
+    '''
+    parser = argparse.ArgumentParser(description='Write a synthetic Cantus corpus as NDJSON.')
+    parser.add_argument('--chants', type=int, default=500000, help='number of chants')
+    parser.add_argument('--sources', type=int, default=10000, help='number of sources')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args(args)
+
+    for doc in Corpus(args.chants, args.sources, args.seed).documents():
+        sys.stdout.write(json.dumps(doc, ensure_ascii=False))
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
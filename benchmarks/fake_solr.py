@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/fake_solr.py
+# Purpose:                Stand-in for Solr, for benchmarking Abbot.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Stand-in for Solr, for benchmarking Abbot.
+
+This is a Tornado server that answers the requests Abbot sends to Solr, from a :class:`Index` of
+documents held in memory (usually a :class:`~benchmarks.corpus.Corpus`). It understands:
+
+- the ``select`` request handler, by GET or POST, with the "q," "df," "start," "rows," "sort,"
+  "fl," and "cursorMark" parameters;
+- queries with ``field:value`` terms, quoted phrases, the ``*`` and ``?`` wildcards, ``*:*``,
+  ``field:(grouped terms)``, the ``AND``, ``OR``, ``NOT``, ``&&``, and ``||`` operators, the
+  ``+``, ``-``, and ``!`` prefixes, and parentheses, with Lucene's rules for combining them; and
+- the ``admin/luke`` request handler, for the index version.
+
+Fields listed in :const:`benchmarks.corpus.TEXT_FIELDS` match single case-insensitive words;
+other fields match their whole value. Scores are not computed, so results without a "sort" are in
+index order. Like Solr's "queryResultCache," the sorted results of recent queries are kept, so
+paging through a large result set is fast.
+
+A delay may be added to every response to act like a slower Solr:
+
+    $ python -m benchmarks.fake_solr --port 8983 --chants 500000 --latency 0.005 --jitter 0.01
+'''
+
+import argparse
+import base64
+from collections import OrderedDict
+import heapq
+import json
+import random
+import re
+import time
+
+from tornado import gen, ioloop, web
+from tornado.log import app_log as log
+
+from benchmarks import corpus
+
+
+_TOKEN = re.compile(r'\w+')
+# what the fake analyzer counts as a word in a text field
+
+_QUERY_TOKEN = re.compile(r'\s*(&&|\|\||[()]|"[^"]*"|[^\s()"]+)')
+# one token of a query: an operator, a parenthesis, a quoted phrase, or a term
+
+_MUST, _SHOULD, _MUST_NOT = 'MUST', 'SHOULD', 'MUST_NOT'
+
+
+class QueryError(ValueError):
+    '''
+    Raised when a query cannot be parsed.
+    '''
+
+
+def tokenize(value):
+    '''
+    Split a field value into the words of a text field.
+
+    :param value: The value.
+    :returns: The lowercase words.
+    :rtype: list of str
+    '''
+    return _TOKEN.findall(str(value).lower())
+
+
+def _wildcard(pattern):
+    "Compile a pattern with ``*`` and ``?`` wildcards into a regular expression."
+    return re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + r'\Z')
+
+
+def _split_term(token):
+    "Split ``field:value`` at the first unescaped colon, or return ``(None, token)``."
+    match = re.match(r'([A-Za-z_][\w.]*|\*):(.*)\Z', token, re.DOTALL)
+    if match:
+        return match.group(1), match.group(2)
+    return None, token
+
+
+class _QueryParser(object):
+    '''
+    Parse a query string into a tree of tuples:
+
+    - ``('all',)`` for ``*:*``;
+    - ``('term', field, value)`` for a term, with wildcards or not;
+    - ``('phrase', field, words)`` for a quoted phrase; and
+    - ``('bool', [(occur, node), ...])`` for several clauses.
+    '''
+
+    def __init__(self, query, default_field):
+        self.tokens = _QUERY_TOKEN.findall(query)
+        if re.sub(r'\s', '', ''.join(self.tokens)) != re.sub(r'\s', '', query):
+            # some characters, like an unmatched quote, were skipped
+            raise QueryError('cannot parse "{}"'.format(query))
+        self.pos = 0
+        self.default_field = default_field
+
+    def peek(self):
+        "The next token, or ``None`` at the end."
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def parse(self):
+        "Parse the whole query."
+        node = self.clauses(self.default_field)
+        if self.peek() is not None:
+            raise QueryError('unexpected "{}"'.format(self.peek()))
+        return node
+
+    def clauses(self, field):
+        "Parse clauses until a closing parenthesis or the end."
+        clauses = []
+        conjunction = None
+        while self.peek() not in (None, ')'):
+            token = self.peek()
+            if token in ('AND', '&&', 'OR', '||'):
+                self.pos += 1
+                conjunction = 'AND' if token in ('AND', '&&') else 'OR'
+                continue
+
+            occur = _SHOULD
+            if token in ('NOT', '!', '-', '+'):
+                self.pos += 1
+                occur = _MUST if token == '+' else _MUST_NOT
+            elif token[0] in '+-!' and len(token) > 1:
+                self.tokens[self.pos] = token[1:]
+                occur = _MUST if token[0] == '+' else _MUST_NOT
+
+            node = self.clause(field)
+            if conjunction == 'AND':
+                if occur == _SHOULD:
+                    occur = _MUST
+                if clauses and clauses[-1][0] == _SHOULD:
+                    clauses[-1] = (_MUST, clauses[-1][1])
+            clauses.append((occur, node))
+            conjunction = None
+
+        if len(clauses) == 1 and clauses[0][0] == _SHOULD:
+            return clauses[0][1]
+        return ('bool', clauses)
+
+    def clause(self, field):
+        "Parse one term, phrase, or group."
+        token = self.peek()
+        if token is None:
+            raise QueryError('the query ends too soon')
+        self.pos += 1
+
+        if token == '(':
+            node = self.clauses(field)
+            if self.peek() != ')':
+                raise QueryError('missing ")"')
+            self.pos += 1
+            return node
+
+        term_field, value = _split_term(token)
+        if term_field is None:
+            term_field = field
+        elif value == '' and self.peek() == '(':
+            # a field with grouped terms, like "id:(1 OR 2)"
+            return self.clause(term_field)
+        elif value == '' and self.peek() is not None and self.peek().startswith('"'):
+            # a field with a phrase after a space, like "incipit: \"deus in\""
+            value = self.peek()
+            self.pos += 1
+
+        if value.startswith('"') and value.endswith('"') and len(value) > 1:
+            return ('phrase', term_field, value[1:-1])
+        elif term_field == '*' and value == '*':
+            return ('all',)
+        return ('term', term_field, value)
+
+
+class Index(object):
+    '''
+    Documents held in memory, with lazily built per-field indices.
+    '''
+
+    def __init__(self, documents, result_cache_size=1024):
+        '''
+        :param documents: The documents. Each must have an "id" field.
+        :type documents: iterable of dict
+        :param int result_cache_size: The number of sorted results of recent queries to keep.
+        '''
+        self.docs = list(documents)
+        self.version = int(time.time())
+        self._fields = {}  # field -> {key -> set of positions}
+        self._present = {}  # field -> set of the positions of documents with the field
+        self._results = OrderedDict()  # (query, df, sort) -> sorted list of positions
+        self._result_cache_size = result_cache_size
+
+    def _field_index(self, field):
+        "Find (or build) the index for a field."
+        if field not in self._fields:
+            index = {}
+            present = set()
+            sources = corpus.DEFAULT_SEARCH_FIELDS if field == 'default_search' else (field,)
+            for position, doc in enumerate(self.docs):
+                for source in sources:
+                    if source not in doc:
+                        continue
+                    present.add(position)
+                    values = doc[source] if isinstance(doc[source], list) else [doc[source]]
+                    for value in values:
+                        if source in corpus.TEXT_FIELDS or field == 'default_search':
+                            keys = tokenize(value)
+                        else:
+                            keys = [str(value)]
+                        for key in keys:
+                            index.setdefault(key, set()).add(position)
+            self._fields[field] = index
+            self._present[field] = present
+        return self._fields[field]
+
+    def _is_text(self, field):
+        "Whether a field is tokenized."
+        return field in corpus.TEXT_FIELDS or field == 'default_search'
+
+    def _field_text(self, field, doc):
+        "The words of a field in a document, joined by spaces, for matching phrases."
+        sources = corpus.DEFAULT_SEARCH_FIELDS if field == 'default_search' else (field,)
+        texts = []
+        for source in sources:
+            values = doc.get(source, [])
+            for value in values if isinstance(values, list) else [values]:
+                texts.append(' '.join(tokenize(value)))
+        return ' | '.join(texts)
+
+    def _match(self, node):
+        "Find the positions of the documents that match a node of the query tree."
+        kind = node[0]
+
+        if kind == 'all':
+            return set(range(len(self.docs)))
+
+        elif kind == 'term':
+            _, field, value = node
+            index = self._field_index(field)
+            if value == '*':
+                return set(self._present[field])
+            if self._is_text(field):
+                value = value.lower()
+            if '*' in value or '?' in value:
+                pattern = _wildcard(value)
+                post = set()
+                for key, positions in index.items():
+                    if pattern.match(key):
+                        post.update(positions)
+                return post
+            if self._is_text(field):
+                words = tokenize(value)
+                if len(words) != 1:
+                    return self._match(('phrase', field, value))
+                value = words[0]
+            return set(index.get(value, ()))
+
+        elif kind == 'phrase':
+            _, field, value = node
+            index = self._field_index(field)
+            if not self._is_text(field):
+                return set(index.get(value, ()))
+            words = tokenize(value)
+            if not words:
+                return set()
+            post = set.intersection(*[index.get(word, set()) for word in words])
+            phrase = ' '.join(words)
+            return {position for position in post
+                    if phrase in self._field_text(field, self.docs[position])}
+
+        else:
+            clauses = node[1]
+            musts = [self._match(each) for occur, each in clauses if occur == _MUST]
+            shoulds = [self._match(each) for occur, each in clauses if occur == _SHOULD]
+            must_nots = [self._match(each) for occur, each in clauses if occur == _MUST_NOT]
+            if musts:
+                post = set.intersection(*musts)
+            elif shoulds:
+                post = set.union(*shoulds)
+            else:
+                post = set(range(len(self.docs)))
+            for each in must_nots:
+                post -= each
+            return post
+
+    def _sorted(self, positions, sort):
+        "Sort the positions of some documents with a Solr ``sort`` parameter."
+        if not sort:
+            return sorted(positions)
+
+        post = sorted(positions)
+        for spec in reversed([each.strip() for each in sort.split(',') if each.strip()]):
+            try:
+                field, direction = spec.split()
+            except ValueError:
+                raise QueryError('invalid sort "{}"'.format(spec))
+            if direction not in ('asc', 'desc'):
+                raise QueryError('invalid sort direction "{}"'.format(direction))
+            # documents without the field always go last, as with sortMissingLast="true"
+            present = [each for each in post if field in self.docs[each]]
+            missing = [each for each in post if field not in self.docs[each]]
+            present.sort(key=lambda each: _sort_key(self.docs[each][field]),
+                         reverse=(direction == 'desc'))
+            post = present + missing
+        return post
+
+    def results(self, query, df='default_search', sort=None):
+        '''
+        Find the documents that match a query, in order.
+
+        :param str query: The query.
+        :param str df: The default field, for terms without a field.
+        :param str sort: The "sort" parameter, like ``'incipit asc,id asc'``.
+        :returns: The positions of the matching documents in :attr:`docs`, in order.
+        :rtype: list of int
+        :raises: :exc:`QueryError` when the query or sort is invalid.
+        '''
+        key = (query, df, sort)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+
+        tree = _QueryParser(query, df).parse()
+        matches = self._match(tree)
+        start = time.monotonic()
+        post = self._sorted(matches, sort)
+        log.debug('sorted {} results in {:.3f}s'.format(len(post), time.monotonic() - start))
+
+        self._results[key] = post
+        while len(self._results) > self._result_cache_size:
+            self._results.popitem(last=False)
+        return post
+
+    def select(self, query, df='default_search', start=0, rows=10, sort=None, fields=None,
+               cursor=None):
+        '''
+        Answer a query as Solr's "select" request handler does.
+
+        :param str query: The "q" parameter.
+        :param str df: The "df" parameter.
+        :param int start: The "start" parameter.
+        :param int rows: The "rows" parameter.
+        :param str sort: The "sort" parameter.
+        :param str fields: The "fl" parameter, like ``'id,type,name'``, or ``None`` for every field.
+        :param str cursor: The "cursorMark" parameter.
+        :returns: The response, as Solr would send it with ``wt=json``.
+        :rtype: dict
+        :raises: :exc:`QueryError` when a parameter is invalid.
+        '''
+        matches = self.results(query, df, sort)
+
+        if cursor is not None:
+            if start:
+                raise QueryError('"start" cannot be used with "cursorMark"')
+            start = _decode_cursor(cursor)
+
+        wanted = None
+        if fields and fields.strip() != '*':
+            wanted = {each.strip() for each in fields.split(',')}
+
+        docs = []
+        for position in matches[start:start + rows]:
+            doc = self.docs[position]
+            if wanted is not None:
+                doc = OrderedDict((key, value) for key, value in doc.items() if key in wanted)
+            docs.append(doc)
+
+        post = {'responseHeader': {'status': 0, 'QTime': 0},
+                'response': {'numFound': len(matches), 'start': start, 'docs': docs}}
+        if cursor is not None:
+            post['nextCursorMark'] = _encode_cursor(start + len(docs)) if docs else cursor
+        return post
+
+
+def _sort_key(value):
+    "Sort numbers as numbers and strings without regard to case."
+    if isinstance(value, list):
+        value = value[0] if value else ''
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, str(value).lower())
+
+
+def _encode_cursor(offset):
+    "Make a ``cursorMark`` for the results after ``offset``."
+    return base64.urlsafe_b64encode('offset:{}'.format(offset).encode('ascii')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    "Find the offset of a ``cursorMark`` from :func:`_encode_cursor`, or ``'*'`` for ``0``."
+    if cursor == '*':
+        return 0
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split(':')[1])
+    except (ValueError, IndexError):
+        raise QueryError('invalid cursorMark "{}"'.format(cursor))
+
+
+class SelectHandler(web.RequestHandler):
+    '''
+    The "select" request handler.
+    '''
+
+    def initialize(self, index, latency=0.0, jitter=0.0):  # pylint: disable=arguments-differ
+        '''
+        :param index: The documents.
+        :type index: :class:`Index`
+        :param float latency: Seconds to wait before every response.
+        :param float jitter: Up to this many more seconds to wait, chosen at random.
+        '''
+        self.index = index
+        self.latency = latency
+        self.jitter = jitter
+
+    @gen.coroutine
+    def get(self):  # pylint: disable=arguments-differ
+        "Answer a query."
+        delay = self.latency + (random.uniform(0.0, self.jitter) if self.jitter else 0.0)
+        if delay > 0.0:
+            yield gen.sleep(delay)
+
+        started = time.monotonic()
+        try:
+            response = self.index.select(
+                self.get_argument('q'),
+                df=self.get_argument('df', 'default_search'),
+                start=int(self.get_argument('start', 0)),
+                rows=int(self.get_argument('rows', 10)),
+                sort=self.get_argument('sort', None),
+                fields=self.get_argument('fl', None),
+                cursor=self.get_argument('cursorMark', None))
+        except (QueryError, ValueError) as err:
+            self.set_status(400)
+            self.write({'responseHeader': {'status': 400},
+                        'error': {'msg': str(err), 'code': 400}})
+            return
+
+        response['responseHeader']['QTime'] = int((time.monotonic() - started) * 1000)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(json.dumps(response))
+
+    post = get
+
+
+class LukeHandler(web.RequestHandler):
+    '''
+    The "admin/luke" request handler, with only the index version.
+    '''
+
+    def initialize(self, index):  # pylint: disable=arguments-differ
+        "Hold the :class:`Index`."
+        self.index = index
+
+    def get(self):  # pylint: disable=arguments-differ
+        "Describe the index."
+        last_modified = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.index.version))
+        self.write({'index': {'numDocs': len(self.index.docs), 'version': self.index.version,
+                              'lastModified': last_modified}})
+
+
+def make_app(index, latency=0.0, jitter=0.0):
+    '''
+    Make the Tornado application. Requests are accepted at any path ending with ``/select`` or
+    ``/admin/luke``, so any "solr_url" will work.
+
+    :param index: The documents.
+    :type index: :class:`Index`
+    :param float latency: As for :class:`SelectHandler`.
+    :param float jitter: As for :class:`SelectHandler`.
+    :returns: The application.
+    :rtype: :class:`tornado.web.Application`
+    '''
+    return web.Application([
+        (r'.*/select/?', SelectHandler, {'index': index, 'latency': latency, 'jitter': jitter}),
+        (r'.*/admin/luke/?', LukeHandler, {'index': index}),
+    ])
+
+
+def load_ndjson(path):
+    '''
+    Read documents from a newline-delimited JSON file, like one from :mod:`benchmarks.corpus`.
+
+    :param str path: The pathname of the file.
+    :returns: The documents.
+    :rtype: iterator of dict
+    '''
+    with open(path, encoding='utf-8') as the_file:
+        for line in the_file:
+            if line.strip():
+                yield json.loads(line, object_pairs_hook=OrderedDict)
+
+
+def main(args=None):  # pragma: no cover
+    '''
+    Start the fake Solr server.
+
+    :param args: The command-line arguments, or ``None`` for :data:`sys.argv`.
+    :type args: list of str
+    '''
+    parser = argparse.ArgumentParser(description='Serve a synthetic Cantus corpus like Solr does.')
+    parser.add_argument('--port', type=int, default=8983, help='port to listen on')
+    parser.add_argument('--corpus', help='NDJSON file to load, instead of making a corpus')
+    parser.add_argument('--chants', type=int, default=500000, help='number of chants to make')
+    parser.add_argument('--sources', type=int, default=10000, help='number of sources to make')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the corpus')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds to wait before every response')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='up to this many more seconds to wait, at random')
+    args = parser.parse_args(args)
+
+    started = time.monotonic()
+    if args.corpus:
+        documents = load_ndjson(args.corpus)
+    else:
+        documents = corpus.Corpus(args.chants, args.sources, args.seed).documents()
+    index = Index(documents)
+    print('Loaded {} documents in {:.1f}s.'.format(len(index.docs), time.monotonic() - started))
+
+    make_app(index, args.latency, args.jitter).listen(args.port)
+    print('Listening on http://localhost:{}/solr/collection1/'.format(args.port))
+    try:
+        ioloop.IOLoop.current().start()
+    except KeyboardInterrupt:
+        raise SystemExit(0)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/load.py
+# Purpose:                Load-test driver for Abbot.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Load-test driver for Abbot.
+
+This sends requests to a running Abbot server from several concurrent clients, then reports the
+throughput and the 50th and 99th percentile latency of each workload. The requests are made from
+the same :class:`~benchmarks.corpus.Corpus` that the :mod:`benchmarks.fake_solr` server holds, so
+use the same "--chants," "--sources," and "--seed" for both.
+
+The workloads are:
+
+- "view," which GETs one chant or source by ID;
+- "browse," which GETs a random page of ten chants, sources, or feasts, sorted by a field;
+- "xrefs," which GETs a random page of 100 chants with their resource URLs, so that every page
+  cross-references about 400 feasts, genres, offices, and sources; and
+- "search," which sends SEARCH requests for chants with a genre, a feast, or an incipit.
+
+For example:
+
+    $ python -m benchmarks.load --abbot http://localhost:8888 --workload all --concurrency 20
+'''
+
+import argparse
+import json
+import math
+import random
+import sys
+import time
+
+from tornado import gen, httpclient, ioloop
+
+from benchmarks import corpus
+
+
+WORKLOADS = ('view', 'browse', 'xrefs', 'search')
+'''
+The names of the workloads, in the order they run with "--workload all."
+'''
+
+_SEARCH_WORDS = ('deus', 'domine', 'dominus', 'alleluia', 'gloria', 'sancte', 'christe', 'regem')
+# incipit words that appear often in the corpus
+
+
+def percentile(values, percent):
+    '''
+    Find a percentile with the nearest-rank method.
+
+    :param values: The values, in any order.
+    :type values: list of float
+    :param float percent: The percentile, from 0 to 100.
+    :returns: The value at that percentile, or ``None`` when there are no values.
+    :rtype: float
+    '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(math.ceil(percent / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+class Workload(object):
+    '''
+    Make the requests of one workload.
+    '''
+
+    def __init__(self, name, the_corpus, base_url, seed=0):
+        '''
+        :param str name: One of the :const:`WORKLOADS`.
+        :param the_corpus: The corpus held by the fake Solr server.
+        :type the_corpus: :class:`~benchmarks.corpus.Corpus`
+        :param str base_url: The URL of the Abbot server, like ``'http://localhost:8888'``.
+        :param int seed: Seed for the random choice of requests.
+        :raises: :exc:`ValueError` when ``name`` is not a workload.
+        '''
+        if name not in WORKLOADS:
+            raise ValueError('unknown workload "{}"'.format(name))
+        self.name = name
+        self.corpus = the_corpus
+        self.base_url = base_url.rstrip('/')
+        self.rng = random.Random(seed)
+        self._names = {}
+
+    def _random_name(self, type_name):
+        "Find the name of a random taxonomy resource."
+        if type_name not in self._names:
+            self._names[type_name] = sorted({doc['name'] for doc in self.corpus.taxonomy()
+                                             if doc['type'] == type_name and 'name' in doc})
+        return self.rng.choice(self._names[type_name])
+
+    def request(self):
+        '''
+        Make the next request.
+
+        :returns: The request.
+        :rtype: :class:`tornado.httpclient.HTTPRequest`
+        '''
+        return getattr(self, '_' + self.name)()
+
+    def _get(self, path, headers=None):
+        "Make a GET request."
+        return httpclient.HTTPRequest(self.base_url + path, headers=headers)
+
+    def _view(self):
+        "Request one chant or source."
+        type_name = self.rng.choice(('chant', 'chant', 'chant', 'source'))
+        return self._get('/{}s/{}/'.format(type_name, self.corpus.random_id(type_name, self.rng)))
+
+    def _browse(self):
+        "Request a page of chants, sources, or feasts."
+        type_name, total, sort = self.rng.choice((
+            ('chant', self.corpus.num_chants, 'incipit;asc'),
+            ('source', self.corpus.num_sources, 'title;asc'),
+            ('feast', self.corpus.sizes['feast'], 'name;asc')))
+        page = self.rng.randint(1, max(total // 10, 1))
+        headers = {'X-Cantus-Page': str(page), 'X-Cantus-Per-Page': '10', 'X-Cantus-Sort': sort}
+        return self._get('/{}s/'.format(type_name), headers)
+
+    def _xrefs(self):
+        "Request a page of 100 chants, with their resource URLs."
+        page = self.rng.randint(1, max(self.corpus.num_chants // 100, 1))
+        headers = {'X-Cantus-Page': str(page), 'X-Cantus-Per-Page': '100',
+                   'X-Cantus-Include-Resources': 'true'}
+        return self._get('/chants/', headers)
+
+    def _search(self):
+        "Search for chants."
+        kind = self.rng.choice(('genre', 'feast', 'incipit'))
+        if kind == 'incipit':
+            query = 'incipit:{}*'.format(self.rng.choice(_SEARCH_WORDS)[:4])
+        else:
+            query = '{}:"{}"'.format(kind, self._random_name(kind))
+        return httpclient.HTTPRequest(self.base_url + '/chants/', method='SEARCH',
+                                      body=json.dumps({'query': query}),
+                                      headers={'Content-Type': 'application/json'},
+                                      allow_nonstandard_methods=True)
+
+
+@gen.coroutine
+def run(workload, requests=1000, concurrency=10, timeout=60.0):
+    '''
+    Send the requests of a workload from several concurrent clients.
+
+    :param workload: The workload.
+    :type workload: :class:`Workload`
+    :param int requests: The total number of requests.
+    :param int concurrency: The number of clients.
+    :param float timeout: Seconds before a request fails.
+    :returns: The results, with the keys "workload," "requests," "errors," "seconds,"
+        "requests_per_second," "p50_ms," "p99_ms," and "statuses."
+    :rtype: dict
+    '''
+    client = httpclient.AsyncHTTPClient(max_clients=concurrency)
+    latencies = []
+    statuses = {}
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        "Send requests until there are none left."
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            request = workload.request()
+            request.request_timeout = timeout
+            start = time.monotonic()
+            response = yield client.fetch(request, raise_error=False)
+            latencies.append(time.monotonic() - start)
+            statuses[response.code] = statuses.get(response.code, 0) + 1
+
+    start = time.monotonic()
+    yield [worker() for _ in range(concurrency)]
+    seconds = time.monotonic() - start
+
+    errors = sum(count for code, count in statuses.items() if code >= 400 or code < 100)
+    return {
+        'workload': workload.name,
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'requests_per_second': round(len(latencies) / seconds, 1) if seconds else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        'statuses': {str(code): count for code, count in sorted(statuses.items())},
+    }
+
+
+def format_results(results):
+    '''
+    Format results from :func:`run` as a table.
+
+    :param results: The results.
+    :type results: list of dict
+    :returns: The table.
+    :rtype: str
+    '''
+    post = ['{:<8} {:>8} {:>7} {:>9} {:>10} {:>10}'.format(
+        'workload', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)')]
+    for each in results:
+        post.append('{workload:<8} {requests:>8} {errors:>7} {requests_per_second:>9} '
+                    '{p50_ms:>10} {p99_ms:>10}'.format(**each))
+    return '\n'.join(post)
+
+
+def main(args=None):  # pragma: no cover
+    '''
+    Run the load test.
+
+    :param args: The command-line arguments, or ``None`` for :data:`sys.argv`.
+    :type args: list of str
+    '''
+    parser = argparse.ArgumentParser(description='Measure the throughput and latency of Abbot.')
+    parser.add_argument('--abbot', default='http://localhost:8888', help='URL of the Abbot server')
+    parser.add_argument('--workload', default='all', choices=WORKLOADS + ('all',))
+    parser.add_argument('--requests', type=int, default=1000, help='requests per workload')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent clients')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='requests per workload to send before measuring')
+    parser.add_argument('--chants', type=int, default=500000, help='as given to the fake Solr')
+    parser.add_argument('--sources', type=int, default=10000, help='as given to the fake Solr')
+    parser.add_argument('--seed', type=int, default=0, help='as given to the fake Solr')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(args)
+
+    the_corpus = corpus.Corpus(args.chants, args.sources, args.seed)
+    names = WORKLOADS if args.workload == 'all' else (args.workload,)
+
+    @gen.coroutine
+    def run_all():
+        "Run every chosen workload, one after the other."
+        results = []
+        for name in names:
+            if args.warmup:
+                yield run(Workload(name, the_corpus, args.abbot, seed=-1), args.warmup,
+                          args.concurrency)
+            results.append((yield run(Workload(name, the_corpus, args.abbot, args.seed),
+                                      args.requests, args.concurrency)))
+        return results
+
+    results = ioloop.IOLoop.current().run_sync(run_all)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        print(format_results(results))
+    if any(each['errors'] for each in results):
+        print('Some requests failed: {}'.format({each['workload']: each['statuses']
+                                                 for each in results}), file=sys.stderr)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/micro.py
+# Purpose:                Micro-benchmarks for the functions used by every Abbot request.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Micro-benchmarks for the functions used by every Abbot request.
+
+Each benchmark times one CPU-bound function with realistic input, without Solr or the network.
+Functions that work on a page of results, like :meth:`Xref.collect`, are timed on a page of 100
+chants or sources from a :class:`~benchmarks.corpus.Corpus`, so one "operation" is one page.
+
+Run the benchmarks and save the results as JSON:
+
+    $ python -m benchmarks.micro run --output before.json
+
+Then, after changing Abbot, run them again and compare with the saved results. The exit status is
+1 when a benchmark is slower than the baseline by more than the threshold (10% by default):
+
+    $ python -m benchmarks.micro run --output after.json --compare before.json
+
+Or compare two saved results:
+
+    $ python -m benchmarks.micro compare before.json after.json
+'''
+
+import argparse
+from collections import OrderedDict
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from unittest import mock
+
+from tornado import httpclient, web
+from tornado.options import options
+
+from abbot import __main__ as abbot_main
+from abbot import util
+from abbot.complex_handler import ComplexHandler, Xref
+from benchmarks import corpus
+
+
+PAGE_SIZE = 100
+'''
+The number of records in a page, for the benchmarks that work on a page of results.
+'''
+
+BENCHMARKS = OrderedDict()
+'''
+The benchmarks, registered with :func:`benchmark`. Keys are the names, and values are functions
+that take a :class:`Fixtures` instance and return a function without arguments that does one
+operation.
+'''
+
+
+def benchmark(name):
+    '''
+    Decorator to register a benchmark in :const:`BENCHMARKS`.
+
+    :param str name: The name of the benchmark, like ``'util.parse_query'``.
+    '''
+    def decorator(func):
+        "Register the benchmark."
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+class Fixtures(object):
+    '''
+    The input shared by the benchmarks: pages of chants and sources from a small corpus, with their
+    cross-referenced resources, and a :class:`ComplexHandler` for each type.
+    '''
+
+    def __init__(self, seed=0):
+        '''
+        :param int seed: The seed for the corpus.
+        '''
+        the_corpus = corpus.Corpus(chants=PAGE_SIZE * 10, sources=PAGE_SIZE, seed=seed)
+        self.chants = list(the_corpus.chants())[:PAGE_SIZE]
+        self.sources = list(the_corpus.sources())[:PAGE_SIZE]
+        self.xrefs = {doc['id']: doc for doc in the_corpus.taxonomy()}
+        self.xrefs.update((doc['id'], doc) for doc in self.sources)
+
+        routes = abbot_main.compile_routes(abbot_main.HANDLERS)
+        self.app = web.Application(routes)
+        self.handlers = {}
+        for spec in routes:
+            if spec.name in ('view_chants', 'view_sources'):
+                request = httpclient.HTTPRequest(url='/', method='GET')
+                request.connection = mock.Mock()  # required for Tornado magic things
+                handler = ComplexHandler(self.app, request, **spec.kwargs)
+                self.handlers[handler.type_name] = handler
+
+    def page(self, type_name):
+        '''
+        :param str type_name: Either ``'chant'`` or ``'source'``.
+        :returns: A page of records of that type, as Solr would give them.
+        :rtype: list of dict
+        '''
+        return self.chants if type_name == 'chant' else self.sources
+
+
+_QUERY = 'genre:antiphon AND incipit:deus* AND feast:"Dom. Adventus" -mode:1 OR (office:V)'
+# a SEARCH query with a cross-referenced field, a wildcard, a phrase, and operators
+
+
+@benchmark('util.parse_query[uncached]')
+def _parse_query(fixtures):  # pylint: disable=unused-argument
+    "Parse a query that is not in the QUERY_CACHE."
+    def run():
+        "Empty the cache, then parse."
+        util.QUERY_CACHE.clear()
+        util.parse_query(_QUERY)
+    return run
+
+
+@benchmark('util.parse_query[cached]')
+def _parse_query_cached(fixtures):  # pylint: disable=unused-argument
+    "Parse a query that is in the QUERY_CACHE."
+    util.parse_query(_QUERY)
+    return lambda: util.parse_query(_QUERY)
+
+
+@benchmark('util.assemble_query')
+def _assemble_query(fixtures):  # pylint: disable=unused-argument
+    "The components of :const:`_QUERY`, after :func:`util.run_subqueries`."
+    components = [('default', '(genre_id:4001^2 OR genre_id:4017^1)'), 'AND', ('incipit', 'deus*'),
+                  'AND', ('feast_id', '3000'), '-', ('mode', '1'), 'OR', '(',
+                  ('office_id', '7000'), ')']
+    return lambda: util.assemble_query(components)
+
+
+@benchmark('util.prepare_formatted_sort')
+def _prepare_formatted_sort(fixtures):  # pylint: disable=unused-argument
+    "An X-Cantus-Sort header with three fields."
+    return lambda: util.prepare_formatted_sort('incipit;asc, folio;desc, sequence;asc')
+
+
+@benchmark('util.parse_fields_header')
+def _parse_fields_header(fixtures):
+    "An X-Cantus-Fields header with six fields, some cross-referenced."
+    returned_fields = fixtures.handlers['chant'].returned_fields
+    return lambda: util.parse_fields_header('incipit, genre, feast, source, folio, sequence',
+                                            returned_fields)
+
+
+@benchmark('SimpleHandler.format_record[chant page]')
+def _format_record(fixtures):
+    "Format a page of chants."
+    handler = fixtures.handlers['chant']
+    page = fixtures.page('chant')
+    def run():
+        "Format every record."
+        for record in page:
+            handler.format_record(record)
+    return run
+
+
+@benchmark('SimpleHandler.make_resource_url[chant page]')
+def _make_resource_url(fixtures):
+    "Make the URLs of a page of chants."
+    handler = fixtures.handlers['chant']
+    ids = [record['id'] for record in fixtures.page('chant')]
+    def run():
+        "Make every URL."
+        for each_id in ids:
+            handler.make_resource_url(each_id, 'chants')
+    return run
+
+
+def _xref_benchmarks(type_name):
+    "Register the benchmarks of the Xref methods on a page of records of one type."
+
+    @benchmark('Xref.collect[{} page]'.format(type_name))
+    def collect(fixtures):
+        "Collect the cross-references of a page."
+        page = fixtures.page(type_name)
+        def run():
+            "Collect from every record."
+            for record in page:
+                Xref.collect(record)
+        return run
+
+    @benchmark('Xref.fill[{} page]'.format(type_name))
+    def fill(fixtures):
+        "Fill in the cross-references of a page."
+        page = fixtures.page(type_name)
+        xrefs = fixtures.xrefs
+        def run():
+            "Fill in every record."
+            for record in page:
+                Xref.fill(record, {}, xrefs)
+        return run
+
+    @benchmark('Xref.resources[{} page]'.format(type_name))
+    def resources(fixtures):
+        "Make the cross-reference URLs of a page."
+        page = fixtures.page(type_name)
+        xrefs = fixtures.xrefs
+        make_resource_url = fixtures.handlers[type_name].make_resource_url
+        def run():
+            "Make URLs for every record."
+            for record in page:
+                Xref.resources(record, {}, xrefs, make_resource_url)
+        return run
+
+_xref_benchmarks('chant')
+_xref_benchmarks('source')
+
+
+def measure(func, repeat=7, min_time=0.05):
+    '''
+    Time a function.
+
+    The function is called in a loop, with enough calls that each loop takes at least ``min_time``
+    seconds, and the loop is repeated ``repeat`` times. The garbage collector is disabled while
+    timing, as in :mod:`timeit`.
+
+    :param func: The function to time, which takes no arguments.
+    :param int repeat: The number of times to time the loop.
+    :param float min_time: The shortest time for one loop, in seconds.
+    :returns: The results, with the keys "loops," "repeat," "median_ns," "min_ns," and "stdev_ns."
+        The times are in nanoseconds per call.
+    :rtype: dict
+    '''
+    def time_loop(loops):
+        "Time a loop of calls."
+        start = time.perf_counter()
+        for _ in range(loops):
+            func()
+        return time.perf_counter() - start
+
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        loops = 1
+        while time_loop(loops) < min_time:
+            loops *= 2
+        times = [time_loop(loops) / loops * 1e9 for _ in range(repeat)]
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return OrderedDict((
+        ('loops', loops),
+        ('repeat', repeat),
+        ('median_ns', round(statistics.median(times), 1)),
+        ('min_ns', round(min(times), 1)),
+        ('stdev_ns', round(statistics.stdev(times), 1) if repeat > 1 else 0.0),
+    ))
+
+
+def run(names=None, repeat=7, min_time=0.05, seed=0):
+    '''
+    Run benchmarks.
+
+    :param names: Run the benchmarks whose names contain one of these strings, or ``None`` to run
+        every benchmark.
+    :type names: list of str
+    :param int repeat: As for :func:`measure`.
+    :param float min_time: As for :func:`measure`.
+    :param int seed: The seed for the corpus in :class:`Fixtures`.
+    :returns: The results, with the keys "python," "platform," and "benchmarks." The "benchmarks"
+        member has the results of :func:`measure` for each benchmark, by name.
+    :rtype: dict
+    '''
+    if not options.server_name:
+        options.server_name = 'http://localhost:8888'
+
+    fixtures = Fixtures(seed)
+    results = OrderedDict()
+    for name, setup in BENCHMARKS.items():
+        if names and not any(each in name for each in names):
+            continue
+        results[name] = measure(setup(fixtures), repeat, min_time)
+
+    return OrderedDict((
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('benchmarks', results),
+    ))
+
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    Compare the results of two runs.
+
+    A benchmark is a "regression" when its median time in ``current`` is more than ``threshold``
+    slower than in ``baseline``, and an "improvement" when it is more than ``threshold`` faster.
+
+    :param dict baseline: The results of the earlier :func:`run`.
+    :param dict current: The results of the later :func:`run`.
+    :param float threshold: The fraction of the baseline time that counts as a change.
+    :returns: For each benchmark, a tuple with the name, the baseline and current median times (or
+        ``None`` when the benchmark is missing from either), the ratio of current to baseline, and
+        one of ``'regression'``, ``'improvement'``, ``'same'``, ``'new'``, or ``'missing'``.
+    :rtype: list of tuple
+    '''
+    post = []
+    before = baseline['benchmarks']
+    after = current['benchmarks']
+
+    for name in list(before) + [name for name in after if name not in before]:
+        if name not in after:
+            post.append((name, before[name]['median_ns'], None, None, 'missing'))
+        elif name not in before:
+            post.append((name, None, after[name]['median_ns'], None, 'new'))
+        else:
+            ratio = after[name]['median_ns'] / before[name]['median_ns']
+            if ratio > 1.0 + threshold:
+                status = 'regression'
+            elif ratio < 1.0 - threshold:
+                status = 'improvement'
+            else:
+                status = 'same'
+            post.append((name, before[name]['median_ns'], after[name]['median_ns'], ratio, status))
+
+    return post
+
+
+def _format_ns(value):
+    "Format a time in nanoseconds with a sensible unit."
+    if value is None:
+        return '-'
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if value >= scale:
+            return '{:.2f} {}'.format(value / scale, unit)
+    return '{:.0f} ns'.format(value)
+
+
+def format_results(results):
+    '''
+    Format the results of :func:`run` as a table.
+
+    :param dict results: The results.
+    :returns: The table.
+    :rtype: str
+    '''
+    post = ['{:<45} {:>12} {:>12}'.format('benchmark', 'median', 'stdev')]
+    for name, each in results['benchmarks'].items():
+        post.append('{:<45} {:>12} {:>12}'.format(name, _format_ns(each['median_ns']),
+                                                  _format_ns(each['stdev_ns'])))
+    return '\n'.join(post)
+
+
+def format_comparison(comparison):
+    '''
+    Format the results of :func:`compare` as a table.
+
+    :param comparison: The comparison.
+    :type comparison: list of tuple
+    :returns: The table.
+    :rtype: str
+    '''
+    post = ['{:<45} {:>12} {:>12} {:>7}  {}'.format('benchmark', 'baseline', 'current', 'ratio',
+                                                     'status')]
+    for name, before, after, ratio, status in comparison:
+        post.append('{:<45} {:>12} {:>12} {:>7}  {}'.format(
+            name, _format_ns(before), _format_ns(after),
+            '-' if ratio is None else '{:.2f}x'.format(ratio), status))
+    return '\n'.join(post)
+
+
+def _load(path):
+    "Load saved results."
+    with open(path, encoding='utf-8') as the_file:
+        return json.load(the_file, object_pairs_hook=OrderedDict)
+
+
+def main(args=None):  # pragma: no cover
+    '''
+    Run or compare the micro-benchmarks.
+
+    :param args: The command-line arguments, or ``None`` for :data:`sys.argv`.
+    :type args: list of str
+    :returns: The exit status: 1 when there is a regression, otherwise 0.
+    :rtype: int
+    '''
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for Abbot's hot functions.")
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--filter', action='append',
+                            help='only run benchmarks whose names contain this (may repeat)')
+    run_parser.add_argument('--repeat', type=int, default=7, help='timed loops per benchmark')
+    run_parser.add_argument('--min-time', type=float, default=0.05,
+                            help='shortest time for one loop, in seconds')
+    run_parser.add_argument('--output', help='save the results as JSON in this file')
+    run_parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    run_parser.add_argument('--compare', metavar='BASELINE',
+                            help='compare with the results saved in this file')
+
+    compare_parser = commands.add_parser('compare', help='compare two saved results')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    for each in (run_parser, compare_parser):
+        each.add_argument('--threshold', type=float, default=0.1,
+                          help='the fraction slower that counts as a regression')
+
+    args = parser.parse_args(args)
+    if args.command is None:
+        parser.error('choose "run" or "compare"')
+
+    if args.command == 'run':
+        current = run(args.filter, args.repeat, args.min_time)
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as the_file:
+                json.dump(current, the_file, indent=2)
+                the_file.write('\n')
+        if args.json:
+            json.dump(current, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        elif not args.compare:
+            print(format_results(current))
+        if not args.compare:
+            return 0
+        baseline = _load(args.compare)
+    else:
+        baseline = _load(args.baseline)
+        current = _load(args.current)
+
+    comparison = compare(baseline, current, args.threshold)
+    # with "--json" the comparison goes to stderr, so stdout is only JSON
+    print(format_comparison(comparison), file=sys.stderr if getattr(args, 'json', False) else sys.stdout)
+    return 1 if any(each[4] == 'regression' for each in comparison) else 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/tests/test_fake_solr.py
+# Purpose:                Tests for the benchmark harness.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for the benchmark harness: the corpus, the fake Solr server, and the load driver.
+'''
+
+# pylint: disable=protected-access
+# pylint: disable=no-self-use
+
+import json
+import random
+from unittest import TestCase
+
+import pytest
+from tornado import escape, testing
+
+from benchmarks import corpus, fake_solr, load
+
+
+_DOCS = [
+    {'id': '1', 'type': 'chant', 'incipit': 'Deus in adjutorium', 'genre_id': '10', 'sequence': 2},
+    {'id': '2', 'type': 'chant', 'incipit': 'Domine labia mea', 'genre_id': '11', 'sequence': 1},
+    {'id': '3', 'type': 'chant', 'incipit': 'Ecce deus', 'sequence': 3},
+    {'id': '10', 'type': 'genre', 'name': 'Antiphon'},
+    {'id': '11', 'type': 'genre', 'name': 'Responsory'},
+]
+
+
+def ids(response):
+    "The IDs of the documents in a response from Index.select()."
+    return [doc['id'] for doc in response['response']['docs']]
+
+
+class TestCorpus(TestCase):
+    '''
+    Tests for corpus.Corpus.
+    '''
+
+    def test_repeatable(self):
+        "The same seed makes the same corpus."
+        assert list(corpus.Corpus(50, 5, seed=3).documents()) == \
+            list(corpus.Corpus(50, 5, seed=3).documents())
+
+    def test_cross_references(self):
+        "Every cross-reference in a chant or source is to a resource in the corpus."
+        the_corpus = corpus.Corpus(200, 10)
+        docs = list(the_corpus.documents())
+        all_ids = {doc['id'] for doc in docs}
+        assert len(all_ids) == len(docs)
+        for doc in docs:
+            for field, value in doc.items():
+                if field.endswith('_id') and field not in ('cantus_id', 'melody_id'):
+                    for each in value if isinstance(value, list) else [value]:
+                        assert each in all_ids, (doc['id'], field, each)
+
+    def test_random_id(self):
+        "random_id() chooses a resource of the right type."
+        the_corpus = corpus.Corpus(100, 5)
+        rng = random.Random(0)
+        assert the_corpus.random_id('chant', rng) in the_corpus.ids('chant')
+        assert the_corpus.random_id('genre', rng) in the_corpus.ids('genre')
+
+
+class TestIndex(TestCase):
+    '''
+    Tests for fake_solr.Index.
+    '''
+
+    def setUp(self):
+        self.index = fake_solr.Index(_DOCS)
+
+    def test_type_and_id(self):
+        "The queries of basic_get()."
+        assert ids(self.index.select('+type:chant +id:2')) == ['2']
+        assert ids(self.index.select('+type:chant +id:*')) == ['1', '2', '3']
+        assert ids(self.index.select('+type:* +id:(1 OR 10)')) == ['1', '10']
+
+    def test_or_list(self):
+        "The queries of Xref.lookup()."
+        actual = self.index.select('id:1 OR id:11 OR id:404', fields='id,type')
+        assert actual['response']['docs'] == [{'id': '1', 'type': 'chant'},
+                                              {'id': '11', 'type': 'genre'}]
+
+    def test_search(self):
+        "Assembled SEARCH queries, with text fields, wildcards, phrases, and the default field."
+        assert ids(self.index.select('type:chant AND ( genre_id:10  ) ')) == ['1']
+        assert ids(self.index.select('type:chant AND (incipit:DEUS)')) == ['1', '3']
+        assert ids(self.index.select('type:chant AND (incipit:dom*)')) == ['2']
+        assert ids(self.index.select('type:chant AND incipit:"in adjutorium"')) == ['1']
+        assert ids(self.index.select('type:genre AND (antiphon)', fields='id')) == ['10']
+        assert ids(self.index.select('type:chant -genre_id:*')) == ['3']
+        assert ids(self.index.select('*:*'))[:2] == ['1', '2']
+
+    def test_sort_and_page(self):
+        "Sorting with missing values last, and paging with start and rows."
+        actual = self.index.select('type:chant', sort='sequence desc,id asc', start=1, rows=1)
+        assert actual['response']['numFound'] == 3
+        assert ids(actual) == ['1']
+        assert ids(self.index.select('type:chant', sort='genre_id desc')) == ['2', '1', '3']
+
+    def test_cursor(self):
+        "Cursors go through every result, then return the same cursor."
+        cursor, seen = '*', []
+        while True:
+            actual = self.index.select('*:*', rows=2, sort='id asc', cursor=cursor)
+            seen.extend(ids(actual))
+            if actual['nextCursorMark'] == cursor:
+                break
+            cursor = actual['nextCursorMark']
+        assert sorted(seen) == sorted(doc['id'] for doc in _DOCS)
+
+    def test_errors(self):
+        "Invalid queries and sorts raise QueryError."
+        for query, sort in (('type:(chant', None), ('"deus', None), ('type:chant', 'id sideways')):
+            with pytest.raises(fake_solr.QueryError):
+                self.index.select(query, sort=sort)
+
+
+class TestHandlers(testing.AsyncHTTPTestCase):
+    '''
+    Tests for the HTTP side of the fake Solr server.
+    '''
+
+    def get_app(self):
+        return fake_solr.make_app(fake_solr.Index(_DOCS))
+
+    def test_get(self):
+        "A GET request to select."
+        response = self.fetch('/solr/collection1/select/?q=type:genre&wt=json&fl=id')
+        assert response.code == 200
+        assert escape.json_decode(response.body)['response']['docs'] == [{'id': '10'}, {'id': '11'}]
+
+    def test_post(self):
+        "A POST request to select, as pysolrtornado sends for long queries."
+        response = self.fetch('/solr/collection1/select/', method='POST',
+                              body='q=id%3A1+OR+id%3A2&wt=json')
+        assert escape.json_decode(response.body)['response']['numFound'] == 2
+
+    def test_bad_query(self):
+        "An invalid query is a 400."
+        assert self.fetch('/solr/select/?q=type%3A%28chant').code == 400
+
+    def test_luke(self):
+        "The index version, as generation.ask_solr() wants."
+        body = json.loads(self.fetch('/solr/collection1/admin/luke?numTerms=0&wt=json').body.decode())
+        assert 'version' in body['index'] and 'lastModified' in body['index']
+
+
+class TestLoad(TestCase):
+    '''
+    Tests for the load driver.
+    '''
+
+    def test_percentile(self):
+        "Nearest-rank percentiles."
+        values = list(range(1, 101))
+        assert load.percentile(values, 50) == 50
+        assert load.percentile(values, 99) == 99
+        assert load.percentile([3.0], 99) == 3.0
+        assert load.percentile([], 50) is None
+
+    def test_workloads(self):
+        "Every workload makes requests for resources in the corpus."
+        the_corpus = corpus.Corpus(1000, 10)
+        for name in load.WORKLOADS:
+            request = load.Workload(name, the_corpus, 'http://abbot/').request()
+            assert request.url.startswith('http://abbot/')
+            if name == 'search':
+                assert request.method == 'SEARCH'
+                assert 'query' in json.loads(request.body.decode())
+
+    def test_unknown_workload(self):
+        "An unknown workload is a ValueError."
+        with pytest.raises(ValueError):
+            load.Workload('nap', corpus.Corpus(10, 1), 'http://abbot/')
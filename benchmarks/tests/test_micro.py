@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#--------------------------------------------------------------------------------------------------
+# Program Name:           abbot
+# Program Description:    HTTP Server for the CANTUS Database
+#
+# Filename:               benchmarks/tests/test_micro.py
+# Purpose:                Tests for the micro-benchmarks.
+#
+# Copyright (C) 2015, 2016 Christopher Antila
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#--------------------------------------------------------------------------------------------------
+'''
+Tests for benchmarks/micro.py.
+'''
+
+# pylint: disable=no-self-use
+
+from unittest import TestCase
+
+from benchmarks import micro
+
+
+def _results(**medians):
+    "Make results like micro.run() does, with these median times."
+    return {'benchmarks': {name: {'median_ns': value} for name, value in medians.items()}}
+
+
+class TestMicro(TestCase):
+    '''
+    Tests for benchmarks/micro.py.
+    '''
+
+    def test_run(self):
+        "Every benchmark runs, and its results have the right keys."
+        actual = micro.run(repeat=1, min_time=0.0)
+        assert list(actual['benchmarks']) == list(micro.BENCHMARKS)
+        for each in actual['benchmarks'].values():
+            assert set(each) == {'loops', 'repeat', 'median_ns', 'min_ns', 'stdev_ns'}
+            assert each['median_ns'] > 0
+
+    def test_run_filter(self):
+        "Only the benchmarks with a name that contains a filter are run."
+        actual = micro.run(['Xref.fill'], repeat=1, min_time=0.0)
+        assert list(actual['benchmarks']) == ['Xref.fill[chant page]', 'Xref.fill[source page]']
+
+    def test_measure(self):
+        "The loop runs enough times to take min_time."
+        calls = []
+        actual = micro.measure(lambda: calls.append(1), repeat=3, min_time=0.001)
+        assert actual['loops'] >= 2
+        assert len(calls) >= actual['loops'] * 3
+
+    def test_compare(self):
+        "Regressions, improvements, and new and missing benchmarks."
+        baseline = _results(a=100.0, b=100.0, c=100.0, d=100.0)
+        current = _results(a=105.0, b=120.0, c=50.0, e=10.0)
+        actual = micro.compare(baseline, current, threshold=0.1)
+        assert [(each[0], each[4]) for each in actual] == [
+            ('a', 'same'), ('b', 'regression'), ('c', 'improvement'), ('d', 'missing'),
+            ('e', 'new')]
+        assert actual[1][3] == 1.2
@@ -28,6 +28,101 @@ port = 8888
 # The URL where Solr will be found. This must include the full path to the collection to query.
 # solr_url = 'http://localhost:8983/solr/collection1/'
 
+# Each worker process opens at most "solr_max_clients" connections to Solr at once; other requests
+# wait in a queue. "solr_connect_timeout" and "solr_request_timeout" are in seconds. When
+# "solr_keep_alive" is True and "pycurl" is installed, connections are reused between requests.
+# solr_max_clients = 20
+# solr_connect_timeout = 2.0
+# solr_request_timeout = 10.0
+# solr_keep_alive = True
+
+# When "solr_adaptive_limit" is True, each worker process adapts the number of queries it sends to
+# Solr at once (up to "solr_max_clients") to how quickly Solr answers: the limit shrinks when
+# recent queries take more than "solr_latency_tolerance" times as long as usual for their kind,
+# and grows again while Solr keeps up. Queries beyond the limit wait in a queue of at most "solr_queue_size"; when it is
+# full, requests get a 503 response at once, with a "Retry-After" header of "solr_retry_after"
+# seconds. Cross-referenced resources are left out of a response, as for "request_deadline" below,
+# rather than refusing the whole request.
+# solr_adaptive_limit = True
+# solr_queue_size = 100
+# solr_latency_tolerance = 2.0
+# solr_retry_after = 1
+
+# A GET request to a "browse" URL or a SEARCH request with "Accept: application/x-ndjson" or
+# "Accept: text/csv" gets every matching resource, fetched from Solr "export_batch_size" at a time.
+# export_batch_size = 500
+
+# A SEARCH request whose body has an "ids" list instead of a "query" gets all those resources in
+# one response. "batch_view_limit" is the most IDs allowed in one request.
+# batch_view_limit = 100
+
+# Response bodies are encoded with "orjson" or "python-rapidjson" if one is installed, otherwise with
+# the standard library; set "json_encoder" to "orjson," "rapidjson," or "stdlib" to choose one. A
+# response with at least "json_executor_threshold" resources is encoded on a thread, so the event
+# loop can answer other requests meanwhile (this does not make the encoding itself faster). 0 means
+# every response is encoded on the event loop.
+# json_encoder = 'auto'
+# json_executor_threshold = 0
+
+
+## Processes --------------------------------------------------------------------------------------
+
+# "workers" is the number of Abbot processes that share the listening socket (including a socket
+# from systemd socket activation). 0 starts one process per CPU core. When a worker dies, it is
+# restarted, unless it has happened more than "max_worker_restarts" times, in which case Abbot
+# quits. Every worker logs to systemd-journal with its own identifier ("abbot-0", "abbot-1", ...).
+# workers = 1
+# max_worker_restarts = 100
+
+
+## Caching ----------------------------------------------------------------------------------------
+
+# Resources that are cross-referenced in chants and sources (feasts, genres, and so on) are held in
+# memory after they are fetched from Solr. "xref_cache_size" is the maximum number of resources to
+# hold (0 disables the cache), and "xref_cache_ttl" is the number of seconds before a resource is
+# fetched again.
+# xref_cache_size = 4096
+# xref_cache_ttl = 3600
+
+# Abbot holds every resource of the "simple" types (centuries, feasts, genres, and so on) in memory,
+# answering requests for them without asking Solr. "taxonomy_refresh" is the number of seconds
+# between reloads from Solr; 0 disables the in-memory store.
+# taxonomy_refresh = 3600
+
+# Whole responses to GET and SEARCH requests are held in memory, so repeating a request with the
+# same URL and "X-Cantus-*" request headers does not ask Solr again. "response_cache_size" is the
+# maximum number of bytes of responses to hold (0 disables the cache), and "response_cache_ttl" is
+# the number of seconds before a response is built again.
+# response_cache_size = 33554432
+# response_cache_ttl = 300
+
+# Every resource in a response is also held in memory already formatted and serialized, so another
+# response with the same resource (on another page, or for another query) only copies it. The
+# cache is emptied when the data in Solr change. "fragment_cache_size" is the maximum number of
+# bytes to hold (0 disables the cache), and "fragment_cache_ttl" is the number of seconds before a
+# resource is formatted again.
+# fragment_cache_size = 33554432
+# fragment_cache_ttl = 3600
+
+# The parsed form of SEARCH query strings is held in memory. "query_cache_size" is the maximum
+# number of query strings to hold (0 disables the cache).
+# query_cache_size = 1024
+
+# Cross-referenced fields in SEARCH queries (like "genre:antiphon") are resolved by asking Solr, and
+# the answers are held in memory. "subquery_cache_size" is the maximum number of answers to hold (0
+# disables the cache), and "subquery_cache_ttl" is the number of seconds before asking Solr again.
+# subquery_cache_size = 1024
+# subquery_cache_ttl = 3600
+
+# Responses carry "ETag" and "Last-Modified" headers derived from the "generation" of the data, and
+# the caches above (except the query cache) are emptied when the generation changes. If
+# "updates_db" is set to the path of
+# the Holy Orders updates database, the generation is the most recent update recorded there;
+# otherwise it is the Solr index version. "generation_refresh" is the number of seconds between
+# checks for a new generation; 0 disables the "ETag" and "Last-Modified" headers.
+# updates_db = '/var/db/holy_orders/updates.db'
+# generation_refresh = 30
+
 
 ## TLS --------------------------------------------------------------------------------------------
 
@@ -72,3 +167,32 @@ else:
 
 # Note that Abbot replaces Tornado's default log "handler" with a connection to systemd-journal
 # via the "systemdream" library. This means the other default Tornado log options are ignored.
+
+
+## Metrics ----------------------------------------------------------------------------------------
+
+# If "metrics_port" is set, every worker process serves Prometheus metrics (request rates and
+# latencies, Solr query latencies, requests in flight, and cache hit ratios) at "/metrics" on this
+# port, separately from the Cantus API. With several worker processes, worker "n" uses port
+# "metrics_port + n". Keep "metrics_address" on a private interface; 0 disables the metrics.
+# metrics_port = 9100
+# metrics_address = '127.0.0.1'
+
+# If "server_timing" is True, responses have a "Server-Timing" header with the milliseconds taken by
+# each stage of the request: parsing a SEARCH query ("parse"), its cross-reference subqueries
+# ("subqueries"), the main Solr query ("solr"), looking up cross-referenced resources ("xrefs") and
+# their extra fields ("extra_fields"), and serializing the response ("encode"). The same stages are
+# always recorded in the "abbot_stage_duration_seconds" metric.
+# server_timing = False
+
+
+## Deadlines --------------------------------------------------------------------------------------
+
+# "request_deadline" is the number of seconds a request may spend waiting for Solr, in total, across
+# its main query, the subqueries of a SEARCH query, and looking up cross-referenced resources. A
+# request whose deadline passes before the main query is answered gets a 504 response. When only
+# the cross-references are late, the response has the resources without them, a header
+# "X-Cantus-Partial: xrefs", and "Cache-Control: no-store". Clients may send an "X-Cantus-Deadline"
+# header to shorten (but not lengthen) the deadline of one request. Exports are not limited. 0 means
+# no deadline, so only "solr_request_timeout" applies to each query.
+# request_deadline = 15.0
@@ -43,6 +43,10 @@ setup(
         'tornado>=4.3,<4.4',
         'tornado_systemd>=1,<2',
     ],
+    extras_require = {
+        'keep-alive': ['pycurl'],  # keep connections to Solr open between requests
+        'fast-json': ['orjson'],  # encode response bodies faster than the standard library
+    },
     tests_require = ['pytest'],
 
     # metadata for upload to PyPI